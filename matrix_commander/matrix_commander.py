@@ -20,13 +20,21 @@ import ast
 import asyncio
 import datetime
 import errno
+import fnmatch
 import getpass
+import gzip
+import hashlib
+import html
+import heapq
 import json
 import logging
+import mimetypes
 import os
 import re  # regular expression
 import select
 import shutil
+import signal
+import sqlite3
 import ssl
 import subprocess
 import sys
@@ -36,11 +44,12 @@ import time
 import traceback
 import urllib.request
 import uuid
+from collections import Counter
 from importlib import metadata
 from os import R_OK, access
 from os.path import isfile
 from ssl import SSLContext
-from typing import Literal, Optional, Union
+from typing import AsyncIterator, Literal, Optional, Tuple, Union
 from urllib.parse import quote, urlparse
 from uuid import uuid4
 
@@ -48,9 +57,13 @@ import aiofiles
 import aiofiles.os
 import emoji
 import magic
-from aiohttp import ClientConnectorError, ClientSession, TCPConnector, web
+import unpaddedbase64
+from aiohttp import (ClientConnectorError, ClientError, ClientSession,
+                     ClientTimeout, TCPConnector, web)
+from Crypto.Cipher import AES
 from markdown import markdown
-from nio import (AsyncClient, AsyncClientConfig, BaseRoomKeyRequest,
+from nio import (Api, AsyncClient, AsyncClientConfig, BadEvent,
+                 BaseRoomKeyRequest,
                  ContentRepositoryConfigError, DeleteDevicesAuthResponse,
                  DeleteDevicesError, DevicesError, DiscoveryInfoError,
                  DownloadError, DummyEvent, EnableEncryptionBuilder,
@@ -62,26 +75,31 @@ from nio import (AsyncClient, AsyncClientConfig, BaseRoomKeyRequest,
                  LocalProtocolError, LoginInfoError, LoginResponse,
                  LogoutError, MatrixRoom, MessageDirection, OlmEvent,
                  PresenceGetError, PresenceSetError, ProfileGetAvatarResponse,
-                 ProfileGetDisplayNameError, ProfileGetError,
+                 ProfileGetDisplayNameResponse, ProfileGetError,
+                 ProfileGetResponse,
                  ProfileSetAvatarResponse, ProfileSetDisplayNameError,
                  RedactedEvent, RedactionEvent, RoomAliasEvent, RoomBanError,
-                 RoomCreateError, RoomDeleteAliasResponse, RoomEncryptedAudio,
+                 RoomContextError, RoomCreateError, RoomDeleteAliasResponse,
+                 RoomEncryptedAudio,
                  RoomEncryptedFile, RoomEncryptedImage, RoomEncryptedMedia,
                  RoomEncryptedVideo, RoomEncryptionEvent, RoomForgetError,
+                 RoomGetStateEventError,
                  RoomGetStateResponse, RoomGetVisibilityResponse,
                  RoomInviteError, RoomKeyEvent, RoomKeyRequest,
                  RoomKeyRequestCancellation, RoomKickError, RoomLeaveError,
                  RoomMemberEvent, RoomMessage, RoomMessageAudio,
                  RoomMessageEmote, RoomMessageFile, RoomMessageFormatted,
                  RoomMessageImage, RoomMessageMedia, RoomMessageNotice,
-                 RoomMessagesError, RoomMessageText, RoomMessageUnknown,
+                 RoomMessagesError, RoomMessagesResponse,
+                 RoomMessageText, RoomMessageUnknown,
                  RoomMessageVideo, RoomNameEvent, RoomPreset,
                  RoomPutAliasResponse, RoomReadMarkersError, RoomRedactError,
                  RoomResolveAliasError, RoomResolveAliasResponse,
                  RoomSendError, RoomUnbanError, RoomVisibility, SyncError,
-                 SyncResponse, ToDeviceError, ToDeviceEvent, ToDeviceMessage,
+                 SyncResponse, ThumbnailResponse, ToDeviceError, ToDeviceEvent,
+                 ToDeviceMessage,
                  UnknownEvent, UnknownToDeviceEvent, UpdateDeviceError,
-                 UploadError, UploadResponse, crypto, responses)
+                 UploadError, UploadResponse, responses)
 from PIL import Image
 from xdg import BaseDirectory
 
@@ -92,6 +110,13 @@ try:
 except ImportError:
     HAVE_NOTIFY = False
 
+try:
+    import orjson
+
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
 try:
     from nio import GetOpenIDTokenError
 
@@ -162,6 +187,74 @@ SEP = DEFAULT_SEPARATOR
 LISTEN_DEFAULT = NEVER
 TAIL_UNUSED_DEFAULT = 0  # get 0 if --tail is not specified
 TAIL_USED_DEFAULT = 10  # get the last 10 msgs by default with --tail
+CHECKPOINTS_FILE = "checkpoints.json"  # in store dir, for --incremental
+ROOM_STATE_SNAPSHOTS_FILE = "room-state.json"  # in store dir, state diffs
+ARCHIVE_FILE = "archive.db"  # in store dir, for --archive and --search
+EXPORT_JSONL = "jsonl"
+EXPORT_HTML = "html"
+EXPORT_MARKDOWN = "markdown"
+# file name extension (without .gz) --> export format, see --export
+EXPORT_FORMATS = {
+    ".jsonl": EXPORT_JSONL,
+    ".html": EXPORT_HTML,
+    ".htm": EXPORT_HTML,
+    ".md": EXPORT_MARKDOWN,
+    ".markdown": EXPORT_MARKDOWN,
+}
+EXPORT_FLUSH_EVERY = 1000  # flush export file every N messages
+# Events are kept in table events, the full-text index events_fts is an
+# external-content FTS5 table kept in sync by the triggers.
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    event_id TEXT NOT NULL UNIQUE,
+    room_id TEXT NOT NULL,
+    room TEXT,
+    room_alias TEXT,
+    sender TEXT NOT NULL,
+    sender_nick TEXT,
+    timestamp INTEGER NOT NULL,
+    type TEXT,
+    body TEXT,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS events_room_timestamp
+    ON events (room_id, timestamp);
+CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+    body, sender, room, content='events', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS events_ai AFTER INSERT ON events BEGIN
+    INSERT INTO events_fts (rowid, body, sender, room)
+        VALUES (new.id, new.body, new.sender, new.room);
+END;
+CREATE TRIGGER IF NOT EXISTS events_ad AFTER DELETE ON events BEGIN
+    INSERT INTO events_fts (events_fts, rowid, body, sender, room)
+        VALUES ('delete', old.id, old.body, old.sender, old.room);
+END;
+CREATE TRIGGER IF NOT EXISTS events_au AFTER UPDATE ON events BEGIN
+    INSERT INTO events_fts (events_fts, rowid, body, sender, room)
+        VALUES ('delete', old.id, old.body, old.sender, old.room);
+    INSERT INTO events_fts (rowid, body, sender, room)
+        VALUES (new.id, new.body, new.sender, new.room);
+END;
+"""
+ROOM_NAME_STATE_EVENTS = ("m.room.name", "m.room.canonical_alias")
+ROOM_INFO_STATE_EVENTS = ROOM_NAME_STATE_EVENTS + (
+    "m.room.topic",
+    "m.room.encryption",
+)
+# sync filter leaving out all rooms, presence and account data, so that
+# only to-device events like new room keys come in, see sync_to_device()
+SYNC_TO_DEVICE_FILTER = {
+    "room": {"rooms": []},
+    "presence": {"types": []},
+    "account_data": {"types": []},
+}
+CONCURRENCY_DEFAULT = 8  # max. number of rooms, etc. handled in parallel
+PREFETCH_PAGES = 2  # pages of messages fetched ahead, per room
+STREAM_EDIT_UNUSED_DEFAULT = None  # use None if --stream-edit is not used
+STREAM_EDIT_USED_DEFAULT = 5.0  # seconds between edits with --stream-edit
 VERIFY_UNUSED_DEFAULT = None  # use None if --verify is not specified
 VERIFY_USED_DEFAULT = VERIFY_DEFAULT  # use 'emoji' by default with --verify
 VERSION_UNUSED_DEFAULT = None  # use None if --version is not specified
@@ -193,6 +286,10 @@ OUTPUT_JSON_MAX = "json-max"
 # adhere to Spec and hence print a JSON object. All other print nothing.
 OUTPUT_JSON_SPEC = "json-spec"
 OUTPUT_DEFAULT = OUTPUT_TEXT
+# buffered records written at once to a pipe or file, see --batch-output
+OUTPUT_FLUSH_RECORDS = 1000
+# seconds a buffered record waits at most before it is written
+OUTPUT_FLUSH_INTERVAL = 0.2
 
 # source, use media file name as provided by sender
 MEDIA_NAME_SOURCE = "source"
@@ -208,6 +305,52 @@ MEDIA_NAME_TIME = "time"
 MEDIA_NAME_DEFAULT = MEDIA_NAME_CLEAN
 # chars allowed in a clean name: alphanumerical and these
 MEDIA_NAME_CLEAN_CHARS = "._- ~$"
+# content-addressed media store, see --download-media-dedup
+MEDIA_OBJECTS_DIR = ".objects"  # in media dir, files named by SHA-256
+MEDIA_INDEX_FILE = ".media-index.db"  # in media dir, mxc --> SHA-256
+AVATAR_CACHE_DIR = "avatars"  # in store dir, see --os-notify
+AVATAR_INDEX_FILE = "index.json"  # in avatar cache dir, user --> mxc
+AVATAR_CACHE_TTL = 24 * 3600  # seconds until a user's avatar is looked up
+AVATAR_CACHE_MAX_SIZE = 20 * 1024 * 1024  # bytes in avatar cache dir
+AVATAR_SIZE = 96  # pixels, width and height of avatar thumbnails
+PROFILE_CACHE_FILE = "profiles.json"  # in store dir, see --profile-cache-ttl
+PROFILE_CACHE_TTL_DEFAULT = 0  # seconds, 0: no cache, see --profile-cache-ttl
+# levels needed if not given in m.room.power_levels, see --has-permission
+POWER_LEVEL_DEFAULTS = {
+    "ban": 50,
+    "events_default": 0,
+    "invite": 0,
+    "kick": 50,
+    "redact": 50,
+    "state_default": 50,
+    "users_default": 0,
+}
+# state events of the Matrix specification, events of other types not
+# listed in 'events' of m.room.power_levels need 'events_default'
+STATE_EVENT_TYPES = {
+    "m.room.aliases",
+    "m.room.avatar",
+    "m.room.canonical_alias",
+    "m.room.create",
+    "m.room.encryption",
+    "m.room.guest_access",
+    "m.room.history_visibility",
+    "m.room.join_rules",
+    "m.room.member",
+    "m.room.name",
+    "m.room.pinned_events",
+    "m.room.power_levels",
+    "m.room.server_acl",
+    "m.room.third_party_invite",
+    "m.room.tombstone",
+    "m.room.topic",
+    "m.space.child",
+    "m.space.parent",
+}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes, see --download
+UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes, see --upload-rate-limit
+DOWNLOAD_SEGMENTS_DEFAULT = 1  # see --download-segments
+DOWNLOAD_SEGMENT_MIN_SIZE = 16 * 1024 * 1024  # smaller files in one piece
 
 # location of README.md file if it is not found on local harddisk
 # used for --manual
@@ -223,9 +366,9 @@ INVITES_USED_DEFAULT = (
 )
 
 # increment this number and use new incremented number for next warning
-# last unique Wxxx warning number used: W114:
+# last unique Wxxx warning number used: W119:
 # increment this number and use new incremented number for next error
-# last unique Exxx error number used: E258:
+# last unique Exxx error number used: E268:
 
 
 class LooseVersion:
@@ -310,6 +453,26 @@ class GlobalState:
         self.ssl: Union[None, SSLContext, bool] = None
         self.client: Union[None, AsyncClient] = None
         self.credentials: Union[None, dict] = None
+        # SQLite connection to the archive, see --archive and --search
+        self.archive: Union[None, sqlite3.Connection] = None
+        # receives the messages instead of stdout, see --export
+        self.exporter: Union[None, HistoryExporter] = None
+        # aggregates the messages instead of printing them, see --stats
+        self.stats: Union[None, HistoryStats] = None
+        # downloads media in the background, see --download-media
+        self.media_downloader: Union[None, MediaDownloader] = None
+        # avatars of senders as local files, see --os-notify
+        self.avatar_cache: Union[None, AvatarCache] = None
+        # cached user profiles, see --profile-cache-ttl
+        self.profile_cache: Union[None, ProfileCache] = None
+        # see --upload-rate-limit and --download-rate-limit
+        self.upload_limiter: Union[None, RateLimiter] = None
+        self.download_limiter: Union[None, RateLimiter] = None
+        # rooms printed in full while listening, see --full-room
+        # maps room id to room_fingerprint() of the printed room
+        self.rooms_printed: dict = {}
+        # writes the lines of print_output(), see --batch-output
+        self.output_writer: Union[None, OutputWriter] = None
         self.send_action = False  # argv contains send action
         self.listen_action = False  # argv contains listen action
         self.room_action = False  # argv contains room action
@@ -343,6 +506,107 @@ def privacy_filter(dirty: str) -> str:
     return dirty.replace(gs.credentials["access_token"], "***")
 
 
+class OutputWriter:
+    """Write the lines of print_output() to stdout, in batches if wanted.
+
+    By default every line is written and flushed right away. With
+    '--batch-output' lines are collected and written together when
+    OUTPUT_FLUSH_RECORDS lines are pending or OUTPUT_FLUSH_INTERVAL seconds
+    after the first pending line, whichever comes first. This saves a
+    system call per record when '--listen' or '--tail' write to a pipe or
+    file. Every write holds complete lines only, so a reader of the pipe
+    never sees half a record. A terminal, or a caller outside of the event
+    loop, gets every line right away regardless. Pending lines are written
+    by flush_output() before anything else goes to stdout, by cleanup()
+    and on SIGTERM.
+    """
+
+    def __init__(self):
+        """Create an empty buffer."""
+        self.lines = []
+        self.timer = None  # pending flush, asyncio.TimerHandle
+        self.stream = None  # sys.stdout as last seen, callers may replace it
+        self.tty = False  # is self.stream a terminal?
+        self.batch = bool(gs.pa.batch_output)
+
+    def write(self, line: str) -> None:
+        """Add a line, without newline, and write it out when it is due."""
+        self.lines.append(line)
+        if sys.stdout is not self.stream:
+            self.stream = sys.stdout
+            self.tty = self.stream.isatty()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if (
+            not self.batch
+            or loop is None
+            or len(self.lines) >= OUTPUT_FLUSH_RECORDS
+            or self.tty
+        ):
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(OUTPUT_FLUSH_INTERVAL, self.flush)
+
+    def flush(self) -> None:
+        """Write all pending lines to stdout."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.lines:
+            return
+        text = "\n".join(self.lines) + "\n"
+        self.lines = []
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            gs.err_count += 1
+            gs.log.error(
+                "E268: "
+                "Output could not be written because standard output "
+                "was closed, e.g. by the program reading the pipe."
+            )
+
+
+def flush_output() -> None:
+    """Write pending lines of print_output() before writing to stdout."""
+    if gs.output_writer:
+        gs.output_writer.flush()
+
+
+def terminate_on_sigterm() -> None:
+    """Write pending lines on SIGTERM, then terminate as usual.
+
+    Installed with loop.add_signal_handler(), so it runs as a callback of
+    the event loop and never in the middle of another write to stdout.
+    """
+    flush_output()
+    asyncio.get_running_loop().remove_signal_handler(signal.SIGTERM)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def json_dumps(obj, default=None) -> str:
+    """Serialize obj to a JSON string, with orjson if '--fast-json' is used.
+
+    Falls back to the json module for anything orjson refuses, e.g.
+    integers beyond 64 bit.
+    """
+    if HAVE_ORJSON and gs.pa.fast_json:
+        try:
+            return orjson.dumps(
+                obj,
+                default=default,
+                option=orjson.OPT_NON_STR_KEYS
+                | orjson.OPT_PASSTHROUGH_DATACLASS
+                | orjson.OPT_PASSTHROUGH_DATETIME,
+            ).decode()
+        except TypeError:  # includes orjson.JSONEncodeError
+            pass
+    return json.dumps(obj, default=default)
+
+
 def print_output(
     option: Literal["text", "json", "json-max", "json-spec"],
     *,
@@ -367,18 +631,68 @@ def print_output(
             )
         return
     if option == OUTPUT_TEXT:
-        print(results[option], flush=True)
+        line = str(results[option])
     elif option == OUTPUT_JSON_SPEC:
-        print(json.dumps(results[option]), flush=True)
+        line = json_dumps(results[option])
     else:  # OUTPUT_JSON or OUTPUT_JSON_MAX
-        print(json.dumps(results[option], default=obj_to_dict), flush=True)
+        line = json_dumps(results[option], default=obj_to_dict)
+    if not gs.output_writer:
+        gs.output_writer = OutputWriter()
+    gs.output_writer.write(line)
+
+
+# classes whose objects are converted to their string by obj_to_dict()
+OBJ_TO_DICT_AS_STR = {
+    # this one is crucial, it make the serialization circular reference.
+    "aiohttp.streams.StreamReader",
+    # these are crucial, they make the serialization circular reference.
+    "asyncio.unix_events._UnixSelectorEventLoop",
+    "aiohttp.tracing.Trace",
+    "aiohttp.tracing.TraceConfig",
+    # avoid "keys must be str, int, float, bool or None" errors
+    "aiohttp.connector.TCPConnector",
+}
+# items of the Olm object kept by obj_to_dict()
+OBJ_TO_DICT_OLM_KEYS = (
+    "user_id",
+    "device_id",
+    "uploaded_key_count",
+    "users_for_key_query",
+    "device_store",
+    "outbound_group_sessions",
+    "tracked_users",
+    "outgoing_key_requests",
+    "received_key_requests",
+    "key_requests_waiting_for_session",
+    "key_request_devices_no_session",
+    "key_request_from_untrusted",
+    "wedged_devices",
+    "key_re_requests_events",
+    "key_verifications",
+    "outgoing_to_device_messages",
+    "message_index_store",
+    "store",
+)
+# type --> conversion function, filled by obj_to_dict() on first use
+OBJ_TO_DICT_HANDLERS = {}
 
 
 def obj_to_dict(obj):
     """Return dict of object
 
     Useful for json.dump() dict-to-json conversion.
+    How objects are converted is decided once per type, the decision is
+    kept in OBJ_TO_DICT_HANDLERS, see obj_to_dict_handler().
     """
+    handler = OBJ_TO_DICT_HANDLERS.get(type(obj))
+    if handler is None:
+        handler = obj_to_dict_handler(obj)
+        OBJ_TO_DICT_HANDLERS[type(obj)] = handler
+    return handler(obj)
+
+
+def obj_to_dict_handler(obj):
+    """Return the function obj_to_dict() uses for objects like obj."""
     if gs.pa.verbose > 1:  # 2+
         gs.log.debug(f"obj_to_dict: {obj.__class__}")
         gs.log.debug(f"obj_to_dict: {obj.__class__.__name__}")
@@ -399,98 +713,69 @@ def obj_to_dict(obj):
     #     return {obj.__class__.__name__: str(obj)}
     # if get_qualifiedclassname(obj) == "aiosignal.Signal":
     #     return {obj.__class__.__name__: str(obj)}
-    # this one is crucial, it make the serialization circular reference.
-    if get_qualifiedclassname(obj) == "aiohttp.streams.StreamReader":
-        return {obj.__class__.__name__: str(obj)}
-    # these four are crucial, they make the serialization circular reference.
-    if (
-        get_qualifiedclassname(obj)
-        == "asyncio.unix_events._UnixSelectorEventLoop"
-    ):
-        return {obj.__class__.__name__: str(obj)}
-    if get_qualifiedclassname(obj) == "aiohttp.tracing.Trace":
-        return {obj.__class__.__name__: str(obj)}
-    if get_qualifiedclassname(obj) == "aiohttp.tracing.TraceConfig":
-        return {obj.__class__.__name__: str(obj)}
-    # avoid "keys must be str, int, float, bool or None" errors
-    if get_qualifiedclassname(obj) == "aiohttp.connector.TCPConnector":
-        return {obj.__class__.__name__: str(obj)}
-
+    if get_qualifiedclassname(obj) in OBJ_TO_DICT_AS_STR:
+        return obj_to_class_and_str
     if hasattr(obj, "__dict__"):
         if (
             "inbound_group_store" in obj.__dict__
             and "session_store" in obj.__dict__
             and "outbound_group_sessions" in obj.__dict__
         ):
-            # "olm" is huge, 1MB+, 20K lines of JSON
-            # grab only some items
-            # "olm": {
-            #   "user_id": "@xxx:xxx.xxx.xxx",
-            #   "device_id": "xxx",
-            #   "uploaded_key_count": 50,
-            #   "users_for_key_query": {
-            #     "set": "..."
-            #   },
-            #   "device_store": {
-            #       ... want
-            #   },
-            #   "session_store": {
-            #       ... don't want, too long
-            #   },
-            #   "inbound_group_store": {
-            #       ... don't want, 20K lines, too long
-            #   },
-            #   "outbound_group_sessions": {},
-            #   "tracked_users": {
-            #     "set": "set()"
-            #   },
-            dictcopy = {}
-            for key in [
-                "user_id",
-                "device_id",
-                "uploaded_key_count",
-                "users_for_key_query",
-                "device_store",
-                "outbound_group_sessions",
-                "tracked_users",
-                "outgoing_key_requests",
-                "received_key_requests",
-                "key_requests_waiting_for_session",
-                "key_request_devices_no_session",
-                "key_request_from_untrusted",
-                "wedged_devices",
-                "key_re_requests_events",
-                "key_verifications",
-                "outgoing_to_device_messages",
-                "message_index_store",
-                "store",
-            ]:
-                dictcopy.update({key: obj.__dict__[key]})
-            if gs.pa.verbose > 1:  # 2+
-                gs.log.debug(
-                    f"{obj} is not serializable, simplifying to {dictcopy}."
-                )
-            return dictcopy
-        if gs.pa.verbose > 1:  # 2+
-            gs.log.debug(
-                f"{obj} is not serializable, using its available dictionary "
-                f"{obj.__dict__}."
-            )
-        return obj.__dict__
-    else:
-        # gs.log.debug(
-        #     f"Object {obj} ({type(obj)}) has no class dictionary. "
-        #     "Cannot be converted to JSON object. "
-        #     "Will be converted to JSON string."
-        # )
-        # simple types like yarl.URL do not have a __dict__
-        # get the class name as string, create a dict with classname and value
-        if gs.pa.verbose > 1:  # 2+
-            gs.log.debug(
-                f"{obj} is not serializable, simplifying to key value pair "
-                f"key '{obj.__class__.__name__}' and value '{str(obj)}'."
-            )
-        return {obj.__class__.__name__: str(obj)}
+            return obj_to_olm_dict
+        return obj_to_instance_dict
+    # simple types like yarl.URL do not have a __dict__
+    return obj_to_class_and_str
+
+
+def obj_to_class_and_str(obj):
+    """Convert obj to a dict with class name as key and str(obj) as value."""
+    # get the class name as string, create a dict with classname and value
+    if gs.pa.verbose > 1:  # 2+
+        gs.log.debug(
+            f"{obj} is not serializable, simplifying to key value pair "
+            f"key '{obj.__class__.__name__}' and value '{str(obj)}'."
+        )
+    return {obj.__class__.__name__: str(obj)}
+
+
+def obj_to_olm_dict(obj):
+    """Convert the Olm object to a dict of only some of its items."""
+    # "olm" is huge, 1MB+, 20K lines of JSON
+    # grab only some items
+    # "olm": {
+    #   "user_id": "@xxx:xxx.xxx.xxx",
+    #   "device_id": "xxx",
+    #   "uploaded_key_count": 50,
+    #   "users_for_key_query": {
+    #     "set": "..."
+    #   },
+    #   "device_store": {
+    #       ... want
+    #   },
+    #   "session_store": {
+    #       ... don't want, too long
+    #   },
+    #   "inbound_group_store": {
+    #       ... don't want, 20K lines, too long
+    #   },
+    #   "outbound_group_sessions": {},
+    #   "tracked_users": {
+    #     "set": "set()"
+    #   },
+    dictcopy = {key: obj.__dict__[key] for key in OBJ_TO_DICT_OLM_KEYS}
+    if gs.pa.verbose > 1:  # 2+
+        gs.log.debug(f"{obj} is not serializable, simplifying to {dictcopy}.")
+    return dictcopy
+
+
+def obj_to_instance_dict(obj):
+    """Convert obj to its instance dictionary."""
+    if gs.pa.verbose > 1:  # 2+
+        gs.log.debug(
+            f"{obj} is not serializable, using its available dictionary "
+            f"{obj.__dict__}."
+        )
+    return obj.__dict__
 
 
 def choose_available_filename(filename):
@@ -531,7 +816,27 @@ def derive_media_filename_with_path(event):
     As last step function adds a sequential number, iff necessary, to assure
     that the file does not yet exist and that no file is overwritten
     (if multiple media files have the same name).
+
+    With --download-media-dedup the media id of the mxc URI is added to
+    the name instead, which makes the name unique without probing the
+    directory, see dedup_media_filename_with_path().
     """
+    newfn = derive_media_filename(event)
+    if gs.pa.download_media_dedup:
+        return dedup_media_filename_with_path(
+            event, newfn, gs.pa.download_media
+        )
+    filename_with_path = choose_available_filename(
+        os.path.join(gs.pa.download_media, newfn)
+    )
+    gs.log.debug(
+        f"Unique file name for media with path is: {filename_with_path}"
+    )
+    return filename_with_path
+
+
+def derive_media_filename(event) -> str:
+    """Derive file name without path according to --download-media-name."""
     method = gs.pa.download_media_name
     if method == MEDIA_NAME_SOURCE:
         newfn = event.body
@@ -553,13 +858,57 @@ def derive_media_filename_with_path(event):
         )
     gs.log.debug(f"Media file name method is: {method}")
     gs.log.debug(f"New file name for media is: {newfn}")
-    filename_with_path = choose_available_filename(
-        os.path.join(gs.pa.download_media, newfn)
+    return newfn
+
+
+def dedup_media_filename_with_path(
+    event, newfn: str, media_dir: str
+) -> str:
+    """Derive the unique file name of a media file for --download-media-dedup.
+
+    The media id of the mxc URI is unique on its server, so it is added
+    before the extension, e.g. "image.png" becomes "image.AbCdEf.png".
+    The same media always gets the same name. No directory probing is
+    needed.
+    """
+    media_id = "".join(
+        x if (x.isalnum() or x in "_-") else "_"
+        for x in urlparse(event.url).path.strip("/")
     )
-    gs.log.debug(
-        f"Unique file name for media with path is: {filename_with_path}"
+    start, dot, ext = newfn.rpartition(".")
+    if not dot or not start:
+        start, ext = newfn, ""
+    name = f"{start}.{media_id}" + (f".{ext}" if ext else "")
+    return os.path.join(media_dir, name)
+
+
+def open_media_index(media_dir: str) -> sqlite3.Connection:
+    """Open the index of the content-addressed media store.
+
+    The index maps mxc URIs to the SHA-256 of their content, so media
+    that was already downloaded is not downloaded again.
+    """
+    conn = sqlite3.connect(os.path.join(media_dir, MEDIA_INDEX_FILE))
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS media (mxc TEXT PRIMARY KEY, "
+        "sha256 TEXT NOT NULL, size INTEGER, mimetype TEXT, "
+        "filename TEXT, timestamp INTEGER)"
     )
-    return filename_with_path
+    conn.execute("CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256)")
+    return conn
+
+
+def media_object_path(media_dir: str, sha256: str) -> str:
+    """Get the path of a media file in the content-addressed store."""
+    return os.path.join(media_dir, MEDIA_OBJECTS_DIR, sha256[:2], sha256)
+
+
+def link_media_object(obj: str, filename: str) -> None:
+    """Make filename a hard link to obj, or a symbolic link as fallback."""
+    try:
+        os.link(obj, filename)
+    except OSError:  # e.g. file system without hard links
+        os.symlink(os.path.relpath(obj, os.path.dirname(filename)), filename)
 
 
 async def synchronize(client: AsyncClient) -> SyncResponse:
@@ -591,10 +940,312 @@ async def synchronize(client: AsyncClient) -> SyncResponse:
     return resp
 
 
-async def download_mxc(
-    client: AsyncClient, mxc: str, filename: Optional[str] = None
+async def sync_to_device(client: AsyncClient) -> None:
+    """Receive pending to-device events with a minimal sync.
+
+    Without a sync no room keys sent by other devices are received and
+    recent messages of encrypted rooms cannot be decrypted. The sync
+    is filtered to leave out all rooms, so it is fast even on big
+    accounts. Failures are only warned about as reading messages
+    can still go on.
+    """
+    try:
+        resp = await client.sync(
+            timeout=0, sync_filter=SYNC_TO_DEVICE_FILTER, full_state=False
+        )
+    except ClientConnectorError as e:
+        err = (
+            "E100: "
+            "sync() failed. Do you have connectivity to internet? "
+            f"ClientConnectorError {e}"
+        )
+        raise MatrixCommanderError(err) from e
+    if isinstance(resp, SyncError):
+        gs.log.warning(
+            "W119: "
+            "Receiving new room keys failed. Some recent messages of "
+            "encrypted rooms might not be decrypted. "
+            f"{privacy_filter(str(resp))}"
+        )
+        gs.warn_count += 1
+
+
+def mxc_download_path(client: AsyncClient, mxc: str) -> str:
+    """Get the path to download an MXC resource with client.send().
+
+    Arguments:
+    ---------
+    client : Client
+    mxc : str
+        string representing URL like mxc://matrix.org/someRandomKey
+    """
+    url = urlparse(mxc)
+    try:
+        _, path = Api.download(
+            url.netloc, url.path.strip("/"), access_token=client.access_token
+        )
+    except TypeError:  # matrix-nio too old for authenticated media
+        _, path = Api.download(url.netloc, url.path.strip("/"))
+    return path
+
+
+def mxc_thumbnail_path(
+    client: AsyncClient, mxc: str, width: int, height: int
+) -> str:
+    """Get the path to download a server thumbnail with client.send().
+
+    Like mxc_download_path(), for a thumbnail of about width x height.
+    """
+    url = urlparse(mxc)
+    try:
+        _, path = Api.thumbnail(
+            url.netloc,
+            url.path.strip("/"),
+            width,
+            height,
+            access_token=client.access_token,
+        )
+    except TypeError:  # matrix-nio too old for authenticated media
+        _, path = Api.thumbnail(url.netloc, url.path.strip("/"), width, height)
+    return path
+
+
+def idle_timeout(client: AsyncClient) -> ClientTimeout:
+    """Get a timeout for client.send() that only covers idle time.
+
+    nio's request_timeout limits the whole request including reading the
+    body, so large or rate limited transfers would fail after 60 sec.
+    This timeout only fires if connecting, or waiting for the next piece
+    of data, takes longer than request_timeout.
+    """
+    return ClientTimeout(
+        total=None,
+        sock_connect=client.config.request_timeout,
+        sock_read=client.config.request_timeout,
+    )
+
+
+class RateLimiter:
+    """Limit the data rate of transfers to some bytes per second.
+
+    A token bucket shared by all transfers in one direction, see
+    --upload-rate-limit and --download-rate-limit. Up to one second
+    worth of data may be sent in a burst. Transfers wait in turn.
+    """
+
+    def __init__(self, rate: int):
+        """Start with a full bucket."""
+        self.rate = rate
+        self.tokens = rate
+        self.time = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, nbytes: int) -> None:
+        """Wait until nbytes may be transferred."""
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.time) * self.rate
+            )
+            self.time = now
+            self.tokens -= nbytes
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+def rate_limited_upload(f):
+    """Prepare an open file for client.upload(), see --upload-rate-limit.
+
+    Returns f itself if there is no limit, otherwise a data provider
+    which reads f from the start whenever nio (re)starts the upload.
+    """
+    if not gs.upload_limiter:
+        return f
+
+    async def chunks():
+        await f.seek(0)
+        while True:
+            chunk = await f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await gs.upload_limiter.acquire(len(chunk))
+            yield chunk
+
+    return lambda got_429, got_timeouts: chunks()
+
+
+async def fetch_mxc_range(
+    client: AsyncClient, path: str, part: str, first: int = 0, last=None
 ):
-    """Download MXC resource.
+    """Download a byte range of a media file and append it to part.
+
+    The range starts at first plus the size part already has, so an
+    interrupted download continues where it stopped. If the server
+    ignores the Range header, the file is downloaded from the start.
+
+    Arguments:
+    ---------
+    client : Client
+    path : str
+        media download path, see mxc_download_path()
+    part : str
+        name of local file receiving the data
+    first : int
+        offset of the range in the media file
+    last : int
+        last byte of the range, None for end of file
+
+    Returns the response; its body has already been read. Returns None
+    if part already holds the whole range.
+    """
+    offset = first + (os.path.getsize(part) if os.path.exists(part) else 0)
+    if last is not None and offset > last:
+        return None
+    headers = {}
+    if offset > 0 or last is not None:
+        headers["Range"] = f"bytes={offset}-{'' if last is None else last}"
+    resp = await client.send(
+        "GET", path, headers=headers, timeout=idle_timeout(client)
+    )
+    try:
+        if resp.status == 416:  # range not satisfiable, nothing left
+            return resp
+        if resp.status not in (200, 206):
+            raise MatrixCommanderError(
+                "E266: "
+                f"Download of {privacy_filter(path)} failed with HTTP "
+                f"status {resp.status}: "
+                f"{privacy_filter(await resp.text())}"
+            )
+        if resp.status == 200 and (first > 0 or last is not None):
+            raise MatrixCommanderError(
+                "E266: "
+                f"Download of {privacy_filter(path)} failed. Server "
+                "does not support downloading a part of a file."
+            )
+        mode = "ab" if resp.status == 206 else "wb"
+        async with aiofiles.open(part, mode) as f:
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                if gs.download_limiter:
+                    await gs.download_limiter.acquire(len(chunk))
+                await f.write(chunk)
+        return resp
+    finally:
+        resp.release()
+
+
+class AttachmentDecryptor:
+    """Decrypt an encrypted attachment piece by piece.
+
+    Does the same as crypto.attachments.decrypt_attachment() in constant
+    memory: data is decrypted chunk by chunk, the SHA-256 hash of the
+    ciphertext is computed along the way and checked with verify() at
+    the end.
+    """
+
+    def __init__(self, decryption_dict: dict):
+        """Set up AES-CTR from a key dictionary, see --key-dict."""
+        try:
+            key = unpaddedbase64.decode_base64(decryption_dict["key"]["k"])
+            iv = unpaddedbase64.decode_base64(decryption_dict["iv"])
+            self.expected_hash = unpaddedbase64.decode_base64(
+                decryption_dict["hashes"]["sha256"]
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise EncryptionError(f"Error decoding key dictionary. {e}")
+        self.sha256 = hashlib.sha256()
+        try:
+            # 8 bytes nonce followed by a 64 bit block counter
+            self.cipher = AES.new(
+                key,
+                AES.MODE_CTR,
+                nonce=iv[:8],
+                initial_value=int.from_bytes(iv[8:], "big"),
+            )
+        except ValueError as e:
+            raise EncryptionError(e)
+
+    def update(self, ciphertext: bytes) -> bytes:
+        """Decrypt the next chunk of ciphertext."""
+        self.sha256.update(ciphertext)
+        return self.cipher.decrypt(ciphertext)
+
+    def verify(self) -> None:
+        """Raise EncryptionError if the ciphertext was not the original."""
+        if self.sha256.digest() != self.expected_hash:
+            raise EncryptionError("Mismatched SHA-256 digest.")
+
+
+async def decrypt_file(src: str, dst: str, decryption_dict: dict) -> None:
+    """Decrypt file src into file dst in constant memory.
+
+    If the check of the SHA-256 hash fails, dst is removed and
+    EncryptionError is raised.
+    """
+    decryptor = AttachmentDecryptor(decryption_dict)
+    try:
+        async with aiofiles.open(src, "rb") as fin:
+            async with aiofiles.open(dst, "wb") as fout:
+                while True:
+                    chunk = await fin.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await fout.write(decryptor.update(chunk))
+        decryptor.verify()
+    except BaseException:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+
+async def write_mxc_to_stdout(
+    client: AsyncClient, path: str, decryption_dict: Optional[dict]
+) -> None:
+    """Write a media file to stdout while it is being downloaded.
+
+    Encrypted media is decrypted on the fly. As data is written before
+    the download is complete, an integrity error of encrypted media can
+    only be reported at the end.
+    """
+    decryptor = None
+    if decryption_dict:
+        decryptor = AttachmentDecryptor(decryption_dict)
+    resp = await client.send("GET", path, timeout=idle_timeout(client))
+    try:
+        if resp.status != 200:
+            raise MatrixCommanderError(
+                "E266: "
+                f"Download of {privacy_filter(path)} failed with HTTP "
+                f"status {resp.status}: "
+                f"{privacy_filter(await resp.text())}"
+            )
+        flush_output()
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            if gs.download_limiter:
+                await gs.download_limiter.acquire(len(chunk))
+            if decryptor:
+                chunk = decryptor.update(chunk)
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()  # keep the pipe flowing
+    finally:
+        resp.release()
+    if decryptor:
+        decryptor.verify()
+
+
+async def download_mxc_to_file(
+    client: AsyncClient,
+    mxc: str,
+    filename: Optional[str],
+    decryption_dict: Optional[dict],
+) -> str:
+    """Download MXC resource into a local file, resumable.
+
+    The data is collected in a .part file which is renamed to the final
+    file name once complete. If a .part file is left over from an
+    interrupted earlier run, the download continues where it stopped.
+    With --download-segments large files are downloaded in several
+    parts in parallel.
 
     Arguments:
     ---------
@@ -602,39 +1253,593 @@ async def download_mxc(
     mxc : str
         string representing URL like mxc://matrix.org/someRandomKey
     filename : str
-        optional name of file for storing download
+        name of local file, or None to use the name from the server,
+        "" to use 'mxc-<mxc-id>', "-" for stdout; may contain
+        MXC_ID_PLACEHOLDER
+    decryption_dict : dict
+        key dictionary for decryption, None if not encrypted
+
+    Returns the name of the file written.
     """
-    nio_version = metadata.version("matrix-nio")
-    # version incompatibility between matrix-nio 0.19.0 and 0.20+
-    # https://matrix.example.com/Abc123
-    # server_name = "matrix.example.com"
-    # media_id = "Abc123"
-    # matrix-nio v0.19.0 has: download(server_name: str, media_id: str, ..)
-    # convert mxc to server_name and media_id
-    # v0.20+ : resp = await client.download(mxc=mxc, filename=filename)
-    # v0.19- : resp = await client.download(
-    #                     server_name=server_name, media_id=media_id,
-    #                     filename=filename)
-    gs.log.debug(f"download_mxc input mxc is {mxc}.")
-    if nio_version.startswith("0.1"):  # like 0.19
-        gs.log.info(
-            f"You are running matrix-nio version {nio_version}. "
-            "You should be running version 0.20+. Update if necessary. "
+    url = urlparse(mxc)
+    media_id = url.path.strip("/")
+    if filename == "":
+        filename = "mxc-" + MXC_ID_PLACEHOLDER
+    if filename:
+        filename = filename.replace(MXC_ID_PLACEHOLDER, media_id)
+    # the .part file must not depend on the file name given by the server,
+    # as it is needed before the server is asked
+    part = (filename or "mxc-" + media_id) + ".part"
+    path = mxc_download_path(client, mxc)
+    if filename == "-":
+        await write_mxc_to_stdout(client, path, decryption_dict)
+        return filename
+    # ask for the first byte to learn size, name and Range support
+    resp = await client.send(
+        "GET",
+        path,
+        headers={"Range": "bytes=0-0"},
+        timeout=idle_timeout(client),
+    )
+    resp.release()
+    if resp.status not in (200, 206, 416):  # 416: empty file
+        raise MatrixCommanderError(
+            "E266: "
+            f"Download of URI '{mxc}' failed with HTTP status {resp.status}."
+        )
+    if not filename:
+        if resp.content_disposition:
+            filename = resp.content_disposition.filename
+        gs.log.debug(f"File name on server: {filename}")
+        # 3rd choice, mxc_id
+        filename = os.path.basename(filename or "") or "mxc-" + media_id
+    size = 0 if resp.status == 416 else None  # None: unknown
+    if resp.status == 206:
+        size = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        size = int(size) if size.isdigit() else None
+    segments = gs.pa.download_segments
+    if (
+        size is not None
+        and segments > 1
+        and size >= DOWNLOAD_SEGMENT_MIN_SIZE
+        and not os.path.exists(part)
+    ):
+        length = -(-size // segments)  # round up
+        ranges = [
+            (first, min(first + length, size) - 1)
+            for first in range(0, size, length)
+        ]
+        gs.log.debug(f"Downloading {mxc} in {len(ranges)} segments.")
+        fetches = []
+        for ii, (first, last) in enumerate(ranges):
+            seg = f"{part}.{ii}"
+            if os.path.exists(seg):
+                if os.path.getsize(seg) == last - first + 1:
+                    continue  # complete from an earlier run
+                if os.path.getsize(seg) > last - first + 1:
+                    os.remove(seg)  # corrupt, start over
+            fetches.append(fetch_mxc_range(client, path, seg, first, last))
+        await asyncio.gather(*fetches)
+        for ii, (first, last) in enumerate(ranges):
+            seg = f"{part}.{ii}"
+            if os.path.getsize(seg) != last - first + 1:
+                got = os.path.getsize(seg)
+                if got > last - first + 1:
+                    os.remove(seg)
+                raise MatrixCommanderError(
+                    "E266: "
+                    f"Download of URI '{mxc}' is incomplete or corrupt. "
+                    f"Segment {ii} should have {last - first + 1} bytes, "
+                    f"got {got} bytes."
+                )
+        async with aiofiles.open(f"{part}.tmp", "wb") as f:
+            for ii in range(len(ranges)):
+                async with aiofiles.open(f"{part}.{ii}", "rb") as seg:
+                    while True:
+                        chunk = await seg.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        await f.write(chunk)
+        os.replace(f"{part}.tmp", part)
+        for ii in range(len(ranges)):
+            os.remove(f"{part}.{ii}")
+    elif size is None or not os.path.exists(part):
+        # no Range support, download from start
+        if os.path.exists(part):
+            os.remove(part)
+        await fetch_mxc_range(client, path, part)
+    elif os.path.getsize(part) < size:
+        gs.log.debug(
+            f"Resuming download of {mxc} at {os.path.getsize(part)} bytes."
         )
-        url = urlparse(mxc)
-        gs.log.debug(f"download_mxc input url is {url}.")
-        response = await client.download(
-            server_name=url.netloc,
-            media_id=url.path.strip("/"),
-            filename=filename,
+        await fetch_mxc_range(client, path, part)
+    if size is not None and os.path.getsize(part) > size:
+        os.remove(part)  # cannot be resumed, start over next time
+        raise MatrixCommanderError(
+            "E266: "
+            f"Download of URI '{mxc}' is corrupt. "
+            f"Expected {size} bytes, got more. The data was discarded."
         )
+    if size is not None and os.path.getsize(part) != size:
+        raise MatrixCommanderError(
+            "E266: "
+            f"Download of URI '{mxc}' is incomplete or corrupt. "
+            f"Expected {size} bytes, got {os.path.getsize(part)} bytes. "
+            f"The data downloaded so far was kept in '{part}'."
+        )
+    if decryption_dict:
+        await decrypt_file(part, f"{part}.tmp", decryption_dict)
+        os.replace(f"{part}.tmp", filename)
+        os.remove(part)
     else:
-        gs.log.debug(
-            f"You are running matrix-nio version {nio_version}. Great!"
+        os.replace(part, filename)
+    return filename
+
+
+def thumbnail_size(size: str) -> Tuple[int, int]:
+    """Get width and height from WxH, see --download-media-thumbnail."""
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def filename_for_mimetype(filename: str, mimetype: Optional[str]) -> str:
+    """Replace the extension of filename by the one of a MIME type.
+
+    Used for thumbnails, which usually are JPEG or PNG files whatever the
+    type of the media file is, see --download-media-thumbnail.
+    filename is returned unchanged if the MIME type is not known.
+    """
+    ext = None
+    if mimetype:
+        ext = mimetypes.guess_extension(mimetype.split(";")[0].strip())
+    root, old_ext = os.path.splitext(filename)
+    if not ext or ext == old_ext.lower():
+        return filename
+    return root + ext
+
+
+def media_download_wanted(
+    room: MatrixRoom, event, thumbnail: bool = False
+) -> bool:
+    """Check the --download-media-* filters for a media event.
+
+    With thumbnail set (see --download-media-thumbnail) the size limit
+    is checked against the size of the thumbnail given by the sender,
+    if any. The size of the full file is checked in
+    MediaDownloader._fetch(), if no thumbnail can be had.
+    """
+    info = event.source.get("content", {}).get("info")
+    if not isinstance(info, dict):
+        info = {}
+    size = info.get("size")
+    if thumbnail:
+        thumbnail_info = info.get("thumbnail_info")
+        if not isinstance(thumbnail_info, dict):
+            thumbnail_info = {}
+        size = thumbnail_info.get("size")
+    if (
+        gs.pa.download_media_max_size is not None
+        and isinstance(size, int)
+        and size > gs.pa.download_media_max_size
+    ):
+        gs.log.debug(f"Not downloading media of {size} bytes: too big.")
+        return False
+    mimetype = info.get("mimetype") or ""
+    if gs.pa.download_media_mime_types and not any(
+        fnmatch.fnmatch(mimetype, pattern)
+        for pattern in gs.pa.download_media_mime_types
+    ):
+        gs.log.debug(f"Not downloading media of type '{mimetype}'.")
+        return False
+    if gs.pa.download_media_rooms and not (
+        {room.room_id, room.canonical_alias, room.display_name}
+        & set(gs.pa.download_media_rooms)
+    ):
+        gs.log.debug(f"Not downloading media of room {room.room_id}.")
+        return False
+    return True
+
+
+class MediaDownloader:
+    """Download media files in the background, see --download-media.
+
+    Media events are queued with submit() and downloaded by --concurrency
+    worker tasks, so that message processing and printing never wait for
+    a download. The queue is bounded: if downloads fall far behind,
+    submit() waits. Files are streamed to a temporary .part file and
+    renamed when complete. Each completed download is reported as an
+    output record of its own.
+
+    With mirror set (see --mirror-media) media is always stored as full
+    files in a content-addressed store in media_dir, and media that is
+    already in the store is skipped silently.
+    """
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        media_dir: Optional[str] = None,
+        mirror: bool = False,
+    ):
+        """Create the queue and start the workers."""
+        self.client = client
+        self.media_dir = media_dir or gs.pa.download_media
+        self.thumbnail = None if mirror else gs.pa.download_media_thumbnail
+        self.report_known = not mirror
+        self.index = None  # see --download-media-dedup
+        if mirror or gs.pa.download_media_dedup:
+            self.index = open_media_index(self.media_dir)
+        workers = gs.pa.concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=2 * workers)
+        self.tasks = [
+            asyncio.create_task(self._work()) for _ in range(workers)
+        ]
+
+    async def submit(self, room: MatrixRoom, event) -> str:
+        """Queue the download of the media of an event.
+
+        Returns the file name the media will be stored under. The file
+        is created empty right away to reserve the name, except with
+        --download-media-dedup where names are unique anyway.
+        """
+        if self.index:
+            filename = dedup_media_filename_with_path(
+                event, derive_media_filename(event), self.media_dir
+            )
+            await self.queue.put((room, event, filename))
+            return filename
+        while True:
+            filename = derive_media_filename_with_path(event)
+            try:
+                open(filename, "x").close()  # reserve the name
+                break
+            except FileExistsError:
+                continue  # name was taken meanwhile, choose the next one
+        await self.queue.put((room, event, filename))
+        return filename
+
+    async def _work(self) -> None:
+        while True:
+            room, event, filename = await self.queue.get()
+            try:
+                await self._download(room, event, filename)
+            except Exception as e:
+                gs.log.error(
+                    "E264: "
+                    f"Download of media {event.url} to {filename} failed. "
+                    f"Exception: {type(e)} {e}"
+                )
+                gs.err_count += 1
+                gs.log.debug(
+                    "Here is the traceback.\n" + traceback.format_exc()
+                )
+            finally:
+                self.queue.task_done()
+
+    async def _download(self, room: MatrixRoom, event, filename: str):
+        mxc = event.url
+        # unique, as with --download-media-dedup the same media might be
+        # downloaded twice at the same time
+        part = f"{filename}.{uuid4().hex[:8]}.part"
+        encrypted = isinstance(event, RoomEncryptedMedia)
+        key = mxc  # key in the index of --download-media-dedup
+        if self.thumbnail:
+            key += f"#thumbnail={self.thumbnail}"
+        known = self.index and self._link_known(key, filename)
+        if known:
+            if self.report_known:
+                self._report(room, event, known, "already downloaded")
+            else:
+                gs.log.debug(f"Media {mxc} is already in {known}.")
+            return
+        stored = False
+        try:
+            resp, file_info, thumbnail = await self._fetch(event, part)
+            if resp is None:
+                return  # too big, see --download-media-max-size
+            if isinstance(resp, DownloadError):
+                gs.log.error(
+                    ("E106: " if encrypted else "E105: ")
+                    + f"download of URI '{mxc}' to local file "
+                    f"failed with response {privacy_filter(str(resp))}"
+                )
+                gs.err_count += 1
+                return
+            if file_info:
+                await decrypt_file(part, f"{part}.plain", file_info)
+                os.replace(f"{part}.plain", part)
+            info = event.source.get("content", {}).get("info")
+            size = info.get("size") if isinstance(info, dict) else None
+            if (
+                thumbnail is None
+                and isinstance(size, int)
+                and os.path.getsize(part) != size
+            ):
+                gs.log.error(
+                    "E265: "
+                    f"Download of URI '{mxc}' is incomplete or corrupt. "
+                    f"Expected {size} bytes, got {os.path.getsize(part)} "
+                    "bytes. The file was not stored."
+                )
+                gs.err_count += 1
+                return
+            if thumbnail is not None:
+                filename = self._thumbnail_filename(filename, thumbnail)
+            # Set atime and mtime of file to event timestamp
+            os.utime(part, ns=((event.server_timestamp * 1000000,) * 2))
+            if self.index:
+                self._store(event, key, part, filename, thumbnail)
+            else:
+                os.replace(part, filename)
+            stored = True
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+            if not stored and not self.index:
+                os.remove(filename)  # release the reserved name
+        gs.log.debug(f"Downloaded media {mxc} to {filename}.")
+        what = "downloaded" if thumbnail is None else "thumbnail downloaded"
+        if encrypted:
+            what += " and decrypted"
+        self._report(room, event, filename, what)
+
+    async def _fetch(self, event, part: str) -> tuple:
+        """Download the media of an event, or its thumbnail, into part.
+
+        With --download-media-thumbnail the thumbnail is fetched instead
+        of the full file if one exists: for plain media the thumbnail is
+        generated by the server, or else the thumbnail_url given by the
+        sender is used; for encrypted media the thumbnail_file given by the
+        sender is used. Otherwise the full file is fetched.
+
+        Returns a tuple: the response, the encryption info of the
+        downloaded file (None if not encrypted), and the MIME type of the
+        thumbnail ("" if unknown) or None if the full file was downloaded.
+        If the full file is larger than --download-media-max-size, nothing
+        is downloaded and the response is None.
+        """
+        content = event.source.get("content", {})
+        file_info = content.get("file")  # encrypted media only
+        mxc = event.url
+        thumbnail = None
+        if self.thumbnail:
+            info = content.get("info")
+            if not isinstance(info, dict):
+                info = {}
+            thumbnail_info = info.get("thumbnail_info")
+            if not isinstance(thumbnail_info, dict):
+                thumbnail_info = {}
+            if isinstance(event, RoomEncryptedMedia):
+                if isinstance(info.get("thumbnail_file"), dict):
+                    file_info = info["thumbnail_file"]
+                    mxc = file_info["url"]
+                    thumbnail = thumbnail_info.get("mimetype") or ""
+            else:
+                width, height = thumbnail_size(self.thumbnail)
+                try:
+                    # stream the thumbnail to disk
+                    resp = await fetch_mxc_range(
+                        self.client,
+                        mxc_thumbnail_path(self.client, mxc, width, height),
+                        part,
+                    )
+                    return resp, None, resp.content_type or ""
+                except (MatrixCommanderError, ClientError, TimeoutError) as e:
+                    gs.log.debug(
+                        f"No server thumbnail for {mxc}: "
+                        f"{privacy_filter(str(e))}"
+                    )
+                    if os.path.exists(part):
+                        os.remove(part)  # do not append to a partial one
+                if isinstance(info.get("thumbnail_url"), str):
+                    mxc = info["thumbnail_url"]
+                    thumbnail = thumbnail_info.get("mimetype") or ""
+            if thumbnail is None:
+                gs.log.debug(f"No thumbnail for {mxc}, getting full file.")
+                size = info.get("size")
+                if (
+                    gs.pa.download_media_max_size is not None
+                    and isinstance(size, int)
+                    and size > gs.pa.download_media_max_size
+                ):
+                    gs.log.debug(
+                        f"Not downloading media of {size} bytes: too big."
+                    )
+                    return None, None, None
+        try:
+            # stream the file to disk
+            resp = await fetch_mxc_range(
+                self.client, mxc_download_path(self.client, mxc), part
+            )
+        except (MatrixCommanderError, ClientError, TimeoutError) as e:
+            resp = DownloadError(str(e) or type(e).__name__)
+        if thumbnail == "" and not isinstance(resp, DownloadError):
+            thumbnail = resp.content_type or ""
+        return resp, file_info, thumbnail
+
+    def _thumbnail_filename(self, filename: str, mimetype: str) -> str:
+        """Get the file name for a thumbnail instead of the media file.
+
+        The extension is taken from the MIME type of the thumbnail. The
+        name reserved for the media file is given up for a new one.
+        """
+        newname = filename_for_mimetype(filename, mimetype)
+        if newname == filename or self.index:
+            return newname  # names of --download-media-dedup are unique
+        root, ext = os.path.splitext(newname)
+        while True:
+            newname = choose_available_filename(root + ext)
+            try:
+                open(newname, "x").close()  # reserve the name
+                break
+            except FileExistsError:
+                continue  # name was taken meanwhile, choose the next one
+        os.remove(filename)
+        return newname
+
+    def _link_known(self, mxc: str, filename: str) -> Optional[str]:
+        """Link filename to the stored content of mxc if already known.
+
+        Returns the name of the link, for thumbnails with the extension
+        of the thumbnail, or None if mxc is not known.
+        """
+        row = self.index.execute(
+            "SELECT sha256, mimetype FROM media WHERE mxc = ?", (mxc,)
+        ).fetchone()
+        if not row:
+            return None
+        obj = media_object_path(self.media_dir, row[0])
+        if not os.path.exists(obj):
+            return None  # store was cleaned up, download again
+        if self.thumbnail:
+            filename = filename_for_mimetype(filename, row[1])
+        if not os.path.lexists(filename):
+            link_media_object(obj, filename)
+        return filename
+
+    def _store(
+        self,
+        event,
+        key: str,
+        part: str,
+        filename: str,
+        thumbnail: Optional[str] = None,
+    ) -> None:
+        """Move a downloaded file into the content-addressed store."""
+        sha256 = hashlib.sha256()
+        with open(part, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        obj = media_object_path(self.media_dir, digest)
+        if os.path.exists(obj):
+            gs.log.debug(f"Media {event.url} is a duplicate of {obj}.")
+        else:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(part, obj)
+        if os.path.lexists(filename):
+            os.remove(filename)
+        link_media_object(obj, filename)
+        if thumbnail is None:
+            info = event.source.get("content", {}).get("info")
+            mimetype = info.get("mimetype") if isinstance(info, dict) else None
+        else:
+            mimetype = thumbnail or None
+        with self.index:
+            self.index.execute(
+                "INSERT OR REPLACE INTO media (mxc, sha256, size, mimetype, "
+                "filename, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    digest,
+                    os.path.getsize(obj),
+                    mimetype,
+                    filename,
+                    event.server_timestamp,
+                ),
+            )
+
+    def _report(self, room: MatrixRoom, event, filename: str, what: str):
+        """Print the output record of a completed download."""
+        mxc = event.url
+        encrypted = isinstance(event, RoomEncryptedMedia)
+        size = os.path.getsize(filename)
+        # output format controlled via --output flag
+        text = (
+            f"Media {what} for room {room.display_name} [{room.room_id}] | "
+            f"{event.event_id} | {mxc} | {size} bytes | {filename}"
+        )
+        json_max = {
+            "room_id": room.room_id,
+            "event_id": event.event_id,
+            "mxc": mxc,
+            "encrypted": encrypted,
+            "size": size,
+            "filename": filename,
+        }
+        json_ = json_max.copy()
+        json_spec = None
+        print_output(
+            gs.pa.output,
+            text=text,
+            json_=json_,
+            json_max=json_max,
+            json_spec=json_spec,
         )
-        response = await client.download(mxc=mxc, filename=filename)
-    gs.log.debug(f"download_mxc response is {response}.")
-    return response
+
+    async def close(self, drain: bool = True) -> None:
+        """Stop the workers.
+
+        With drain the queued downloads are finished first. Without,
+        e.g. after Control-C, the downloads in progress are cancelled,
+        which removes their .part files, and the names reserved for the
+        queued downloads are released. Calling close() again does nothing.
+        """
+        try:
+            if drain:
+                await self.queue.join()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.tasks = []
+            while not self.queue.empty():
+                _, _, filename = self.queue.get_nowait()
+                self.queue.task_done()
+                if not self.index and os.path.exists(filename):
+                    os.remove(filename)  # release the reserved name
+            if self.index:
+                self.index.close()
+                self.index = None
+
+
+def room_reference(room: MatrixRoom) -> dict:
+    """Return the compact stand-in for room in received messages.
+
+    See --full-room.
+    """
+    return {
+        "room_id": room.room_id,
+        "display_name": room.display_name,
+        "encrypted": room.encrypted,
+    }
+
+
+def room_fingerprint(room: MatrixRoom) -> tuple:
+    """Return what print_room() compares to notice a changed room.
+
+    The room is kept up to date by the sync, whether or not the state
+    events that changed it reach a callback.
+    """
+    return (
+        room.display_name,
+        room.topic,
+        len(room.users),
+        room.encrypted,
+    )
+
+
+def print_room(room: MatrixRoom) -> None:
+    """Print the full room before its first message and after changes.
+
+    Received messages only carry room_reference(room). So the full room
+    is printed as a record of its own: before the first message of the
+    room and again before the next message whenever the name, topic,
+    number of members or encryption of the room has changed since.
+    See --full-room.
+    """
+    if gs.pa.output not in (OUTPUT_JSON, OUTPUT_JSON_MAX):
+        return
+    fingerprint = room_fingerprint(room)
+    if gs.rooms_printed.get(room.room_id) == fingerprint:
+        return
+    gs.rooms_printed[room.room_id] = fingerprint
+    print_output(
+        gs.pa.output,
+        text=None,
+        json_={"room": room},
+        json_max={"room": room},
+    )
 
 
 class Callbacks(object):
@@ -756,6 +1961,9 @@ class Callbacks(object):
                 f"event: type: {type(event)}, event_id: {event.event_id}, "
                 f"event: {event}"
             )
+            if gs.pa.archive:
+                # archive all events, also the ones not printed
+                archive_event(self.client, room, event)
             if not gs.pa.listen_self:
                 if event.sender == self.client.user:
                     try:
@@ -777,75 +1985,28 @@ class Callbacks(object):
             # e.g. 2020-08-06 17:30:18
             gs.log.debug(f"event_datetime = {event_datetime}")
 
-            if isinstance(event, RoomMessageMedia):  # for all media events
-                mxc = event.url  # media mxc
-                url = await self.client.mxc_to_http(mxc)  # media url
-                gs.log.debug(f"HTTP URL of media is : {url}")
-                msg_url = " [" + url + "]"
-                if gs.pa.download_media != "":
-                    # download unencrypted/plain media file
-                    resp = await download_mxc(self.client, mxc)
-                    if isinstance(resp, DownloadError):
-                        gs.log.error(
-                            "E105: "
-                            f"download of URI '{mxc}' to local file "
-                            f"failed with response {privacy_filter(str(resp))}"
-                        )
-                        gs.err_count += 1
-                        msg_url += " [Download of media file failed]"
-                    else:
-                        media_data = resp.body
-                        filename = derive_media_filename_with_path(event)
-                        async with aiofiles.open(filename, "wb") as f:
-                            await f.write(media_data)
-                            # Set atime and mtime of file to event timestamp
-                            os.utime(
-                                filename,
-                                ns=((event.server_timestamp * 1000000,) * 2),
-                            )
-                        msg_url += f" [Downloaded media file to {filename}]"
-
-            if isinstance(event, RoomEncryptedMedia):  # for all e2e media
+            if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
+                # for all media events, plain and e2e
                 mxc = event.url  # media mxc
                 url = await self.client.mxc_to_http(mxc)  # media url
                 gs.log.debug(f"HTTP URL of media is : {url}")
                 msg_url = " [" + url + "]"
-                if gs.pa.download_media != "":
-                    # download encrypted media file
-                    resp = await download_mxc(self.client, mxc)
-                    if isinstance(resp, DownloadError):
-                        gs.log.error(
-                            "E106: "
-                            f"download of URI '{mxc}' to local file "
-                            f"failed with response {privacy_filter(str(resp))}"
-                        )
-                        gs.err_count += 1
-                        msg_url += " [Download of media file failed]"
-                    else:
-                        media_data = resp.body
-                        filename = derive_media_filename_with_path(event)
-                        async with aiofiles.open(filename, "wb") as f:
-                            await f.write(
-                                crypto.attachments.decrypt_attachment(
-                                    media_data,
-                                    event.source["content"]["file"]["key"][
-                                        "k"
-                                    ],
-                                    event.source["content"]["file"]["hashes"][
-                                        "sha256"
-                                    ],
-                                    event.source["content"]["file"]["iv"],
-                                )
-                            )
-                            # Set atime and mtime of file to event timestamp
-                            os.utime(
-                                filename,
-                                ns=((event.server_timestamp * 1000000,) * 2),
-                            )
+                if gs.pa.download_media != "" and media_download_wanted(
+                    room, event, bool(gs.pa.download_media_thumbnail)
+                ):
+                    # download (and decrypt) in the background, completion
+                    # is reported separately
+                    if not gs.media_downloader:
+                        gs.media_downloader = MediaDownloader(self.client)
+                    filename = await gs.media_downloader.submit(room, event)
+                    if gs.pa.download_media_thumbnail:
+                        # name is only known when the thumbnail arrived
                         msg_url += (
-                            " [Downloaded and decrypted media "
-                            f"file to {filename}]"
+                            " [Downloading thumbnail of media file to "
+                            f"{gs.pa.download_media}]"
                         )
+                    else:
+                        msg_url += f" [Downloading media file to {filename}]"
 
             if isinstance(event, RoomMessageAudio):
                 msg = "Received audio: " + event.body + msg_url
@@ -963,33 +2124,48 @@ class Callbacks(object):
                 f"{event_id_detail} | {fixed_msg}"
             )
             gs.log.debug(complete_msg)
-            # output format controlled via --output flag
-            text = complete_msg  # print the received message
-            json_ = {"source": event.source}
-            json_.update({"room": room})
-            json_.update({"room_display_name": room.display_name})
-            json_.update({"sender_nick": sender_nick})
-            json_.update({"event_datetime": event_datetime})
-            json_max = event.__dict__
-            json_max.update({"room": room})
-            json_max.update({"room_display_name": room.display_name})
-            json_max.update({"sender_nick": sender_nick})
-            json_max.update({"event_datetime": event_datetime})
-            json_spec = event.source
-            print_output(
-                gs.pa.output,
-                text=text,
-                json_=json_,
-                json_max=json_max,
-                json_spec=json_spec,
-            )
+            if gs.exporter:
+                # --export: write to file instead of printing
+                gs.exporter.write(
+                    room, room_nick, event, sender_nick, event_datetime, msg
+                )
+            else:
+                # output format controlled via --output flag
+                text = complete_msg  # print the received message
+                if gs.pa.full_room:
+                    room_ref = room
+                else:
+                    room_ref = room_reference(room)
+                    print_room(room)
+                json_ = {"source": event.source}
+                json_.update({"room": room_ref})
+                json_.update({"room_display_name": room.display_name})
+                json_.update({"sender_nick": sender_nick})
+                json_.update({"event_datetime": event_datetime})
+                json_max = event.__dict__
+                json_max.update({"room": room_ref})
+                json_max.update({"room_display_name": room.display_name})
+                json_max.update({"sender_nick": sender_nick})
+                json_max.update({"event_datetime": event_datetime})
+                json_spec = event.source
+                print_output(
+                    gs.pa.output,
+                    text=text,
+                    json_=json_,
+                    json_max=json_max,
+                    json_spec=json_spec,
+                )
 
             if gs.pa.os_notify:
-                avatar_url = await get_avatar_url(self.client, event.sender)
+                if not gs.avatar_cache:
+                    gs.avatar_cache = AvatarCache(
+                        self.client,
+                        os.path.join(self.client.store_path, AVATAR_CACHE_DIR),
+                    )
                 notify(
                     f"From {room.user_name(event.sender)}",
                     msg[:160],
-                    avatar_url,
+                    gs.avatar_cache.get(event.sender),
                 )
 
         except BaseException:
@@ -1138,6 +2314,7 @@ class Callbacks(object):
 
                 # sas = client.key_verifications[event.transaction_id]
 
+                flush_output()
                 print(
                     f"{sas.get_emoji()}",
                     file=sys.stdout,
@@ -1271,6 +2448,7 @@ class Callbacks(object):
                     f"code {event.code} and "
                     f"reason {event.reason}."
                 )
+                flush_output()
                 print(
                     "To give up hit Control-C.",
                     file=sys.stdout,
@@ -1375,6 +2553,7 @@ class Callbacks(object):
                 """
                 sas = client.key_verifications[event.transaction_id]
 
+                flush_output()
                 print(
                     f"{sas.get_emoji()}",
                     file=sys.stdout,
@@ -1483,6 +2662,7 @@ class Callbacks(object):
                     f"sas.verified = {sas.verified}\n"
                     f"sas.verified_devices = {sas.verified_devices}\n"
                 )
+                flush_output()
                 print(
                     "Emoji verification was successful!\n"
                     "Verify with other devices or hit Control-C to "
@@ -1501,7 +2681,7 @@ class Callbacks(object):
             gs.log.debug("Here is the traceback.\n" + traceback.format_exc())
 
 
-def notify(title: str, content: str, image_url: str):
+def notify(title: str, content: str, image_file: Optional[str]):
     """Notify OS of message receipt.
 
     If the system is running headless or any problem happens with
@@ -1518,10 +2698,8 @@ def notify(title: str, content: str, image_url: str):
         gs.warn_count += 1
         return
     try:
-        if image_url:
-            notused, avatar_file = tempfile.mkstemp()
-            urllib.request.urlretrieve(image_url, avatar_file)
-            # TODO: cleanup temp files? in cleanup()?
+        if image_file:
+            avatar_file = os.path.abspath(image_file)
         else:
             # Icon name "notification-message-IM" will work on Ubuntu
             # but not all platforms
@@ -1537,28 +2715,120 @@ def notify(title: str, content: str, image_url: str):
         pass
 
 
-async def get_avatar_url(client: AsyncClient, user_id: str) -> str:
-    """Get https avatar URL for user user_id.
+class AvatarCache:
+    """Keep avatars of senders as local files, see --os-notify.
 
-    Returns URL or None if user has no avatar
+    Avatar files are stored in a directory of the store, named after the
+    SHA-256 hash of their mxc URI. Which avatar a user has is remembered
+    in an index file for AVATAR_CACHE_TTL seconds. A lookup never waits
+    for the network: an unknown or outdated user is looked up in the
+    background, and the avatar is shown from the next notification on.
+    When the directory grows beyond AVATAR_CACHE_MAX_SIZE bytes, the
+    least recently used avatars are deleted.
     """
-    avatar_url = None  # default
-    resp = await client.get_avatar(user_id)
-    if isinstance(resp, ProfileGetAvatarResponse):
-        gs.log.debug(
-            "ProfileGetAvatarResponse. Response is: "
-            f"{privacy_filter(str(resp))}"
+
+    def __init__(self, client: AsyncClient, directory: str):
+        """Read the index of the cache in directory."""
+        self.client = client
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_file = os.path.join(directory, AVATAR_INDEX_FILE)
+        # user_id --> [mxc or None, time of lookup]
+        self.index = {}
+        try:
+            with open(self.index_file, "r") as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            gs.log.debug(f"Avatar index {self.index_file} not read: {e}")
+        self.tasks = {}  # user_id --> running lookup
+
+    def get(self, user_id: str) -> Optional[str]:
+        """Get the avatar file of user_id, None if not (yet) known."""
+        entry = self.index.get(user_id)
+        path = self._path(entry[0]) if entry and entry[0] else None
+        if path and not os.path.exists(path):
+            path = None  # deleted to make room, get it again
+            entry = None
+        if (
+            not entry or time.time() - entry[1] > AVATAR_CACHE_TTL
+        ) and user_id not in self.tasks:
+            self.tasks[user_id] = asyncio.create_task(self._lookup(user_id))
+        if path:
+            os.utime(path)  # recently used
+        return path
+
+    def _path(self, mxc: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(mxc.encode()).hexdigest()
         )
-        avatar_mxc = resp.avatar_url
-        gs.log.debug(f"avatar_mxc is {avatar_mxc}")
-        if avatar_mxc:  # could be None if no avatar
-            avatar_url = await client.mxc_to_http(avatar_mxc)
-    else:
-        gs.log.info(
-            f"Failed getting avatar from server. {privacy_filter(str(resp))}"
+
+    async def _lookup(self, user_id: str) -> None:
+        try:
+            resp = await self.client.get_avatar(user_id)
+            if not isinstance(resp, ProfileGetAvatarResponse):
+                gs.log.info(
+                    "Failed getting avatar from server. "
+                    f"{privacy_filter(str(resp))}"
+                )
+                return
+            mxc = resp.avatar_url  # None if user has no avatar
+            gs.log.debug(f"Avatar of {user_id} is {mxc}.")
+            if mxc and not os.path.exists(self._path(mxc)):
+                await self._download(mxc)
+            self.index[user_id] = [mxc, time.time()]
+            tmp = f"{self.index_file}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.index_file)
+        except Exception as e:
+            gs.log.debug(
+                f"Getting avatar of {user_id} failed. Exception: {e}"
+                f"\nHere is the traceback:\n{traceback.format_exc()}"
+            )
+        finally:
+            del self.tasks[user_id]
+
+    async def _download(self, mxc: str) -> None:
+        path = self._path(mxc)
+        part = f"{path}.{uuid4().hex[:8]}.part"
+        url = urlparse(mxc)
+        resp = await self.client.thumbnail(
+            url.netloc, url.path.strip("/"), AVATAR_SIZE, AVATAR_SIZE
         )
-    gs.log.debug(f"avatar_url is {avatar_url}")
-    return avatar_url
+        try:
+            if isinstance(resp, ThumbnailResponse):
+                async with aiofiles.open(part, "wb") as f:
+                    await f.write(resp.body)
+            else:  # no thumbnail, e.g. SVG, take the original
+                await fetch_mxc_range(
+                    self.client, mxc_download_path(self.client, mxc), part
+                )
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+        self._trim()
+
+    def _trim(self) -> None:
+        """Delete least recently used avatars beyond the size limit."""
+        files = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and len(entry.name) == 64  # SHA-256 hex
+        ]
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= AVATAR_CACHE_MAX_SIZE:
+                break
+            os.remove(path)
+            total -= size
+
+    def close(self) -> None:
+        """Abandon lookups still running."""
+        for task in self.tasks.values():
+            task.cancel()
 
 
 def create_pid_file() -> None:
@@ -1608,6 +2878,10 @@ def delete_pid_file() -> None:
 def cleanup() -> None:
     """Cleanup before quitting program."""
     gs.log.debug("Cleanup: cleaning up.")
+    flush_output()
+    if gs.archive:
+        gs.archive.close()
+        gs.archive = None
     delete_pid_file()
 
 
@@ -3132,7 +4406,7 @@ async def send_file(client, rooms, file):  # noqa: C901
     file_stat = await aiofiles.os.stat(file)
     async with aiofiles.open(file, "r+b") as f:
         resp, decryption_keys = await client.upload(
-            f,
+            rate_limited_upload(f),
             content_type=mime_type,  # application/pdf
             filename=os.path.basename(file),
             filesize=file_stat.st_size,
@@ -3382,7 +4656,7 @@ async def send_image(client, rooms, image):  # noqa: C901
     file_stat = await aiofiles.os.stat(image)
     async with aiofiles.open(image, "r+b") as f:
         resp, decryption_keys = await client.upload(
-            f,
+            rate_limited_upload(f),
             content_type=mime_type,  # image/jpeg
             filename=os.path.basename(image),
             filesize=file_stat.st_size,
@@ -3487,7 +4761,9 @@ async def send_image(client, rooms, image):  # noqa: C901
 
 
 # according to linter: function is too complex, C901
-async def send_message(client, rooms, message):  # noqa: C901
+async def send_message(  # noqa: C901
+    client, rooms, message, replaces: Optional[dict] = None
+) -> dict:
     """Process message.
 
     Format message according to instructions from command line arguments.
@@ -3501,15 +4777,22 @@ async def send_message(client, rooms, message):  # noqa: C901
     message : str
         message to send as read from -m, pipe or keyboard
         message is without mime formatting
+    replaces : dict
+        optional dictionary mapping room_id to event_id. If a room_id
+        is found in it, the message is sent as an edit (m.replace)
+        of that event instead of as a new event.
+
+    Returns dictionary mapping room_id to event_id of the sent events.
 
     """
+    sent = {}
     if not rooms:
         gs.log.info(
             "No rooms are given. This should not happen. "
             "Maybe your DM rooms specified via --user were not found. "
             "This text message is being dropped and NOT sent."
         )
-        return
+        return sent
     # remove leading AND trailing newlines to beautify
     message = message.strip("\n")
 
@@ -3518,7 +4801,7 @@ async def send_message(client, rooms, message):  # noqa: C901
             "The message is empty. "
             "This message is being dropped and NOT sent."
         )
-        return
+        return sent
 
     if gs.pa.notice:
         content = {"msgtype": "m.notice"}
@@ -3560,10 +4843,14 @@ async def send_message(client, rooms, message):  # noqa: C901
     try:
         for room_id in rooms:
             room_id = await map_roominfo_to_roomid(client, room_id)
+            if replaces and replaces.get(room_id):
+                room_content = replace_content(content, replaces[room_id])
+            else:
+                room_content = content
             resp = await client.room_send(
                 room_id,
                 message_type="m.room.message",
-                content=content,
+                content=room_content,
                 ignore_unverified_devices=True,
             )
             if isinstance(resp, RoomSendError):
@@ -3578,6 +4865,7 @@ async def send_message(client, rooms, message):  # noqa: C901
                 f'This message was sent: "{message}" to room "{resp.room_id}" '
                 f'as event "{resp.event_id}".'
             )
+            sent[room_id] = resp.event_id
             if gs.pa.print_event_id:
                 # output format controlled via --output flag
                 text = f"{resp.event_id}{SEP}{resp.room_id}{SEP}{message}"
@@ -3604,6 +4892,23 @@ async def send_message(client, rooms, message):  # noqa: C901
         gs.log.error("E151: " "Message send failed. Sorry.")
         gs.err_count += 1
         gs.log.debug("Here is the traceback.\n" + traceback.format_exc())
+    return sent
+
+
+def replace_content(content: dict, event_id: str) -> dict:
+    """Turn message content into an edit (m.replace) of event_id.
+
+    Clients that understand edits display the "m.new_content",
+    older clients fall back to the "body" prefixed with "* ".
+    """
+    new_content = content.copy()
+    edit = content.copy()
+    edit["body"] = "* " + content["body"]
+    if "formatted_body" in content:
+        edit["formatted_body"] = "* " + content["formatted_body"]
+    edit["m.new_content"] = new_content
+    edit["m.relates_to"] = {"rel_type": "m.replace", "event_id": event_id}
+    return edit
 
 
 async def stream_messages_from_pipe(client, rooms):
@@ -3647,6 +4952,9 @@ async def stream_messages_from_pipe(client, rooms):
                 "Trying to read from pipe in any case."
             )
         try:
+            if gs.pa.stream_edit is not None:
+                await stream_edits_from_pipe(client, rooms)
+                return
             for line in sys.stdin:
                 await send_message(client, rooms, line)
                 gs.log.debug("Using data from stdin pipe stream as message.")
@@ -3665,6 +4973,55 @@ async def stream_messages_from_pipe(client, rooms):
             )
 
 
+async def stream_edits_from_pipe(client, rooms):
+    """Read pipe line by line and send lines as edits of one message.
+
+    The first line is sent as a normal message. Every later line
+    replaces (m.replace) that first message. Edits are throttled to at
+    most one per --stream-edit interval; lines arriving faster are
+    coalesced and only the latest one is sent. The last line read
+    before the pipe is closed is always sent.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list of room_ids
+
+    """
+    loop = asyncio.get_running_loop()
+    interval = gs.pa.stream_edit
+    originals = {}  # room_id --> event_id of first message
+    pending = None  # latest line not yet sent
+    last_sent = 0.0
+    reader = None
+    while True:
+        if reader is None:
+            # blocking readline() must not block the event loop
+            reader = loop.run_in_executor(None, sys.stdin.readline)
+        timeout = None
+        if pending is not None:
+            timeout = max(0.0, last_sent + interval - time.monotonic())
+        done, _ = await asyncio.wait({reader}, timeout=timeout)
+        if done:
+            line = reader.result()
+            reader = None
+            if line == "":  # EOF, pipe was closed
+                break
+            if line.strip() == "":
+                continue
+            pending = line
+            if time.monotonic() - last_sent < interval:
+                continue
+        sent = await send_message(client, rooms, pending, originals)
+        for room_id, event_id in sent.items():
+            originals.setdefault(room_id, event_id)
+        gs.log.debug("Using data from stdin pipe stream as message edit.")
+        pending = None
+        last_sent = time.monotonic()
+    if pending is not None:  # flush final state
+        await send_message(client, rooms, pending, originals)
+
+
 def get_messages_from_pipe() -> list:
     """Read input from pipe if available.
 
@@ -4227,6 +5584,165 @@ async def listen_once_alternative(client: AsyncClient) -> None:
                 )
 
 
+async def matrix_api_call(
+    client: AsyncClient,
+    method: str,
+    path: list,
+    query_parameters: Optional[dict] = None,
+    content: Optional[dict] = None,
+    api_version: str = "v3",
+) -> Tuple[int, dict]:
+    """Call a Matrix client-server API endpoint not wrapped by matrix-nio.
+
+    Arguments:
+    ---------
+        client: AsyncClient : the logged in NIO client
+        method: str : "GET", "POST", etc.
+        path: list : path elements below /_matrix/client/v3,
+            e.g. ["rooms", room_id, "timestamp_to_event"]
+        query_parameters: dict : optional query parameters
+        content: dict : optional JSON body
+        api_version: str : "v3" by default, some endpoints are "v1"
+
+    Returns the HTTP status and the JSON response as dict.
+
+    """
+    url = Api._build_path(
+        path, query_parameters, f"/_matrix/client/{api_version}"
+    )
+    headers = {"Authorization": f"Bearer {client.access_token}"}
+    data = None
+    if content is not None:
+        data = json.dumps(content)
+        headers["Content-Type"] = "application/json"
+    resp = await client.send(
+        method, url, data, headers, timeout=idle_timeout(client)
+    )
+    try:
+        result = await resp.json(content_type=None)
+    except ValueError:
+        result = {}
+    finally:
+        resp.release()
+    return resp.status, result
+
+
+async def gather_with_concurrency(
+    aws: list, limit: Optional[int] = None
+) -> list:
+    """Run awaitables like asyncio.gather(), but only a few at a time.
+
+    At most limit awaitables run at the same time. The limit
+    defaults to --concurrency. Results are returned in input order.
+    """
+    semaphore = asyncio.Semaphore(limit or gs.pa.concurrency)
+
+    async def limited(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(limited(aw) for aw in aws))
+
+
+async def as_completed_with_concurrency(
+    aws: list, limit: Optional[int] = None
+) -> AsyncIterator:
+    """Like gather_with_concurrency(), but yield results as they arrive."""
+    semaphore = asyncio.Semaphore(limit or gs.pa.concurrency)
+
+    async def limited(aw):
+        async with semaphore:
+            return await aw
+
+    for next_done in asyncio.as_completed([limited(aw) for aw in aws]):
+        yield await next_done
+
+
+async def room_from_state(
+    client: AsyncClient,
+    room_id: str,
+    event_types: tuple = ROOM_NAME_STATE_EVENTS,
+) -> MatrixRoom:
+    """Build a room object from a few state events, without a sync().
+
+    Only the given state event types are fetched, in parallel.
+    Missing state events (e.g. a room without a name) are skipped.
+    """
+    room = MatrixRoom(room_id, client.user_id)
+    resps = await asyncio.gather(
+        *(client.room_get_state_event(room_id, et) for et in event_types)
+    )
+    for event_type, resp in zip(event_types, resps):
+        if isinstance(resp, RoomGetStateEventError):
+            gs.log.debug(
+                f"No state event {event_type} for room {room_id}. "
+                f"{privacy_filter(str(resp))}"
+            )
+            continue
+        content = resp.content
+        if event_type == "m.room.name":
+            room.name = content.get("name")
+        elif event_type == "m.room.canonical_alias":
+            room.canonical_alias = content.get("alias")
+        elif event_type == "m.room.topic":
+            room.topic = content.get("topic")
+        elif event_type == "m.room.encryption":
+            room.encrypted = True
+    return room
+
+
+async def add_joined_members(
+    client: AsyncClient, room: MatrixRoom
+) -> Optional[JoinedMembersError]:
+    """Add the joined members of room to it, without a sync().
+
+    Returns the error response if the members could not be fetched,
+    e.g. because we are not a member of the room, else None.
+    """
+    resp = await client.joined_members(room.room_id)
+    if isinstance(resp, JoinedMembersError):
+        return resp
+    for member in resp.members:
+        room.add_member(member.user_id, member.display_name, member.avatar_url)
+    return None
+
+
+async def load_rooms(
+    client: AsyncClient, rooms: list, to_device: bool = True
+) -> list:
+    """Resolve rooms to room ids and make sure client knows the rooms.
+
+    Room aliases are mapped to room ids. Rooms not yet known in
+    client.rooms (e.g. because no sync() was done) are built from
+    their state events, see room_from_state(), and their joined
+    members, and added to client.rooms. If any of the rooms is
+    encrypted and to_device is set, new room keys are fetched, see
+    sync_to_device(). Returns the list of room ids.
+    """
+
+    async def load_room(room_id: str) -> MatrixRoom:
+        room = await room_from_state(client, room_id, ROOM_INFO_STATE_EVENTS)
+        resp = await add_joined_members(client, room)
+        if resp:
+            gs.log.debug(
+                f"Members of room {room_id} are not known, senders are "
+                f"printed without nick names. {privacy_filter(str(resp))}"
+            )
+        return room
+
+    room_ids = [await map_roominfo_to_roomid(client, r) for r in rooms]
+    unknown = [r for r in dict.fromkeys(room_ids) if r not in client.rooms]
+    for room in await gather_with_concurrency(
+        [load_room(room_id) for room_id in unknown]
+    ):
+        client.rooms[room.room_id] = room
+    if to_device and any(
+        client.rooms[room_id].encrypted for room_id in room_ids
+    ):
+        await sync_to_device(client)
+    return room_ids
+
+
 # according to pylama: function too complex: C901 # noqa: C901
 async def listen_tail(  # noqa: C901
     client: AsyncClient, credentials: dict
@@ -4248,125 +5764,69 @@ async def listen_tail(  # noqa: C901
     the last N messages.
 
     """
-    # we call sync() to get the next_batch marker
-    # we set full_state=True to get all room_ids
-    resp_s = await synchronize(client)  # sync() to get rooms
-    # this prints a summary of all new messages currently waiting in the queue
-    gs.log.debug(f"sync response = {type(resp_s)} :: {resp_s}")
-    gs.log.debug(f"client.next_batch after = (str) {client.next_batch}")
-    gs.log.debug(f"sync next_batch = (str) {resp_s.next_batch}")
-    gs.log.debug(f"sync rooms = (nio.responses.Rooms) {resp_s.rooms}")
-    gs.log.debug(f"client.rooms = {client.rooms}")
-    if not resp_s.rooms.join:  # no Rooms!
-        gs.log.debug(f"sync returned no rooms = {resp_s.rooms.join}")
-        return
+    # No full sync() is done. A full_state sync would only give us a
+    # starting token, the rooms and the room keys, but it is slow on big
+    # accounts. Instead the messages are read from the end of the room
+    # without a token, the rooms are loaded from their state events and
+    # members, and room keys come with a minimal sync, see load_rooms().
 
     # Set up event callbacks
     callbacks = Callbacks(client)
     # Note: we are NOT registering a callback function!
 
-    # room_id = list(resp_s.rooms.join.keys())[0]  # first room_id from dict
-    # alternative way of getting room_id, client.rooms is also a dict
-    # room_id = list(client.rooms.keys())[0]  # first room_id from dict
-
     # get rooms as specified by the user thru args or credential file
     rooms = await determine_rooms(credentials["room_id"], client, credentials)
+    rooms = await load_rooms(client, rooms)
     limit = gs.pa.tail
     gs.log.debug(f"Rooms are: {rooms}, limit is {limit}")
-    # To loop over all rooms, one can loop through the join dictionary. i.e.
-    # for room_id, room_info in resp_s.rooms.join.items():  # loop all rooms
-    for room_id in rooms:  # loop only over user specified rooms
-        start_token = resp_s.next_batch
-        messages_received = 0
-        newest_event = None
-        
-        while messages_received < limit:
-            remaining_limit = limit - messages_received
-            gs.log.debug("listen_tail: === looping over chunks ===")
-            gs.log.debug(f"listen_tail: room_id = {room_id}")
-            gs.log.debug(f"listen_tail: remaining_limit = {remaining_limit}, limit = {limit}")
-            gs.log.debug(f"listen_tail: start = (str) {start_token}")
-            resp = await client.room_messages(
-                room_id, start=start_token, limit=remaining_limit
+
+    since = time_arg_to_ms(gs.pa.since) if gs.pa.since else None
+    until = time_arg_to_ms(gs.pa.until) if gs.pa.until else None
+
+    def pages_of_room(room_id):
+        if since is not None or until is not None:
+            return read_events_in_window(
+                client, room_id, MessageDirection.back, since, until, limit
             )
-            if isinstance(resp, RoomMessagesError):
-                gs.log.warning(
-                    "W106: "
-                    f"room_messages failed with response "
-                    f"{privacy_filter(str(resp))}. "
-                    "Processing continues."
-                )
-                gs.warn_count += 1
-                break  # skip to next room
-                
+        return read_all_events_in_direction(
+            client, room_id, None, MessageDirection.back, limit, warn=True
+        )
+
+    # loop only over user specified rooms
+    newest_events = {}  # room_id --> newest event fetched
+    async for room_id, event, _ in events_of_rooms(
+        rooms, pages_of_room, newest_first=True
+    ):
+        # Capture the newest event, i.e. the very first one fetched
+        newest_events.setdefault(room_id, event)
+        if gs.stats:
+            gs.stats.add(room_id, event)
+            continue
+        gs.log.debug(f"sending event to callback = {event}.")
+        await callbacks.message_callback(room_or_dummy(client, room_id), event)
+
+    # Update read markers once per room, using the newest event fetched
+    for room_id, newest_event in newest_events.items():
+        resp_markers = await client.room_read_markers(
+            room_id=room_id,
+            fully_read_event=newest_event.event_id,
+            read_event=newest_event.event_id,
+        )
+        if isinstance(resp_markers, RoomReadMarkersError):
             gs.log.debug(
-                f"room_messages response = {type(resp)} :: "
-                f"{privacy_filter(str(resp))}."
-            )
-            gs.log.debug(f"room_messages room_id = {resp.room_id}.")
-            gs.log.debug(f"room_messages start = (str) {resp.start}.")
-            gs.log.debug(f"room_messages end = (str) :: {resp.end}.")
-            gs.log.debug(f"room_messages chunk = (list) :: {resp.chunk}.")
-            # chunk is just a list of RoomMessage events like this example:
-            # chunk=[RoomMessageText(...)]
-           
-            if not resp.chunk:
-                gs.log.debug(
-                    "listen_tail: chunk is empty. No more messages returned. Total "
-                    "number of requested messages are not available, all available messages "
-                    f"obtained. {limit-remaining_limit} chunk objects retrieved.")
-                break  # no more messages returned
-                
-            # Capture the newest event from the very first chunk fetched
-            if newest_event is None:
-                newest_event = resp.chunk[0]
-                
-            for event in resp.chunk:
-                gs.log.debug(f"sending event to callback = {event}.")
-                if client.rooms and room_id in client.rooms:
-                    room = client.rooms[room_id]
-                else:
-                    room = MatrixRoom(room_id, None, True)  # dummy_room
-                await callbacks.message_callback(room, event)
-                
-            messages_received += len(resp.chunk)
-            
-            if messages_received >= limit:
-                gs.log.debug(
-                    "listen_tail: limit has been reached, "
-                    "number of requested messages has been returned."
-                )
-                break  # limit has been reached
-              
-            # Set the next start token to resp.end to get the next chunk
-            start_token = resp.end
-            if not start_token:
-                gs.log.debug(
-                    "listen_tail: no more chunks available, stopping, number of "
-                    "requested messages are not available, we got all available messages."
-                )
-                break  # no more pages available
-                
-        # Update read markers once per room, using the newest event fetched
-        if newest_event:
-            resp_markers = await client.room_read_markers(
-                room_id=room_id,
-                fully_read_event=newest_event.event_id,
-                read_event=newest_event.event_id,
+                "room_read_markers failed with response "
+                f"{privacy_filter(str(resp_markers))}."
             )
-            if isinstance(resp_markers, RoomReadMarkersError):
-                gs.log.debug(
-                    "room_read_markers failed with response "
-                    f"{privacy_filter(str(resp_markers))}."
-                )
 
 
 async def read_all_events_in_direction(
     client: AsyncClient,
     room_id: str,
-    start_token: str,
+    start_token: Optional[str],
     direction: MessageDirection = MessageDirection.back,
-) -> list:
+    limit: Optional[int] = None,
+    warn: bool = False,
+) -> AsyncIterator[RoomMessagesResponse]:
     """Read all events from a given room in certain direction.
 
     Arguments:
@@ -4378,30 +5838,47 @@ async def read_all_events_in_direction(
             This token can be obtained from a prev_batch token returned for
             each room by the sync() API, or from a start or end token returned
             by a previous request to room_messages().
+            If None, start at the beginning of the room (direction front)
+            or at the end of the room (direction back).
         direction: MessageDirection (optional): The direction to return
             events from. Defaults to MessageDirection.back.
-
-    Returns
-    -------
-        list: list of RoomMessage events, could be empty
-
-    Read all messages of a room beginning from the past_token
+        limit: int (optional): Stop after this many events. Defaults to
+            None, i.e. read until there are no more events.
+        warn: bool (optional): Report a failed request as warning W106
+            instead of error E162, as --tail always did. Either way
+            reading the room stops there. Defaults to False.
+
+    Yields
+    ------
+        RoomMessagesResponse: one page at a time. Its chunk is a list
+            of RoomMessage events in the order returned by the server,
+            i.e. newest first for direction back and oldest first for
+            direction front. Its start and end are the pagination tokens
+            before and after the chunk.
+
+    Read all messages of a room beginning from the start_token
     to oldest or newest message (depending on the direction).
+    This is an async generator: only one page is kept in memory, so
+    memory use does not grow with the size of the room.
 
     """
-    all_events = []
+    count = 0
     current_start_token = start_token
     # is capped at 1000 at server side
     # 10 seems too small, i.e. too slow
     # 100 to 500 seem good values, depends on network speed, server load, ...
     # example run: 250-->7min30s, 500-->4min30s
     max_msg_per_pull = 500
-    while True:
+    while limit is None or count < limit:
+        if limit is None:
+            pull = max_msg_per_pull
+        else:
+            pull = min(max_msg_per_pull, limit - count)
         try:
             resp = await client.room_messages(
                 room_id,
                 current_start_token,
-                limit=max_msg_per_pull,
+                limit=pull,
                 direction=direction,
             )
         except Exception as e:
@@ -4412,40 +5889,711 @@ async def read_all_events_in_direction(
                 "Error during getting messages. "
                 "But program will continue anyway, despite the error. "
                 "Not all messages might have been retrieved from server. "
-                f"Be warned! Got {len(all_events)} messages so far."
+                f"Be warned! Got {count} messages so far."
                 f"Exception: {type(e)} {e}"
             )
             gs.err_count += 1
             gs.log.debug("Here is the traceback.\n" + traceback.format_exc())
-            break
+            return
         if isinstance(resp, RoomMessagesError):
+            if warn:
+                gs.log.warning(
+                    "W106: "
+                    f"room_messages failed with response "
+                    f"{privacy_filter(str(resp))}. "
+                    "Processing continues."
+                )
+                gs.warn_count += 1
+                return  # skip to next room
             gs.err_count += 1
             gs.log.error(
                 "E162: "
                 f"room_messages failed with resp = {privacy_filter(str(resp))}"
             )
-            break  # skip to end of function
-        gs.log.debug(f"Got {len(all_events)+len(resp.chunk)} messages so far.")
+            return  # skip to end of function
+        count += len(resp.chunk)
+        gs.log.debug(f"Got {count} messages so far.")
         gs.log.debug(f"Received {len(resp.chunk)} events.")
         gs.log.debug(
             f"room_messages response = {type(resp)} :: "
             f"{privacy_filter(str(resp))}."
         )
-        gs.log.debug(f"room_messages room_id = {resp.room_id}.")
-        gs.log.debug(f"room_messages start = (str) {resp.start}.")
-        gs.log.debug(f"room_messages end = (str) :: {resp.end}.")
-        gs.log.debug(f"room_messages chunk = (list) :: {resp.chunk}.")
-        # resp.chunk is just a list of RoomMessage events like this example:
-        # chunk=[RoomMessageText(...)]
-        current_start_token = resp.end
-        if len(resp.chunk) == 0:
-            gs.log.debug(
-                "All messages have been retrieved from server successfully. "
-                f"{len(all_events)} messages were pulled from server."
-            )
-            break
-        all_events = all_events + resp.chunk
-    return all_events
+        gs.log.debug(f"room_messages room_id = {resp.room_id}.")
+        gs.log.debug(f"room_messages start = (str) {resp.start}.")
+        gs.log.debug(f"room_messages end = (str) :: {resp.end}.")
+        gs.log.debug(f"room_messages chunk = (list) :: {resp.chunk}.")
+        # resp.chunk is just a list of RoomMessage events like this example:
+        # chunk=[RoomMessageText(...)]
+        if len(resp.chunk) == 0:
+            gs.log.debug(
+                "All messages have been retrieved from server successfully. "
+                f"{count} messages were pulled from server."
+            )
+            return
+        yield resp
+        current_start_token = resp.end
+        if not current_start_token:
+            # no end token means there are no more events in this direction
+            gs.log.debug(
+                "All messages have been retrieved from server successfully. "
+                f"{count} messages were pulled from server."
+            )
+            return
+    gs.log.debug(f"Limit has been reached. {count} messages were pulled.")
+
+
+async def token_at_timestamp(
+    client: AsyncClient,
+    room_id: str,
+    timestamp: int,
+    direction: MessageDirection,
+) -> Tuple[bool, Optional[str]]:
+    """Get a pagination token at a point in time of a room.
+
+    Uses /timestamp_to_event to find the event closest to the timestamp,
+    then /context of that event to get a token next to it.
+
+    Arguments:
+    ---------
+        client: AsyncClient : the NIO client
+        room_id: str : the room
+        timestamp: int : milliseconds since 1970
+        direction: MessageDirection : front to get a token for reading
+            forward from the first event at or after timestamp, back to get
+            a token for reading backward from the last event at or before
+            timestamp.
+
+    Returns a tuple: (found, token). found is False if the room has no
+    event in that direction. token is None if no token could be
+    determined, then reading must start at the beginning (front) or end
+    (back) of the room.
+
+    """
+    api_dir = "f" if direction == MessageDirection.front else "b"
+    status, resp = await matrix_api_call(
+        client,
+        "GET",
+        ["rooms", room_id, "timestamp_to_event"],
+        {"ts": timestamp, "dir": api_dir},
+        api_version="v1",
+    )
+    if status == 404 and resp.get("errcode") == "M_NOT_FOUND":
+        gs.log.debug(f"No event in room {room_id} from {timestamp} {api_dir}.")
+        return False, None
+    if status != 200:
+        gs.log.warning(
+            "W116: "
+            f"timestamp_to_event failed for room {room_id} with status "
+            f"{status} and response {resp}. Messages will be read from the "
+            f"{'beginning' if api_dir == 'f' else 'end'} of the room instead. "
+            "This is slower but gives the same result."
+        )
+        gs.warn_count += 1
+        return True, None
+    resp_context = await client.room_context(room_id, resp["event_id"], 0)
+    if isinstance(resp_context, RoomContextError):
+        gs.log.warning(
+            "W116: "
+            f"room_context failed for room {room_id} with response "
+            f"{privacy_filter(str(resp_context))}. Messages will be read "
+            f"from the {'beginning' if api_dir == 'f' else 'end'} of the room "
+            "instead. This is slower but gives the same result."
+        )
+        gs.warn_count += 1
+        return True, None
+    # start is the position just before the event, end just after it,
+    # so reading in the given direction includes the event itself
+    token = resp_context.start if api_dir == "f" else resp_context.end
+    gs.log.debug(f"Token at {timestamp} {api_dir} in {room_id} is {token}.")
+    return True, token
+
+
+async def read_events_in_window(
+    client: AsyncClient,
+    room_id: str,
+    direction: MessageDirection,
+    since: Optional[int],
+    until: Optional[int],
+    limit: Optional[int] = None,
+) -> AsyncIterator[RoomMessagesResponse]:
+    """Read the events of a room within a time window, see --since, --until.
+
+    Arguments:
+    ---------
+        client: AsyncClient : the NIO client
+        room_id: str : the room
+        direction: MessageDirection : front for oldest first,
+            back for newest first
+        since: int : start of window in milliseconds since 1970, or None
+        until: int : end of window (exclusive), or None
+        limit: int : stop after this many events in the window, or None
+
+    Yields pages like read_all_events_in_direction(), with the chunks
+    reduced to the events inside the window. Reading jumps straight to
+    the start of the window (since for front, until for back), see
+    token_at_timestamp(), and stops at its end, so the data transferred
+    is proportional to the window, not to its distance from now.
+
+    """
+    jump_to = since if direction == MessageDirection.front else until
+    start_token = None
+    if jump_to is not None:
+        found, start_token = await token_at_timestamp(
+            client, room_id, jump_to, direction
+        )
+        if not found:
+            return
+    count = 0
+    async for page in read_all_events_in_direction(
+        client, room_id, start_token, direction
+    ):
+        chunk = []
+        done = False
+        for event in page.chunk:
+            ts = event.server_timestamp
+            if direction == MessageDirection.front:
+                done = until is not None and ts >= until
+                outside = since is not None and ts < since
+            else:
+                done = since is not None and ts < since
+                outside = until is not None and ts >= until
+            if done:
+                break
+            if outside:
+                continue
+            chunk.append(event)
+            if limit is not None and len(chunk) + count >= limit:
+                done = True
+                break
+        count += len(chunk)
+        if chunk:
+            yield RoomMessagesResponse(room_id, chunk, page.start, page.end)
+        if done:
+            gs.log.debug(f"End of time window reached in room {room_id}.")
+            return
+
+
+class PagePrefetcher:
+    """Fetch pages of an async page iterator ahead of its consumer.
+
+    A background task pulls pages from the wrapped iterator while the
+    consumer is still processing earlier pages. At most `depth` pages are
+    buffered, so memory stays bounded. Iterate over the object to get the
+    pages in their original order.
+    """
+
+    def __init__(self, pages: AsyncIterator, depth: int):
+        """Start fetching pages in the background."""
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=depth)
+        self.task = asyncio.create_task(self._produce(pages))
+
+    async def _produce(self, pages: AsyncIterator) -> None:
+        try:
+            async for page in pages:
+                await self.queue.put(page)
+        except Exception as e:
+            gs.log.error(
+                "E259: "
+                "Error during prefetching of messages. "
+                "Not all messages might have been retrieved from server. "
+                f"Exception: {type(e)} {e}"
+            )
+            gs.err_count += 1
+            gs.log.debug("Here is the traceback.\n" + traceback.format_exc())
+        await self.queue.put(None)  # end marker
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        page = await self.queue.get()
+        if page is None:
+            raise StopAsyncIteration
+        return page
+
+    def cancel(self) -> None:
+        """Stop fetching further pages."""
+        self.task.cancel()
+
+
+async def paginate_rooms(
+    rooms: list, pages_of_room
+) -> AsyncIterator[tuple]:
+    """Paginate several rooms concurrently, yield them one after another.
+
+    Arguments:
+    ---------
+        rooms: list : room ids, in the order in which they are yielded
+        pages_of_room: callable : returns the async page iterator
+            (e.g. read_all_events_in_direction()) for a given room id
+
+    Yields
+    ------
+        tuple: (room_id, PagePrefetcher) for each room in order.
+            The consumer should exhaust the pages of one room before
+            asking for the next room. This keeps the output grouped per
+            room, while up to --concurrency rooms are already being
+            fetched in the background.
+
+    """
+    pending = iter(rooms)
+    running = []
+    for room_id in pending:
+        running.append(
+            (room_id, PagePrefetcher(pages_of_room(room_id), PREFETCH_PAGES))
+        )
+        if len(running) >= gs.pa.concurrency:
+            break
+    while running:
+        room_id, prefetcher = running.pop(0)
+        try:
+            yield room_id, prefetcher
+        finally:
+            prefetcher.cancel()
+        room_id = next(pending, None)
+        if room_id is not None:
+            running.append(
+                (
+                    room_id,
+                    PagePrefetcher(pages_of_room(room_id), PREFETCH_PAGES),
+                )
+            )
+
+
+async def merge_rooms(
+    rooms: list, pages_of_room, newest_first: bool
+) -> AsyncIterator[tuple]:
+    """Merge the events of several rooms into one stream by timestamp.
+
+    Arguments:
+    ---------
+        rooms: list : room ids
+        pages_of_room: callable : returns the async page iterator
+            (e.g. read_all_events_in_direction()) for a given room id.
+            The pages of each room must already be sorted in the
+            direction given by newest_first.
+        newest_first: bool : True if the pages are sorted newest first
+            (reading back in time), False if sorted oldest first.
+
+    Yields
+    ------
+        tuple: (room_id, event, page) in global server_timestamp order.
+            page is the RoomMessagesResponse the event belongs to.
+
+    This is a streaming k-way merge over a heap with one entry per room.
+    All rooms are read in parallel, but at most one page per room
+    (plus one page prefetched) is held in memory.
+
+    """
+    sign = -1 if newest_first else 1
+    streams = [PagePrefetcher(pages_of_room(room_id), 1) for room_id in rooms]
+    pages = [None for _ in rooms]
+    heap = []  # entries: (sort key, room index, position in page)
+
+    async def push(ii: int, pos: int) -> None:
+        if pages[ii] is None or pos >= len(pages[ii].chunk):
+            pages[ii] = await anext(streams[ii], None)
+            pos = 0
+            if pages[ii] is None:
+                return  # this room is exhausted
+        event = pages[ii].chunk[pos]
+        timestamp = getattr(event, "server_timestamp", 0) or 0
+        heapq.heappush(heap, (sign * timestamp, ii, pos))
+
+    try:
+        await asyncio.gather(*(push(ii, 0) for ii in range(len(rooms))))
+        while heap:
+            _, ii, pos = heapq.heappop(heap)
+            page = pages[ii]
+            yield rooms[ii], page.chunk[pos], page
+            await push(ii, pos + 1)
+    finally:
+        for stream in streams:
+            stream.cancel()
+
+
+async def events_of_rooms(
+    rooms: list, pages_of_room, newest_first: bool
+) -> AsyncIterator[tuple]:
+    """Get the events of several rooms, grouped by room or merged.
+
+    Yields tuples (room_id, event, page), where page is the
+    RoomMessagesResponse the event belongs to. If --merge-rooms is used,
+    events of all rooms are merged into one stream ordered by server
+    timestamp, see merge_rooms(). Otherwise all events of the first room
+    are yielded, then all of the second room, etc., see paginate_rooms().
+    """
+    if gs.pa.merge_rooms:
+        async for room_id, event, page in merge_rooms(
+            rooms, pages_of_room, newest_first
+        ):
+            yield room_id, event, page
+        return
+    async for room_id, pages in paginate_rooms(rooms, pages_of_room):
+        async for page in pages:
+            for event in page.chunk:
+                yield room_id, event, page
+
+
+def room_or_dummy(client: AsyncClient, room_id: str) -> MatrixRoom:
+    """Get room object from client, or a dummy room if it is unknown."""
+    if client.rooms and room_id in client.rooms:
+        return client.rooms[room_id]
+    return MatrixRoom(room_id, None, True)  # dummy_room
+
+
+def read_checkpoints(store_dir: str) -> dict:
+    """Read the --incremental checkpoints from the store directory.
+
+    Arguments:
+    ---------
+        store_dir: str : the store directory
+
+    Returns a dict mapping room ids to {"token": ..., "event_id": ...},
+    empty if there are no checkpoints yet.
+
+    """
+    path = os.path.join(store_dir, CHECKPOINTS_FILE)
+    try:
+        with open(path, "r") as f:
+            checkpoints = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        gs.log.warning(
+            f"W115: Checkpoint file {path} could not be read ({e}). "
+            "All messages will be read again."
+        )
+        return {}
+    gs.log.debug(f"Read checkpoints for {len(checkpoints)} rooms from {path}.")
+    return checkpoints
+
+
+def write_checkpoints(store_dir: str, checkpoints: dict) -> None:
+    """Write the --incremental checkpoints atomically to the store directory.
+
+    The file is first written to a temporary file which then replaces the
+    old file, so an interrupted run never leaves a corrupt checkpoint file.
+
+    Arguments:
+    ---------
+        store_dir: str : the store directory
+        checkpoints: dict : room id --> {"token": ..., "event_id": ...}
+
+    """
+    path = os.path.join(store_dir, CHECKPOINTS_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoints, f)
+    os.replace(tmp, path)
+    gs.log.debug(f"Wrote checkpoints for {len(checkpoints)} rooms to {path}.")
+
+
+def markdown_inline(text: str) -> str:
+    """Escape text for use within a line of Markdown, see --export.
+
+    Line breaks become blanks and characters with a meaning in Markdown
+    are backslash-escaped, so e.g. a display name cannot start a new
+    message, a header or a link.
+    """
+    return re.sub(
+        r"([\\`*_{}\[\]()<>#+\-.!|~])", r"\\\1", " ".join(text.split())
+    )
+
+
+def export_format(path: str) -> Optional[str]:
+    """Get the --export format from the file name, None if unsupported."""
+    if path.endswith(".gz"):
+        path = path[:-3]
+    return EXPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+class HistoryExporter:
+    """Write messages incrementally into an export file, see --export.
+
+    The format is derived from the file name: JSONL of the event sources
+    (one event per line), or a self-contained HTML or Markdown transcript.
+    If the file name ends in .gz the file is gzip-compressed while it is
+    written. Nothing is kept in memory, the file is flushed every
+    EXPORT_FLUSH_EVERY messages and closed properly on interruption.
+    """
+
+    def __init__(self, path: str):
+        """Open the export file and write the header."""
+        self.path = path
+        self.format = export_format(path)
+        if path.endswith(".gz"):
+            self.file = gzip.open(path, "wt", encoding="utf-8")
+        else:
+            self.file = open(path, "w", encoding="utf-8")
+        self.count = 0
+        if self.format == EXPORT_HTML:
+            self.file.write(
+                "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+                f"<title>{PROG_WITHOUT_EXT} export</title>\n<style>\n"
+                "body { font-family: sans-serif; max-width: 60em; "
+                "margin: auto; }\n"
+                ".msg { border-bottom: 1px solid #ddd; padding: 0.4em 0; }\n"
+                ".meta { color: #666; font-size: 0.85em; }\n"
+                ".sender { font-weight: bold; color: #000; }\n"
+                ".body { white-space: pre-wrap; margin-top: 0.2em; }\n"
+                "</style>\n</head>\n<body>\n"
+            )
+        elif self.format == EXPORT_MARKDOWN:
+            self.file.write(f"# {PROG_WITHOUT_EXT} export\n\n")
+        gs.log.debug(f"Exporting messages as {self.format} to {path}.")
+
+    def write(
+        self,
+        room: MatrixRoom,
+        room_nick: str,
+        event,
+        sender_nick: str,
+        event_datetime: str,
+        msg: str,
+    ) -> None:
+        """Write one message."""
+        if self.format == EXPORT_JSONL:
+            source = event.source
+            if "room_id" not in source:
+                source = dict(source, room_id=room.room_id)
+            self.file.write(json.dumps(source) + "\n")
+        elif self.format == EXPORT_HTML:
+            self.file.write(
+                f'<div class="msg" id="{html.escape(event.event_id)}">'
+                f'<div class="meta">{event_datetime} '
+                f'<span class="sender" title="{html.escape(event.sender)}">'
+                f"{html.escape(sender_nick)}</span> in "
+                f'<span class="room" title="{html.escape(room.room_id)}">'
+                f"{html.escape(room_nick)}</span></div>"
+                f'<div class="body">{html.escape(msg)}</div></div>\n'
+            )
+        else:  # EXPORT_MARKDOWN
+            # quote every line of the message and escape the names so
+            # neither can inject markdown headers or fake messages
+            quoted = "\n".join("> " + line for line in msg.split("\n"))
+            self.file.write(
+                f"**{markdown_inline(sender_nick)}** "
+                f"({markdown_inline(event.sender)}) in "
+                f"{markdown_inline(room_nick)} "
+                f"at {event_datetime}\n\n{quoted}\n\n"
+            )
+        self.count += 1
+        if self.count % EXPORT_FLUSH_EVERY == 0:
+            self.file.flush()
+
+    def close(self) -> None:
+        """Write the footer and close the export file."""
+        if self.format == EXPORT_HTML:
+            self.file.write("</body>\n</html>\n")
+        self.file.close()
+        gs.log.debug(f"Exported {self.count} messages to {self.path}.")
+
+
+class HistoryStats:
+    """Aggregate statistics over the messages of rooms, see --stats.
+
+    Only counters are kept, never the events, so memory use does not
+    depend on how many events are aggregated.
+    """
+
+    def __init__(self):
+        """Initialize the counters."""
+        self.count = 0
+        self.first_ts = None  # oldest server timestamp, millisec
+        self.last_ts = None  # newest server timestamp, millisec
+        self.media_count = 0
+        self.media_bytes = 0
+        self.by_room = Counter()
+        self.by_sender = Counter()
+        self.by_type = Counter()
+        self.by_hour = Counter()  # hour of day, "00" to "23"
+        self.by_day = Counter()  # "YYYY-MM-DD"
+
+    def add(self, room_id: str, event) -> None:
+        """Count one event."""
+        ts = event.server_timestamp
+        self.count += 1
+        if self.first_ts is None or ts < self.first_ts:
+            self.first_ts = ts
+        if self.last_ts is None or ts > self.last_ts:
+            self.last_ts = ts
+        self.by_room[room_id] += 1
+        self.by_sender[event.sender] += 1
+        content = event.source.get("content", {})
+        event_type = event.source.get("type", type(event).__name__)
+        msgtype = content.get("msgtype")
+        self.by_type[f"{event_type} {msgtype}" if msgtype else event_type] += 1
+        if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
+            self.media_count += 1
+            info = content.get("info")
+            if isinstance(info, dict) and isinstance(info.get("size"), int):
+                self.media_bytes += info["size"]
+        timestamp = datetime.datetime.fromtimestamp(int(ts / 1000))
+        self.by_hour[timestamp.strftime("%H")] += 1
+        self.by_day[timestamp.strftime("%Y-%m-%d")] += 1
+
+    def print(self) -> None:
+        """Print the summary according to --output."""
+
+        def datetime_str(ts):
+            if ts is None:
+                return None
+            return datetime.datetime.fromtimestamp(int(ts / 1000)).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+
+        sections = {
+            "by_room": dict(self.by_room.most_common()),
+            "by_sender": dict(self.by_sender.most_common()),
+            "by_type": dict(self.by_type.most_common()),
+            "by_hour": dict(sorted(self.by_hour.items())),
+            "by_day": dict(sorted(self.by_day.items())),
+        }
+        # output format controlled via --output flag
+        text = (
+            f"Statistics of {self.count} events in {len(self.by_room)} "
+            f"rooms, from {datetime_str(self.first_ts)} to "
+            f"{datetime_str(self.last_ts)}\n"
+            f"Media: {self.media_count} files, {self.media_bytes} bytes"
+        )
+        for name, counts in sections.items():
+            text += f"\n{name.replace('_', ' ').capitalize()}:"
+            for key, value in counts.items():
+                text += f"\n    {key}{SEP}{value}"
+        json_max = {
+            "events": self.count,
+            "rooms": len(self.by_room),
+            "first_event_datetime": datetime_str(self.first_ts),
+            "last_event_datetime": datetime_str(self.last_ts),
+            "media_files": self.media_count,
+            "media_bytes": self.media_bytes,
+        }
+        json_max.update(sections)
+        json_ = json_max.copy()
+        json_spec = None
+        print_output(
+            gs.pa.output,
+            text=text,
+            json_=json_,
+            json_max=json_max,
+            json_spec=json_spec,
+        )
+
+
+def open_archive(store_dir: str, create: bool) -> sqlite3.Connection:
+    """Open the SQLite archive of events in the store directory.
+
+    Arguments:
+    ---------
+        store_dir: str : the store directory
+        create: bool : create the archive if it does not exist yet
+
+    Returns the connection, which is kept in gs.archive and closed in
+    cleanup().
+
+    """
+    if gs.archive:
+        return gs.archive
+    path = os.path.join(store_dir, ARCHIVE_FILE)
+    if not create and not os.path.exists(path):
+        raise MatrixCommanderError(
+            "E260: "
+            f"No archive was found at {path}. Use --archive while "
+            "listening to build the archive before using --search."
+        ) from None
+    conn = sqlite3.connect(path)
+    try:
+        # WAL makes a commit per event cheap and lets --search read
+        # while another process is listening and writing
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(ARCHIVE_SCHEMA)
+    except sqlite3.OperationalError as e:
+        conn.close()
+        raise MatrixCommanderError(
+            "E261: "
+            f"Archive {path} could not be opened ({e}). The SQLite "
+            "library of your Python must include the FTS5 extension."
+        ) from None
+    gs.log.debug(f"Opened archive {path}.")
+    gs.archive = conn
+    return conn
+
+
+def archive_event(client: AsyncClient, room: MatrixRoom, event) -> None:
+    """Write a received event into the archive, see --archive.
+
+    Events are inserted or updated by event id, so reading the same
+    messages again (e.g. with --listen all) does not create duplicates.
+    A redaction removes the body and content of the redacted event from
+    the archive and from the full-text index.
+
+    Arguments:
+    ---------
+        client: AsyncClient : the NIO client
+        room: MatrixRoom : the room of the event
+        event: Event : the received event
+
+    """
+    conn = open_archive(client.store_path, create=True)
+    content = event.source.get("content", {})
+    body = content.get("body")
+    if not isinstance(body, str):
+        body = None
+    sender_nick = room.user_name(event.sender)
+    if not sender_nick:
+        sender_nick = user_id_to_short_user_name(event.sender)
+    with conn:  # commits, or rolls back on exception
+        if isinstance(event, RedactionEvent):
+            conn.execute(
+                "UPDATE events SET body = NULL, source = NULL "
+                "WHERE event_id = ?",
+                (event.redacts,),
+            )
+        conn.execute(
+            "INSERT INTO events (event_id, room_id, room, room_alias, "
+            "sender, sender_nick, timestamp, type, body, source) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (event_id) DO UPDATE SET room = excluded.room, "
+            "room_alias = excluded.room_alias, "
+            "sender_nick = excluded.sender_nick, type = excluded.type, "
+            "body = excluded.body, source = excluded.source",
+            (
+                event.event_id,
+                room.room_id,
+                room.display_name,
+                room.canonical_alias,
+                event.sender,
+                sender_nick,
+                event.server_timestamp,
+                event.source.get("type"),
+                body,
+                json.dumps(event.source),
+            ),
+        )
+    gs.log.debug(f"Archived event {event.event_id}.")
+
+
+def time_arg_to_ms(value: str) -> Optional[int]:
+    """Convert a --since or --until value to milliseconds since 1970.
+
+    Arguments:
+    ---------
+        value: str : either an integer (milliseconds since 1970) or a
+            date and time in ISO 8601 format, e.g. "2024-03-05 02:00" or
+            "2024-03-05T02:00:00+01:00". Without time zone the local time
+            zone is used.
+
+    Returns None if the value cannot be converted.
+
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        return None
 
 
 # according to pylama: function too complex: C901 # noqa: C901
@@ -4464,68 +6612,109 @@ async def listen_all(  # noqa: C901
     Print them. Then leave.
 
     The function room_messages() is used to get all messages.
+    Messages are read forward, page by page, starting from the beginning
+    of the room. So, they are printed in chronological order as soon
+    as the first page arrives, and memory use is bounded by the page
+    size regardless of the size of the room.
+
+    With --incremental, reading starts at the checkpoint left by the
+    previous run, see read_checkpoints().
 
     """
-    # we call sync() to get the next_batch marker
-    # we set full_state=True to get all room_ids
-    resp_s = await synchronize(client)  # sync() to get rooms
-    # this prints a summary of all new messages currently waiting in the queue
-    gs.log.debug(f"sync response = {type(resp_s)} :: {resp_s}")
-    gs.log.debug(f"client.next_batch after = (str) {client.next_batch}")
-    gs.log.debug(f"sync next_batch = (str) {resp_s.next_batch}")
-    gs.log.debug(f"sync rooms = (nio.responses.Rooms) {resp_s.rooms}")
-    gs.log.debug(f"client.rooms = {client.rooms}")
-    if not resp_s.rooms.join:  # no Rooms!
-        gs.log.debug(f"sync returned no rooms = {resp_s.rooms.join}")
-        return
+    # No sync() is done, see listen_tail().
 
     # Set up event callbacks
     callbacks = Callbacks(client)
     # Note: we are NOT registering a callback function!
 
-    # room_id = list(resp_s.rooms.join.keys())[0]  # first room_id from dict
-    # alternative way of getting room_id, client.rooms is also a dict
-    # room_id = list(client.rooms.keys())[0]  # first room_id from dict
-
     # get rooms as specified by the user thru args or credential file
     rooms = await determine_rooms(credentials["room_id"], client, credentials)
+    rooms = await load_rooms(client, rooms)
     gs.log.debug(f"Rooms are: {rooms}")
 
-    # To loop over all rooms, one can loop through the join dictionary. i.e.
-    # for room_id, room_info in resp_s.rooms.join.items():  # loop all rooms
-    for room_id in rooms:  # loop only over user specified rooms
-        prev_batch = resp_s.rooms.join[room_id].timeline.prev_batch
-        back_events = await read_all_events_in_direction(
-            client, room_id, prev_batch, MessageDirection.back
-        )
-        front_events = await read_all_events_in_direction(
-            client, room_id, prev_batch, MessageDirection.front
-        )
-
-        # We have to reverse the first list since we are going backwards (but
-        # we want to have a chronological order)
-        all_events = back_events[::-1] + front_events
-
-        for event in all_events:
-            gs.log.debug(f"sending event to callback = {event}.")
-            if client.rooms and client.rooms[room_id]:
-                room = client.rooms[room_id]
+    # room_id --> {"token": str, "event_id": str}, see --incremental
+    checkpoints = {}
+    if gs.pa.incremental:
+        checkpoints = read_checkpoints(client.store_path)
+
+    # No start token: read forward from the very first event of the
+    # room. This gives chronological order without having to keep
+    # the older half of the history in memory in order to reverse it.
+    # With --incremental read forward from the checkpoint instead.
+    # With --since or --until read only the messages in that window.
+    since = time_arg_to_ms(gs.pa.since) if gs.pa.since else None
+    until = time_arg_to_ms(gs.pa.until) if gs.pa.until else None
+
+    def pages_of_room(room_id):
+        if since is not None or until is not None:
+            return read_events_in_window(
+                client, room_id, MessageDirection.front, since, until
+            )
+        token = checkpoints.get(room_id, {}).get("token")
+        return read_all_events_in_direction(
+            client, room_id, token, MessageDirection.front
+        )
+
+    # loop only over user specified rooms
+    last_events = {}  # room_id --> last event fetched
+    # room_id --> event id of the last exported event on the first page
+    # that is re-read from a checkpoint; events up to it are skipped
+    skip_until = {
+        room_id: cp["event_id"] for room_id, cp in checkpoints.items()
+    }
+    # room_id --> set of the event ids on that first page
+    first_page_ids = {}
+    try:
+        async for room_id, event, page in events_of_rooms(
+            rooms, pages_of_room, newest_first=False
+        ):
+            if room_id in skip_until:
+                skip_event_id = skip_until[room_id]
+                if room_id not in first_page_ids:
+                    first_page_ids[room_id] = {e.event_id for e in page.chunk}
+                if skip_event_id not in first_page_ids[room_id]:
+                    # checkpoint event is gone, e.g. redacted and purged
+                    del skip_until[room_id]
+                else:
+                    # already processed in a previous run
+                    if event.event_id == skip_event_id:
+                        del skip_until[room_id]
+                    continue
+            last_events[room_id] = event
+            if gs.stats:
+                gs.stats.add(room_id, event)
             else:
-                room = MatrixRoom(room_id, None, True)  # dummy_room
-            await callbacks.message_callback(room, event)
-        if all_events:  # list not empty
-            last_event = all_events[-1]
-            resp = await client.room_read_markers(
-                room_id=room_id,
-                fully_read_event=last_event.event_id,
-                read_event=last_event.event_id,
-            )
-            if isinstance(resp, RoomReadMarkersError):
-                gs.log.error(
-                    "E163: "
-                    "room_read_markers failed with response "
-                    f"{privacy_filter(str(resp))}."
+                gs.log.debug(f"sending event to callback = {event}.")
+                await callbacks.message_callback(
+                    room_or_dummy(client, room_id), event
                 )
+            if gs.pa.incremental:
+                last_of_page = event is page.chunk[-1]
+                checkpoints[room_id] = {
+                    # end of page: continue after this page, else re-read
+                    # this page and skip up to and including this event
+                    "token": (
+                        page.end if last_of_page and page.end else page.start
+                    ),
+                    "event_id": event.event_id,
+                }
+                if last_of_page:
+                    write_checkpoints(client.store_path, checkpoints)
+    finally:
+        if gs.pa.incremental:
+            write_checkpoints(client.store_path, checkpoints)
+    for room_id, last_event in last_events.items():
+        resp = await client.room_read_markers(
+            room_id=room_id,
+            fully_read_event=last_event.event_id,
+            read_event=last_event.event_id,
+        )
+        if isinstance(resp, RoomReadMarkersError):
+            gs.log.error(
+                "E163: "
+                "room_read_markers failed with response "
+                f"{privacy_filter(str(resp))}."
+            )
 
 
 async def action_listen() -> None:
@@ -4548,10 +6737,23 @@ async def action_listen() -> None:
             await listen_once(gs.client)
             # could use 'await listen_once_alternative(gs.client)'
             # as an alternative implementation
-        elif gs.pa.listen == TAIL:
-            await listen_tail(gs.client, gs.credentials)
-        elif gs.pa.listen == ALL:
-            await listen_all(gs.client, gs.credentials)
+        elif gs.pa.listen in (TAIL, ALL):
+            if gs.pa.export:
+                gs.exporter = HistoryExporter(gs.pa.export)
+            if gs.pa.stats:
+                gs.stats = HistoryStats()
+            try:
+                if gs.pa.listen == TAIL:
+                    await listen_tail(gs.client, gs.credentials)
+                else:
+                    await listen_all(gs.client, gs.credentials)
+            finally:
+                if gs.exporter:
+                    gs.exporter.close()
+                    gs.exporter = None
+                if gs.stats:
+                    gs.stats.print()
+                    gs.stats = None
         else:
             gs.log.error(
                 "E165: "
@@ -4606,26 +6808,136 @@ async def action_set_display_name(
         )
 
 
+class ProfileCache:
+    """Cache of user profiles, see --profile-cache-ttl.
+
+    Keeps display name, avatar and other profile info of users in a JSON
+    file in the store, so that --get-display-name, --get-avatar and
+    --get-profile do not ask the server again for the same user within
+    the time to live. All three are answered from one get_profile()
+    request per user. Only global profiles are cached; the member state
+    of rooms holds per-room nick names, which are not the profile.
+    """
+
+    def __init__(self, path: Optional[str], ttl: int):
+        """Read the cache from file path; nothing is kept if ttl is 0."""
+        self.path = path if ttl > 0 else None
+        self.ttl = ttl
+        # user_id --> {"displayname", "avatar_url", "other_info", "time"}
+        self.entries = {}
+        self.changed = False
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            gs.log.debug(f"Profile cache {self.path} not read: {e}")
+
+    def _fresh(self, user_id: str) -> bool:
+        entry = self.entries.get(user_id)
+        return bool(entry) and time.time() - entry["time"] <= self.ttl
+
+    async def get(
+        self, client: AsyncClient, user_id: str, full: bool = False
+    ) -> Union[ProfileGetResponse, ProfileGetError]:
+        """Get the profile of user_id, from the cache if possible.
+
+        With full set, the other profile info is needed as well.
+        """
+        entry = self.entries.get(user_id)
+        if self._fresh(user_id) and not (full and entry["other_info"] is None):
+            gs.log.debug(f"Profile of {user_id} found in cache.")
+            return ProfileGetResponse(
+                entry["displayname"],
+                entry["avatar_url"],
+                entry["other_info"] or {},
+            )
+        resp = await client.get_profile(user_id)
+        if isinstance(resp, ProfileGetResponse):
+            self.entries[user_id] = {
+                "displayname": resp.displayname,
+                "avatar_url": resp.avatar_url,
+                "other_info": resp.other_info,
+                "time": time.time(),
+            }
+            self.changed = True
+        return resp
+
+    def save(self) -> None:
+        """Write the cache back to its file if anything changed."""
+        if not self.path or not self.changed:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self.changed = False
+
+
+def get_profile_cache(client: AsyncClient) -> ProfileCache:
+    """Get the profile cache, create it on first use."""
+    if not gs.profile_cache:
+        gs.profile_cache = ProfileCache(
+            os.path.join(client.store_path, PROFILE_CACHE_FILE),
+            gs.pa.profile_cache_ttl,
+        )
+    return gs.profile_cache
+
+
+def users_to_look_up(users: list) -> list:
+    """Clean up a list of user ids given as arguments.
+
+    A '-' is replaced by the user ids read from stdin, one per line.
+    Empty lines and lines starting with '#' are skipped. Duplicates are
+    removed.
+    """
+    result = []
+    for user in users:
+        if user == "-":
+            for line in sys.stdin:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    result.append(line)
+        else:
+            result.append(user.strip())
+    return list(dict.fromkeys(result))  # remove duplicates in list
+
+
 async def action_get_display_name(
     client: AsyncClient, credentials: dict
 ) -> None:
-    """Get display name(s) while already logged in."""
+    """Get display name(s) while already logged in.
+
+    Users are looked up in parallel, see --concurrency, and printed as
+    they arrive. Profiles can be cached, see --profile-cache-ttl.
+    """
     if not gs.pa.user:
         # get display name of myself
         whoami = credentials["user_id"]
         users = [whoami]
     else:
-        users = gs.pa.user
-    users = list(dict.fromkeys(users))  # remove duplicates in list
-    for user in users:
-        resp = await client.get_displayname(user)
-        if isinstance(resp, ProfileGetDisplayNameError):
+        users = users_to_look_up(gs.pa.user)
+    cache = get_profile_cache(client)
+
+    async def lookup(user):
+        return user, await cache.get(client, user)
+
+    async for user, resp in as_completed_with_concurrency(
+        [lookup(user) for user in users]
+    ):
+        if isinstance(resp, ProfileGetError):
             gs.log.error(
                 "E169: "
                 f"get_displayname failed with {privacy_filter(str(resp))}"
             )
             gs.err_count += 1
         else:
+            transport_response = resp.transport_response  # None if cached
+            resp = ProfileGetDisplayNameResponse(resp.displayname)
+            resp.transport_response = transport_response  # for json-max
             gs.log.debug(
                 f"get_displayname successful with {privacy_filter(str(resp))}"
             )
@@ -4641,7 +6953,7 @@ async def action_get_display_name(
             json_max = resp.__dict__
             json_max.update({"user": user})  # add dict items
             json_ = json_max.copy()
-            json_.pop("transport_response")
+            json_.pop("transport_response", None)  # None if cached
             json_spec = None
             print_output(
                 gs.pa.output,
@@ -4650,6 +6962,7 @@ async def action_get_display_name(
                 json_max=json_max,
                 json_spec=json_spec,
             )
+    cache.save()
 
 
 async def action_set_presence(client: AsyncClient, credentials: dict) -> None:
@@ -4671,16 +6984,20 @@ async def action_set_presence(client: AsyncClient, credentials: dict) -> None:
 
 
 async def action_get_presence(client: AsyncClient, credentials: dict) -> None:
-    """Get presence(s) while already logged in."""
+    """Get presence(s) while already logged in.
+
+    Users are looked up in parallel, see --concurrency, and printed as
+    they arrive. Presence changes too often to be cached.
+    """
     if not gs.pa.user:
         # get presence name of myself
         whoami = credentials["user_id"]
         users = [whoami]
     else:
-        users = gs.pa.user
-    users = list(dict.fromkeys(users))  # remove duplicates in list
-    for user in users:
-        resp = await client.get_presence(user)
+        users = users_to_look_up(gs.pa.user)
+    async for resp in as_completed_with_concurrency(
+        [client.get_presence(user) for user in users]
+    ):
         if isinstance(resp, PresenceGetError):
             gs.log.error(
                 "E171: "
@@ -4735,7 +7052,7 @@ async def action_upload(client: AsyncClient, credentials: dict) -> None:
         file_stat = await aiofiles.os.stat(filename)
         async with aiofiles.open(filename, "r+b") as f:
             resp, decryption_dict = await client.upload(
-                f,
+                rate_limited_upload(f),
                 content_type=mime_type,  # e.g. application/pdf
                 filename=os.path.basename(filename),
                 encrypt=encrypt,
@@ -4919,6 +7236,7 @@ async def action_delete_mxc_before(
 async def action_download(client: AsyncClient, credentials: dict) -> None:
     """Download a file from content repository of Matrix server.
     Assumes that user is already logged in.
+    Up to --concurrency files are downloaded in parallel.
     """
     if not gs.pa.download:
         gs.log.debug("Download list is empty. Nothing to download. Skipping.")
@@ -4929,7 +7247,7 @@ async def action_download(client: AsyncClient, credentials: dict) -> None:
             filenames.append(None)
     decryption_strings = gs.pa.key_dict
     if decryption_strings:
-        while len(decryption_strings) < len(gs.pa.key_dict):
+        while len(decryption_strings) < len(gs.pa.download):
             decryption_strings.append(None)
     # filenames is now None or list at least as long as downloads
     # decryption_strings is now None or list at least as long as downloads
@@ -4939,8 +7257,8 @@ async def action_download(client: AsyncClient, credentials: dict) -> None:
         "'*** hidden to prevent leaks'"
         # f"{decryption_strings}"
     )
-    ii = 0
-    for download in gs.pa.download:
+
+    async def download_one(ii: int, mxc: str) -> None:
         if gs.pa.file_name:
             filename = filenames[ii]  # 1st choice
         else:
@@ -4958,52 +7276,35 @@ async def action_download(client: AsyncClient, credentials: dict) -> None:
                 "assumed that the download is not encrypted "
                 "(i.e. plain-text). No decryption will be attempted."
             )
-        mxc = download
-        resp = await download_mxc(client, mxc=mxc, filename=filename)
-        if isinstance(resp, DownloadError):
+        try:
+            filename = await download_mxc_to_file(
+                client,
+                mxc,
+                filename,
+                ast.literal_eval(decryption_str) if encrypted else None,
+            )
+        except Exception as e:
             gs.log.error(
                 "E176: "
                 f"download of URI '{mxc}' to local file '{filename}' "
-                f"failed with response {privacy_filter(str(resp))}"
+                f"failed. Exception: {privacy_filter(str(e))}"
             )
             gs.err_count += 1
-        else:
-            url = urlparse(mxc)
-            media_id = url.path.strip("/")
-            if filename == "":
-                filename = "mxc-" + MXC_ID_PLACEHOLDER
-            if not filename:
-                filename = resp.filename  # 2nd choice, from server
-                gs.log.debug(f"File name on server: {filenames}")
-            else:
-                filename = filename.replace(MXC_ID_PLACEHOLDER, media_id)
-            if not filename:
-                filename = "mxc-" + media_id  # 3rd choice, mxc_id
-            gs.log.debug(
-                f"Download of URI '{mxc}' to local file '{filename}' "
-                f"successful with {len(resp.body)} bytes of data downloaded, "
-                f"content_type {resp.content_type}; "
-                f"remote filename {resp.filename}; "
-                f"encrypted {encrypted}; "
-                "key dictionary '*** hidden to prevent leaks'. "
-                # f"key dictionary {decryption_str}. "
-                "Trying to save data now."
-            )
-            if encrypted:
-                decryption_dict = ast.literal_eval(decryption_str)
-                with open(filename, "wb") as file:
-                    file.write(
-                        crypto.attachments.decrypt_attachment(
-                            resp.body,
-                            decryption_dict["key"]["k"],
-                            decryption_dict["hashes"]["sha256"],
-                            decryption_dict["iv"],
-                        )
-                    )
-            else:  # plain, unencrypted
-                with open(filename, "wb") as file:
-                    file.write(resp.body)
-        ii += 1
+            gs.log.debug("Here is the traceback.\n" + traceback.format_exc())
+            return
+        gs.log.debug(
+            f"Download of URI '{mxc}' to local file '{filename}' "
+            f"successful, "
+            f"encrypted {encrypted}; "
+            "key dictionary '*** hidden to prevent leaks'. "
+        )
+
+    # downloads run in parallel, at most --concurrency at a time,
+    # except if written to stdout where they must not be mixed up
+    await gather_with_concurrency(
+        [download_one(ii, mxc) for ii, mxc in enumerate(gs.pa.download)],
+        1 if filenames and "-" in filenames else None,
+    )
 
 
 async def action_joined_rooms(client: AsyncClient, credentials: dict) -> None:
@@ -5563,14 +7864,27 @@ async def action_rest(client: AsyncClient, credentials: dict) -> None:
 
 
 async def action_get_avatar(client: AsyncClient, credentials: dict) -> None:
-    """Get avatar(s) of itself or users while already logged in."""
+    """Get avatar(s) of itself or users while already logged in.
+
+    Users are looked up in parallel, see --concurrency, and printed as
+    they arrive. Profiles can be cached, see --profile-cache-ttl.
+    """
     if gs.pa.get_avatar == []:
         gs.pa.get_avatar.append(credentials["user_id"])  # whoami
-    gs.log.debug(f"Getting avatars for these users: {gs.pa.get_avatar}")
-    for user_id in gs.pa.get_avatar:
-        user_id = user_id.strip()
-        resp = await client.get_avatar(user_id)
-        if isinstance(resp, ProfileGetAvatarResponse):
+    users = users_to_look_up(gs.pa.get_avatar)
+    gs.log.debug(f"Getting avatars for these users: {users}")
+    cache = get_profile_cache(client)
+
+    async def lookup(user_id):
+        return user_id, await cache.get(client, user_id)
+
+    async for user_id, resp in as_completed_with_concurrency(
+        [lookup(user_id) for user_id in users]
+    ):
+        if isinstance(resp, ProfileGetResponse):
+            transport_response = resp.transport_response  # None if cached
+            resp = ProfileGetAvatarResponse(resp.avatar_url)
+            resp.transport_response = transport_response  # for json-max
             gs.log.debug(
                 "ProfileGetAvatarResponse. Response is: "
                 f"{privacy_filter(str(resp))}"
@@ -5589,7 +7903,7 @@ async def action_get_avatar(client: AsyncClient, credentials: dict) -> None:
             json_max = resp.__dict__
             json_max.update({"avatar_http": avatar_url})  # add dict items
             json_ = json_max.copy()
-            json_.pop("transport_response")
+            json_.pop("transport_response", None)  # None if cached
             json_spec = None
             print_output(
                 gs.pa.output,
@@ -5605,16 +7919,27 @@ async def action_get_avatar(client: AsyncClient, credentials: dict) -> None:
                 f"from server. {privacy_filter(str(resp))}"
             )
             gs.err_count += 1
+    cache.save()
 
 
 async def action_get_profile(client: AsyncClient, credentials: dict) -> None:
-    """Get user profile(s) of itself or users while already logged in."""
+    """Get user profile(s) of itself or users while already logged in.
+
+    Users are looked up in parallel, see --concurrency, and printed as
+    they arrive. Profiles can be cached, see --profile-cache-ttl.
+    """
     if gs.pa.get_profile == []:
         gs.pa.get_profile.append(credentials["user_id"])  # whoami
-    gs.log.debug(f"Getting user profiles for these users: {gs.pa.get_profile}")
-    for user_id in gs.pa.get_profile:
-        user_id = user_id.strip()
-        resp = await client.get_profile(user_id)
+    users = users_to_look_up(gs.pa.get_profile)
+    gs.log.debug(f"Getting user profiles for these users: {users}")
+    cache = get_profile_cache(client)
+
+    async def lookup(user_id):
+        return user_id, await cache.get(client, user_id, full=True)
+
+    async for user_id, resp in as_completed_with_concurrency(
+        [lookup(user_id) for user_id in users]
+    ):
         if isinstance(resp, ProfileGetError):
             gs.log.error(
                 "E189: "
@@ -5648,7 +7973,7 @@ async def action_get_profile(client: AsyncClient, credentials: dict) -> None:
             json_max = resp.__dict__
             json_max.update({"avatar_http": avatar_url})  # add dict items
             json_ = json_max.copy()
-            json_.pop("transport_response")
+            json_.pop("transport_response", None)  # None if cached
             json_spec = None
             print_output(
                 gs.pa.output,
@@ -5657,6 +7982,7 @@ async def action_get_profile(client: AsyncClient, credentials: dict) -> None:
                 json_max=json_max,
                 json_spec=json_spec,
             )
+    cache.save()
 
 
 async def action_get_client_info(
@@ -5669,18 +7995,43 @@ async def action_get_client_info(
 
 
 async def action_get_room_info(client: AsyncClient, credentials: dict) -> None:
-    """Get room display name(s) of itself or rooms while already logged in."""
+    """Get room display name(s) of itself or rooms while already logged in.
+
+    No sync() is done. Rooms not yet known to the client are built from
+    their name, alias, topic and encryption state events, all rooms in
+    parallel, see room_from_state(). Only for rooms without name and
+    alias the members are fetched, as the display name is made from them.
+    """
     if gs.pa.get_room_info == []:
         gs.pa.get_room_info.append(credentials["room_id"])
     gs.log.debug(
         "Getting room display names for these rooms: " f"{gs.pa.get_room_info}"
     )
-    await synchronize(client)  # sync() to get rooms
-    # user_id = credentials["user_id"]
-    for room_id in gs.pa.get_room_info:
+
+    async def room_info(room_id: str):
         room_id = await map_roominfo_to_roomid(client, room_id)
+        if room_id in client.rooms:
+            return room_id, client.rooms[room_id]
+        room = await room_from_state(client, room_id, ROOM_INFO_STATE_EVENTS)
+        if not room.name and not room.canonical_alias:
+            resp = await add_joined_members(client, room)
+            if resp:
+                return room_id, resp  # e.g. not a member of the room
+        return room_id, room
+
+    # user_id = credentials["user_id"]
+    for room_id, room in await gather_with_concurrency(
+        [room_info(room_id) for room_id in gs.pa.get_room_info]
+    ):
+        if isinstance(room, JoinedMembersError):
+            gs.log.error(
+                "E190: "
+                f"Failed getting room display name for room {room_id} "
+                f"from server. {privacy_filter(str(room))}"
+            )
+            gs.err_count += 1
+            continue
         try:
-            room = client.rooms[room_id]
             room_displayname = room.display_name
         except Exception as e:
             gs.log.error(
@@ -5725,6 +8076,51 @@ async def action_get_room_info(client: AsyncClient, credentials: dict) -> None:
             )
 
 
+def has_permission(
+    power_levels: dict, user_id: str, permission_type: str
+) -> Union[bool, ErrorResponse]:
+    """Check a permission against the content of m.room.power_levels.
+
+    Arguments:
+    ---------
+    power_levels : dict
+        content of the m.room.power_levels state event of a room
+    user_id : str
+        user whose permission is checked
+    permission_type : str
+        'ban', 'invite', 'kick', 'redact', 'notifications',
+        'events_default', 'state_default', 'users_default', or an event
+        type like 'm.room.name'
+
+    Missing levels default to the values of the Matrix specification.
+    Event types not listed in 'events' need 'state_default' if they are
+    state events of the specification, else 'events_default'.
+    Returns True or False, or ErrorResponse if permission_type is unknown.
+    """
+
+    def level(name: str) -> int:
+        value = power_levels.get(name)
+        return value if isinstance(value, int) else POWER_LEVEL_DEFAULTS[name]
+
+    users = power_levels.get("users", {})
+    user_level = users.get(user_id, level("users_default"))
+    events = power_levels.get("events", {})
+    if permission_type == "notifications":
+        needed = power_levels.get("notifications", {}).get("room", 50)
+    elif permission_type in POWER_LEVEL_DEFAULTS:
+        needed = level(permission_type)
+    elif permission_type in events:
+        needed = events[permission_type]
+    elif "." in permission_type:  # an event type
+        if permission_type in STATE_EVENT_TYPES:
+            needed = level("state_default")
+        else:
+            needed = level("events_default")
+    else:
+        return ErrorResponse(f"permission_type {permission_type} unknown")
+    return user_level >= needed
+
+
 async def action_has_permission(
     client: AsyncClient, credentials: dict
 ) -> None:
@@ -5739,23 +8135,47 @@ async def action_has_permission(
         gs.err_count += 1
         return
     user_id = credentials["user_id"]  # whoami
-    for ii in range(len(gs.pa.has_permission) // 2):
-        room_id = gs.pa.has_permission[ii * 2 + 0]
-        room_id = room_id.replace(r"\!", "!")  # remove possible escape
-        room_id = await map_roominfo_to_roomid(client, room_id)
-        permission_type = gs.pa.has_permission[ii * 2 + 1].strip()
+    pairs = [
+        (
+            gs.pa.has_permission[ii * 2 + 0].replace(r"\!", "!"),
+            gs.pa.has_permission[ii * 2 + 1].strip(),
+        )
+        for ii in range(len(gs.pa.has_permission) // 2)
+    ]
+    # Each room is resolved and its power levels are fetched only once,
+    # all rooms in parallel. Then all pairs are evaluated locally.
+    rooms = list(dict.fromkeys(room for room, _ in pairs))
+    room_ids = dict(
+        zip(
+            rooms,
+            await gather_with_concurrency(
+                [map_roominfo_to_roomid(client, room) for room in rooms]
+            ),
+        )
+    )
+    unique_room_ids = list(dict.fromkeys(room_ids.values()))
+    power_levels = dict(
+        zip(
+            unique_room_ids,
+            await gather_with_concurrency(
+                [
+                    client.room_get_state_event(
+                        room_id, "m.room.power_levels"
+                    )
+                    for room_id in unique_room_ids
+                ]
+            ),
+        )
+    )
+    for room, permission_type in pairs:
+        room_id = room_ids[room]
         gs.log.debug(
             "Preparing to ask about permission for permission type "
             f"'{permission_type}' in room {room_id}."
         )
-        try:
-            resp = await client.has_permission(room_id, permission_type)
-        except Exception as e:
-            resp = ErrorResponse(
-                "E192: "
-                f"has_permission() failed with '{e}'. "
-                f"Is the room id {room_id} correct?"
-            )
+        resp = power_levels[room_id]
+        if not isinstance(resp, RoomGetStateEventError):
+            resp = has_permission(resp.content, user_id, permission_type)
         if isinstance(resp, ErrorResponse):
             gs.log.error(
                 "E193: "
@@ -5783,20 +8203,20 @@ async def action_has_permission(
         else:
             gs.log.debug(
                 f"has_permission {user_id} for permission type "
-                f"'{permission_type}' in room {room_id}: "
-                f"{privacy_filter(str(resp))}"
+                f"'{permission_type}' in room {room_id}: {resp}"
             )
             # output format controlled via --output flag
             text = (
-                f"{privacy_filter(str(resp))}{SEP}{user_id}{SEP}{room_id}{SEP}"
+                f"{resp}{SEP}{user_id}{SEP}{room_id}{SEP}"
                 f"{permission_type}"
             )
-            # Object of type xxxResponse is not JSON
-            # serializable, hence we use the dictionary.
-            json_max = resp.__dict__
-            # json_max.update({"key": value})  # add dict items
+            json_max = {
+                "has_permission": resp,
+                "user_id": user_id,
+                "room_id": room_id,
+                "permission_type": permission_type,
+            }
             json_ = json_max.copy()
-            json_.pop("transport_response")
             json_spec = None
             print_output(
                 gs.pa.output,
@@ -6144,13 +8564,22 @@ async def action_room_get_visibility(
 async def action_room_get_state(
     client: AsyncClient, credentials: dict
 ) -> None:
-    """Get state of room(s) while already logged in."""
+    """Get state of room(s) while already logged in.
+
+    The states of the rooms are fetched in parallel, see --concurrency,
+    and printed in the order the rooms were given.
+    """
     if gs.pa.room_get_state == []:
         gs.pa.room_get_state.append(credentials["room_id"])  # default room
-    for room_id in gs.pa.room_get_state:
+
+    async def room_state(room_id: str):
         room_id = await map_roominfo_to_roomid(client, room_id)
-        gs.log.debug(f"Getting visibility for room {room_id}.")
-        resp = await client.room_get_state(room_id)
+        gs.log.debug(f"Getting state for room {room_id}.")
+        return room_id, await client.room_get_state(room_id)
+
+    for room_id, resp in await gather_with_concurrency(
+        [room_state(room_id) for room_id in gs.pa.room_get_state]
+    ):
         if isinstance(resp, RoomGetStateResponse):
             gs.log.info(
                 f"Successfully got state for room {resp.room_id}: "
@@ -6174,25 +8603,158 @@ async def action_room_get_state(
             )
         else:
             gs.log.error(
-                "E208: "
+                "E208: "
+                f"Failed getting state for room {room_id}. "
+                f"{privacy_filter(str(resp))}"
+            )
+            gs.err_count += 1
+            errmsg = "Error: " + str(resp.status_code) + " " + resp.message
+            # output format controlled via --output flag
+            # for JSON the user can determine which one from the list
+            # was successful and which one failed. For 4 inputs there
+            # might only be 3 output JSON objects if there was 1 error.
+            # In text mode we print this error line, so that for 4 inputs
+            # there will be 4 output lines.
+            print_output(
+                gs.pa.output,
+                text=(f"{errmsg}{SEP}{room_id}"),
+                json_=None,
+                json_max=None,
+                json_spec=None,
+            )
+
+
+def read_room_state_snapshots(store_dir: str) -> dict:
+    """Read the --room-state-diff snapshots from the store directory.
+
+    Arguments:
+    ---------
+        store_dir: str : the store directory
+
+    Returns a dict mapping room ids to {type: {state_key: event_id}},
+    empty if there are no snapshots yet.
+
+    """
+    path = os.path.join(store_dir, ROOM_STATE_SNAPSHOTS_FILE)
+    try:
+        with open(path, "r") as f:
+            snapshots = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        gs.log.warning(
+            f"W117: Room state file {path} could not be read ({e}). "
+            "All state events will be reported as added."
+        )
+        return {}
+    gs.log.debug(f"Read state of {len(snapshots)} rooms from {path}.")
+    return snapshots
+
+
+def write_room_state_snapshots(store_dir: str, snapshots: dict) -> None:
+    """Write the --room-state-diff snapshots atomically to the store.
+
+    Arguments:
+    ---------
+        store_dir: str : the store directory
+        snapshots: dict : room id --> {type: {state_key: event_id}}
+
+    """
+    path = os.path.join(store_dir, ROOM_STATE_SNAPSHOTS_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshots, f)
+    os.replace(tmp, path)
+    gs.log.debug(f"Wrote state of {len(snapshots)} rooms to {path}.")
+
+
+async def action_room_state_diff(
+    client: AsyncClient, credentials: dict
+) -> None:
+    """Print how the state of room(s) changed since the last run.
+
+    For each room only the type, state key and event id of its state
+    events are kept in the store. The states of the rooms are fetched
+    in parallel, see --concurrency, and compared to what was kept. One
+    line is printed for each added, changed or removed state event.
+    """
+    if gs.pa.room_state_diff == []:
+        gs.pa.room_state_diff.append(credentials["room_id"])  # default room
+    snapshots = read_room_state_snapshots(client.store_path)
+
+    async def room_state(room_id: str):
+        room_id = await map_roominfo_to_roomid(client, room_id)
+        gs.log.debug(f"Getting state for room {room_id}.")
+        return room_id, await client.room_get_state(room_id)
+
+    def report(room_id, change, event_type, state_key, event_id, event):
+        # output format controlled via --output flag
+        text = (
+            f"{change}{SEP}{room_id}{SEP}{event_type}{SEP}{state_key}"
+            f"{SEP}{event_id}"
+        )
+        json_max = {
+            "change": change,
+            "room_id": room_id,
+            "type": event_type,
+            "state_key": state_key,
+            "event_id": event_id,
+            "event": event,  # None for removed state
+        }
+        json_ = json_max.copy()
+        json_spec = event
+        print_output(
+            gs.pa.output,
+            text=text,
+            json_=json_,
+            json_max=json_max,
+            json_spec=json_spec,
+        )
+
+    for room_id, resp in await gather_with_concurrency(
+        [room_state(room_id) for room_id in gs.pa.room_state_diff]
+    ):
+        if not isinstance(resp, RoomGetStateResponse):
+            gs.log.error(
+                "E267: "
                 f"Failed getting state for room {room_id}. "
                 f"{privacy_filter(str(resp))}"
             )
             gs.err_count += 1
-            errmsg = "Error: " + str(resp.status_code) + " " + resp.message
-            # output format controlled via --output flag
-            # for JSON the user can determine which one from the list
-            # was successful and which one failed. For 4 inputs there
-            # might only be 3 output JSON objects if there was 1 error.
-            # In text mode we print this error line, so that for 4 inputs
-            # there will be 4 output lines.
-            print_output(
-                gs.pa.output,
-                text=(f"{errmsg}{SEP}{room_id}"),
-                json_=None,
-                json_max=None,
-                json_spec=None,
-            )
+            continue
+        old = snapshots.get(room_id, {})
+        new = {}
+        for event in resp.events:
+            if "state_key" not in event:
+                continue
+            event_type = event["type"]
+            state_key = event["state_key"]
+            new.setdefault(event_type, {})[state_key] = event["event_id"]
+            previous = old.get(event_type, {}).get(state_key)
+            if previous == event["event_id"]:
+                continue
+            change = "changed" if previous else "added"
+            report(
+                room_id,
+                change,
+                event_type,
+                state_key,
+                event["event_id"],
+                event,
+            )
+        for event_type, state_keys in old.items():
+            for state_key, event_id in state_keys.items():
+                if state_key not in new.get(event_type, {}):
+                    report(
+                        room_id,
+                        "removed",
+                        event_type,
+                        state_key,
+                        event_id,
+                        None,
+                    )
+        snapshots[room_id] = new
+    write_room_state_snapshots(client.store_path, snapshots)
 
 
 async def action_delete_device(client: AsyncClient, credentials: dict) -> None:
@@ -6352,6 +8914,219 @@ async def action_whoami(client: AsyncClient, credentials: dict) -> None:
     )
 
 
+async def action_search(client: AsyncClient, credentials: dict) -> None:
+    """Search the local archive of events, see --archive.
+
+    The query uses the SQLite FTS5 query syntax and is matched against
+    message body, sender and room name. Results can be restricted with
+    --room, --user, --since and --until. Results are printed oldest
+    first. No server is contacted.
+
+    """
+    conn = open_archive(client.store_path, create=False)
+    sql = (
+        "SELECT e.event_id, e.room_id, e.room, e.sender, e.sender_nick, "
+        "e.timestamp, e.body, e.source FROM events_fts "
+        "JOIN events AS e ON e.id = events_fts.rowid "
+        "WHERE events_fts MATCH ?"
+    )
+    params = [gs.pa.search]
+    if gs.pa.room:
+        marks = ", ".join("?" * len(gs.pa.room))
+        sql += (
+            f" AND (e.room_id IN ({marks}) OR e.room_alias IN ({marks}) "
+            f"OR e.room IN ({marks}))"
+        )
+        params += gs.pa.room * 3
+    if gs.pa.user:
+        sql += f" AND e.sender IN ({', '.join('?' * len(gs.pa.user))})"
+        params += gs.pa.user
+    if gs.pa.since:
+        sql += " AND e.timestamp >= ?"
+        params.append(time_arg_to_ms(gs.pa.since))
+    if gs.pa.until:
+        sql += " AND e.timestamp < ?"
+        params.append(time_arg_to_ms(gs.pa.until))
+    sql += " ORDER BY e.timestamp"
+    gs.log.debug(f"Searching archive with {sql} and {params}.")
+    try:
+        rows = conn.execute(sql, params)
+        count = 0
+        for (
+            event_id,
+            room_id,
+            room_name,
+            sender,
+            sender_nick,
+            timestamp,
+            body,
+            source,
+        ) in rows:
+            event_datetime = datetime.datetime.fromtimestamp(
+                int(timestamp / 1000)
+            ).strftime("%Y-%m-%d %H:%M:%S")
+            # Prevent faking messages by prefixing each line of a multiline
+            # message with space.
+            fixed_body = re.sub("\n", "\n    ", zn(body))
+            # output format controlled via --output flag
+            text = (
+                f"Message found in room {zn(room_name)} [{room_id}] | "
+                f"sender {zn(sender_nick)} [{sender}] | {event_datetime} | "
+                f"{event_id} | {fixed_body}"
+            )
+            json_max = {
+                "event_id": event_id,
+                "room_id": room_id,
+                "room_display_name": room_name,
+                "sender": sender,
+                "sender_nick": sender_nick,
+                "server_timestamp": timestamp,
+                "event_datetime": event_datetime,
+                "body": body,
+                "source": json.loads(source) if source else None,
+            }
+            json_ = json_max.copy()
+            json_.pop("source")
+            json_spec = json_max["source"]
+            print_output(
+                gs.pa.output,
+                text=text,
+                json_=json_,
+                json_max=json_max,
+                json_spec=json_spec,
+            )
+            count += 1
+    except sqlite3.OperationalError as e:
+        gs.log.error(
+            "E262: "
+            f"Search for {gs.pa.search} failed. Is the query valid "
+            f"FTS5 syntax? ({e})"
+        )
+        gs.err_count += 1
+        return
+    gs.log.debug(f"Search for {gs.pa.search} found {count} messages.")
+
+
+async def action_search_server(
+    client: AsyncClient, credentials: dict
+) -> None:
+    """Search messages with the /search API of the homeserver.
+
+    The server does the searching with its own index, so only the hits are
+    transferred. Results are fetched page by page following next_batch and
+    each hit is printed as soon as its page arrives, newest first, in the
+    same format as --listen output. Encrypted messages cannot be searched
+    by the server, so no room keys are needed.
+
+    """
+    rooms = []
+    if gs.pa.room:
+        rooms = await load_rooms(client, gs.pa.room, to_device=False)
+    since = time_arg_to_ms(gs.pa.since) if gs.pa.since else None
+    until = time_arg_to_ms(gs.pa.until) if gs.pa.until else None
+    event_filter = {}
+    if rooms:
+        event_filter["rooms"] = rooms
+    if gs.pa.user:
+        event_filter["senders"] = gs.pa.user
+    content = {
+        "search_categories": {
+            "room_events": {
+                "search_term": gs.pa.search_server,
+                "keys": ["content.body"],
+                "order_by": "recent",
+                "filter": event_filter,
+            }
+        }
+    }
+    callbacks = Callbacks(client)
+    next_batch = None
+    count = 0
+    while True:
+        query = {"next_batch": next_batch} if next_batch else None
+        status, resp = await matrix_api_call(
+            client, "POST", ["search"], query, content
+        )
+        if status != 200:
+            gs.log.error(
+                "E263: "
+                f"Server search for {gs.pa.search_server} failed with "
+                f"status {status} and response {resp}."
+            )
+            gs.err_count += 1
+            return
+        room_events = resp.get("search_categories", {}).get(
+            "room_events", {}
+        )
+        hits = []  # (room_id, event) of this page
+        for hit in room_events.get("results", []):
+            event_dict = hit["result"]
+            timestamp = event_dict.get("origin_server_ts", 0)
+            if until and timestamp >= until:
+                continue
+            if since and timestamp < since:
+                # results are newest first, the rest is even older
+                next_batch = None
+                break
+            event = Event.parse_event(event_dict)
+            if isinstance(event, BadEvent):
+                gs.log.debug(f"Skipping unparsable search hit {event_dict}.")
+                continue
+            hits.append((event_dict["room_id"], event))
+        else:
+            next_batch = room_events.get("next_batch")
+        # load the rooms of the page not known yet, all at once
+        await load_rooms(
+            client,
+            [room_id for room_id, _ in hits if room_id not in client.rooms],
+            to_device=False,
+        )
+        for room_id, event in hits:
+            await callbacks.message_callback(
+                room_or_dummy(client, room_id), event
+            )
+            count += 1
+        if not next_batch:
+            break
+    gs.log.debug(
+        f"Server search for {gs.pa.search_server} found {count} messages."
+    )
+
+
+async def action_mirror_media(
+    client: AsyncClient, credentials: dict
+) -> None:
+    """Download all media of a room into a directory, see --mirror-media.
+
+    The history of the room is read from its beginning. Media files are
+    downloaded in the background by --concurrency workers into a
+    content-addressed store in the directory while the history is still
+    being read. Media already in the store, e.g. from a previous run, is
+    skipped, so later runs only transfer new media.
+
+    """
+    room, media_dir = gs.pa.mirror_media
+    os.makedirs(media_dir, exist_ok=True)
+    room_id = (await load_rooms(client, [room]))[0]
+    matrix_room = room_or_dummy(client, room_id)
+    downloader = MediaDownloader(client, media_dir, mirror=True)
+    count = 0
+    try:
+        async for page in read_all_events_in_direction(
+            client, room_id, None, MessageDirection.front
+        ):
+            for event in page.chunk:
+                if isinstance(
+                    event, (RoomMessageMedia, RoomEncryptedMedia)
+                ) and media_download_wanted(matrix_room, event):
+                    await downloader.submit(matrix_room, event)
+                    count += 1
+        await downloader.close()  # let the downloads finish
+    finally:
+        await downloader.close(drain=False)  # if interrupted
+    gs.log.debug(f"Found {count} media files in room {room_id}.")
+
+
 async def action_roomsetget() -> None:
     """Perform room, get, set actions while being logged in."""
     if not gs.client and not gs.credentials:
@@ -6394,6 +9169,8 @@ async def action_roomsetget() -> None:
             await action_room_get_visibility(gs.client, gs.credentials)
         if gs.pa.room_get_state is not None:  # empty list must invoke func
             await action_room_get_state(gs.client, gs.credentials)
+        if gs.pa.room_state_diff is not None:  # empty list must invoke func
+            await action_room_state_diff(gs.client, gs.credentials)
         if gs.pa.room_resolve_alias:
             await action_room_resolve_alias(gs.client, gs.credentials)
         if gs.room_action:
@@ -6460,6 +9237,12 @@ async def action_roomsetget() -> None:
             await action_get_openid_token(gs.client, gs.credentials)
         if gs.pa.whoami:
             await action_whoami(gs.client, gs.credentials)
+        if gs.pa.search:
+            await action_search(gs.client, gs.credentials)
+        if gs.pa.search_server:
+            await action_search_server(gs.client, gs.credentials)
+        if gs.pa.mirror_media:
+            await action_mirror_media(gs.client, gs.credentials)
         if gs.setget_action:
             gs.log.debug("Set or get action(s) were performed or attempted.")
     except Exception as e:
@@ -6582,6 +9365,7 @@ async def action_verify_manual() -> None:
         # In practice, you want to have a list of previously-known device IDs
         # for each user you want to trust. user id and device ids
         trust_devices(user_to_trust, [device_to_trust])
+        flush_output()
         print(
             "Hit Control-C to continue.",
             file=sys.stdout,
@@ -6725,6 +9509,7 @@ async def action_verify_emoji() -> None:
                 "in their Matrix client. Newer versions of Element seem "
                 "to no longer support this."
             )
+        flush_output()
         print(
             helptext,
             file=sys.stdout,
@@ -7263,6 +10048,17 @@ async def async_main() -> None:
     # close client
     # sys.argv ordering? # todo
     try:
+        if gs.pa.batch_output:
+            try:
+                asyncio.get_running_loop().add_signal_handler(
+                    signal.SIGTERM, terminate_on_sigterm
+                )
+            except NotImplementedError:  # e.g. Windows, nothing to do
+                pass
+        if gs.pa.upload_rate_limit:
+            gs.upload_limiter = RateLimiter(gs.pa.upload_rate_limit)
+        if gs.pa.download_rate_limit:
+            gs.download_limiter = RateLimiter(gs.pa.download_rate_limit)
         if gs.pa.login:
             await action_login()  # explicit login
         else:
@@ -7290,9 +10086,19 @@ async def async_main() -> None:
             await action_listen()
         if gs.pa.logout:
             await action_logout()
+        if gs.media_downloader:
+            # let the background downloads finish
+            await gs.media_downloader.close()
     except Exception:
         raise
     finally:
+        if gs.media_downloader:
+            # if interrupted, e.g. by Control-C, do not wait for downloads
+            await gs.media_downloader.close(drain=False)
+            gs.media_downloader = None
+        if gs.avatar_cache:
+            gs.avatar_cache.close()
+            gs.avatar_cache = None
         if gs.client:
             await gs.client.close()
 
@@ -7571,6 +10377,7 @@ def initial_check_of_args() -> None:  # noqa: C901
         # room get
         or gs.pa.room_get_visibility is not None  # empty list must invoke func
         or gs.pa.room_get_state is not None  # empty list must invoke func
+        or gs.pa.room_state_diff is not None  # empty list must invoke func
         or gs.pa.room_resolve_alias
     ):
         gs.room_action = True
@@ -7613,6 +10420,9 @@ def initial_check_of_args() -> None:  # noqa: C901
         or gs.pa.export_keys
         or gs.pa.get_openid_token is not None  # empty list must invoke func
         or gs.pa.whoami
+        or gs.pa.search
+        or gs.pa.search_server
+        or gs.pa.mirror_media
     ):
         gs.get_action = True
     else:
@@ -7636,6 +10446,7 @@ def initial_check_of_args() -> None:  # noqa: C901
     STDIN_AUDIO = 0
     STDIN_FILE = 0
     STDIN_EVENT = 0
+    STDIN_USER = 0
     STDIN_TOTAL = 0
     if gs.pa.image:
         for image in gs.pa.image:
@@ -7662,11 +10473,24 @@ def initial_check_of_args() -> None:  # noqa: C901
             if message == "-" or message == "_":
                 STDIN_MESSAGE += 1
                 gs.stdin_use = "message"
+    users_to_read = (gs.pa.get_avatar or []) + (gs.pa.get_profile or [])
+    if gs.pa.user and (gs.pa.get_display_name or gs.pa.get_presence):
+        users_to_read += gs.pa.user
+    if "-" in users_to_read:
+        STDIN_USER += 1
+        gs.stdin_use = "user"
     STDIN_TOTAL = (
-        STDIN_MESSAGE + STDIN_IMAGE + STDIN_AUDIO + STDIN_FILE + STDIN_EVENT
+        STDIN_MESSAGE
+        + STDIN_IMAGE
+        + STDIN_AUDIO
+        + STDIN_FILE
+        + STDIN_EVENT
+        + STDIN_USER
     )
 
-    if gs.pa.download_media_name == "" and gs.pa.download_media:
+    if gs.pa.download_media_name == "" and (
+        gs.pa.download_media or gs.pa.mirror_media
+    ):
         gs.pa.download_media_name = MEDIA_NAME_DEFAULT
 
     # Secondly, the checks
@@ -7807,14 +10631,41 @@ def initial_check_of_args() -> None:  # noqa: C901
             "either. Specify --listen or --tail "
             f"and run program again. ({gs.pa.download_media})"
         )
-    elif gs.pa.download_media_name != "" and (not gs.pa.download_media):
+    elif gs.pa.download_media_name != "" and not (
+        gs.pa.download_media or gs.pa.mirror_media
+    ):
         t = (
-            "If --download-media is not used, "
+            "If --download-media or --mirror-media is not used, "
             "then --download-media-name must not be used "
             "either. Specify --download-media "
             f"and run program again. ({gs.pa.download_media_name})"
         )
-    elif gs.pa.download_media and gs.pa.download_media_name not in (
+    elif (
+        gs.pa.download_media_max_size is not None
+        or gs.pa.download_media_mime_types
+    ) and not (gs.pa.download_media or gs.pa.mirror_media):
+        t = (
+            "If --download-media or --mirror-media is not used, "
+            "then --download-media-max-size and "
+            "--download-media-mime-types must not be used "
+            "either. Specify --download-media "
+            "and run program again."
+        )
+    elif (
+        gs.pa.download_media_rooms
+        or gs.pa.download_media_thumbnail
+        or gs.pa.download_media_dedup
+    ) and not gs.pa.download_media:
+        t = (
+            "If --download-media is not used, "
+            "then --download-media-rooms, --download-media-thumbnail and "
+            "--download-media-dedup must not be used "
+            "either. Specify --download-media "
+            "and run program again."
+        )
+    elif (
+        gs.pa.download_media or gs.pa.mirror_media
+    ) and gs.pa.download_media_name not in (
         MEDIA_NAME_SOURCE,
         MEDIA_NAME_CLEAN,
         MEDIA_NAME_EVENTID,
@@ -7825,6 +10676,102 @@ def initial_check_of_args() -> None:  # noqa: C901
             f"Only '{MEDIA_NAME_SOURCE}', '{MEDIA_NAME_CLEAN}', "
             f"'{MEDIA_NAME_EVENTID}', '{MEDIA_NAME_TIME}' are allowed."
         )
+    elif gs.pa.concurrency <= 0:
+        t = (
+            "An integer 1 or larger must be specified with --concurrency "
+            f"({gs.pa.concurrency})."
+        )
+    elif gs.pa.profile_cache_ttl < 0:
+        t = (
+            "A number 0 or larger must be specified with "
+            f"--profile-cache-ttl ({gs.pa.profile_cache_ttl})."
+        )
+    elif gs.pa.download_segments <= 0:
+        t = (
+            "An integer 1 or larger must be specified with "
+            f"--download-segments ({gs.pa.download_segments})."
+        )
+    elif gs.pa.upload_rate_limit is not None and gs.pa.upload_rate_limit <= 0:
+        t = (
+            "An integer 1 or larger must be specified with "
+            f"--upload-rate-limit ({gs.pa.upload_rate_limit})."
+        )
+    elif (
+        gs.pa.download_rate_limit is not None
+        and gs.pa.download_rate_limit <= 0
+    ):
+        t = (
+            "An integer 1 or larger must be specified with "
+            f"--download-rate-limit ({gs.pa.download_rate_limit})."
+        )
+    elif gs.pa.merge_rooms and gs.pa.listen not in (TAIL, ALL):
+        t = (
+            "Option --merge-rooms can only be used together with "
+            "--listen tail or --listen all."
+        )
+    elif gs.pa.incremental and gs.pa.listen != ALL:
+        t = (
+            "Option --incremental can only be used together with "
+            "--listen all."
+        )
+    elif gs.pa.since is not None and time_arg_to_ms(gs.pa.since) is None:
+        t = (
+            "Incorrect value given for --since. Specify a date and time "
+            "like '2024-03-05 02:00' or milliseconds since 1970 "
+            f"({gs.pa.since})."
+        )
+    elif gs.pa.until is not None and time_arg_to_ms(gs.pa.until) is None:
+        t = (
+            "Incorrect value given for --until. Specify a date and time "
+            "like '2024-03-05 03:00' or milliseconds since 1970 "
+            f"({gs.pa.until})."
+        )
+    elif (gs.pa.since or gs.pa.until) and not (
+        gs.pa.search or gs.pa.search_server or gs.pa.listen in (TAIL, ALL)
+    ):
+        t = (
+            "Options --since and --until can only be used with --search, "
+            "--search-server, --listen tail or --listen all."
+        )
+    elif (gs.pa.since or gs.pa.until) and gs.pa.incremental:
+        t = (
+            "Options --since and --until cannot be used together with "
+            "--incremental."
+        )
+    elif (
+        gs.pa.download_media_max_size is not None
+        and gs.pa.download_media_max_size < 0
+    ):
+        t = (
+            "A number 0 or larger must be specified with "
+            f"--download-media-max-size ({gs.pa.download_media_max_size})."
+        )
+    elif gs.pa.download_media_thumbnail and not re.fullmatch(
+        r"[1-9][0-9]*[xX][1-9][0-9]*", gs.pa.download_media_thumbnail
+    ):
+        t = (
+            "Incorrect value given for --download-media-thumbnail. "
+            "Specify width and height like '320x240' "
+            f"({gs.pa.download_media_thumbnail})."
+        )
+    elif gs.pa.export and gs.pa.listen not in (TAIL, ALL):
+        t = (
+            "Option --export can only be used together with "
+            "--listen tail or --listen all."
+        )
+    elif gs.pa.stats and gs.pa.listen not in (TAIL, ALL):
+        t = (
+            "Option --stats can only be used together with "
+            "--listen tail or --listen all."
+        )
+    elif gs.pa.stats and gs.pa.export:
+        t = "Options --stats and --export cannot be used together."
+    elif gs.pa.export and not export_format(gs.pa.export):
+        t = (
+            f"Unsupported file name for --export ({gs.pa.export}). "
+            "The file name must end in .jsonl, .html, .htm, .md or "
+            ".markdown, optionally followed by .gz."
+        )
     elif gs.pa.listen == TAIL and (gs.pa.tail <= 0):
         t = (
             "An integer 1 or larger must be specified with --tail "
@@ -7847,6 +10794,18 @@ def initial_check_of_args() -> None:  # noqa: C901
             f'into "{PROG_WITHOUT_EXT}". Stdin pipe can '
             "be used at most once."
         )
+    elif gs.pa.stream_edit is not None and (
+        not gs.pa.message or "_" not in gs.pa.message
+    ):
+        t = (
+            "Option --stream-edit can only be used when streaming "
+            "messages via a pipe with '-m _'."
+        )
+    elif gs.pa.stream_edit is not None and gs.pa.stream_edit < 0:
+        t = (
+            "A number 0 or larger must be specified with --stream-edit "
+            f"({gs.pa.stream_edit})."
+        )
     elif gs.pa.no_ssl and gs.pa.ssl_certificate != SSL_CERTIFICATE_DEFAULT:
         t = (
             "Options --no-ssl and --ssl-certificate cannot be used "
@@ -8442,7 +11401,9 @@ def main_inner(
         "using display names as they might not be unique, and you could "
         "be sending to the wrong person. To see possible display names use "
         "the --joined-members '*' option which will show you the display "
-        "names in the middle column.",
+        "names in the middle column. "
+        "With --search and --search-server, --user restricts the search "
+        "to messages sent by the given full user ids.",
     )
     ap.add_argument(
         "--user-login",
@@ -8707,6 +11668,27 @@ def main_inner(
         "will be printed in a separate message. "
         "By default, i.e. if not set, no messages will be split.",
     )
+    ap.add_argument(
+        "--stream-edit",
+        required=False,
+        type=float,
+        default=STREAM_EDIT_UNUSED_DEFAULT,  # when option is not used
+        nargs="?",  # makes the number optional
+        const=STREAM_EDIT_USED_DEFAULT,  # when used without number
+        metavar="SECONDS",
+        help="Send streamed lines as edits of a single message. "
+        "Details:: Only meaningful when streaming via a pipe with "
+        "'-m _'. The first line read from the pipe is sent as a "
+        "normal message. Each later line is sent as an edit "
+        "(m.replace) of that first message, so the room shows one "
+        "evolving message instead of one event per line. This is "
+        "useful for progress or status updates of long-running jobs. "
+        "The optional argument is the minimum interval in seconds "
+        f"between two edits; it defaults to {STREAM_EDIT_USED_DEFAULT}. "
+        "Lines arriving faster than that are coalesced and only the "
+        "latest one is sent. The last line is always sent "
+        "when the pipe is closed.",
+    )
     # -c is already used for --credentials
     ap.add_argument(
         "--config",
@@ -8804,7 +11786,14 @@ def main_inner(
         f'"{FOREVER}" that listen in ALL rooms, "{TAIL}" '
         f'and "{ALL}" listen '
         "only to the room specified in the credentials "
-        "file or the --room options. ",
+        "file or the --room options. "
+        f'"{TAIL}" and "{ALL}" do not do a full sync with the server, '
+        "which is slow for accounts with many rooms. Instead, only the "
+        "names, encryption states and current members of the specified "
+        "rooms are fetched. For encrypted rooms, a minimal sync then "
+        "fetches new room keys. The trade-off: senders who have left "
+        "a room are printed with their user id instead of their nick "
+        "name.",
     )
     ap.add_argument(
         "-t",
@@ -8832,6 +11821,80 @@ def main_inner(
         "they are from the user itself. "
         "Look at --listen as this option is related to --tail.",
     )
+    ap.add_argument(
+        "--merge-rooms",
+        required=False,
+        action="store_true",
+        help="Merge the messages of several rooms by time. "
+        "Details:: Only meaningful with '--listen tail' and "
+        "'--listen all'. By default, the messages of each room are "
+        "printed as a separate block, one room after the other. "
+        "If set, the messages of all specified rooms are merged into a "
+        "single stream ordered by server timestamp: oldest first for "
+        "'--listen all', newest first for '--listen tail'. This is "
+        "useful to correlate events across rooms. All rooms are read "
+        "in parallel, and only about one page of messages per room is "
+        "kept in memory.",
+    )
+    ap.add_argument(
+        "--incremental",
+        required=False,
+        action="store_true",
+        help="Only get messages not yet seen by a previous run. "
+        "Details:: Only meaningful with '--listen all'. If set, "
+        "a checkpoint (pagination token and event id) is kept per room "
+        "in the store directory. The next run with '--listen all "
+        "--incremental' continues after the last message printed by the "
+        "previous run instead of reading the complete history again. "
+        "The checkpoints are saved after each page of messages and when "
+        "the program is interrupted, so an aborted export of a long room "
+        "history can be resumed. Without '--incremental' the "
+        "checkpoints are neither read nor updated.",
+    )
+    ap.add_argument(
+        "--export",
+        required=False,
+        type=str,
+        metavar="FILE",
+        help="Write the messages into a file instead of printing them. "
+        "Details:: Only meaningful with '--listen tail' and "
+        "'--listen all'. The format is chosen by the file name: "
+        "'.jsonl' writes the source of each event as one JSON object per "
+        "line, '.html' or '.htm' writes a self-contained HTML transcript, "
+        "'.md' or '.markdown' writes a Markdown transcript. Append '.gz' "
+        "to compress the file with gzip while it is written, e.g. "
+        "'history.jsonl.gz'. The file is written incrementally, so even "
+        "very large rooms are exported with little memory. An existing "
+        "file is overwritten.",
+    )
+    ap.add_argument(
+        "--stats",
+        required=False,
+        action="store_true",
+        help="Print statistics instead of the messages. "
+        "Details:: Only meaningful with '--listen tail' and "
+        "'--listen all'. The messages are not printed. Instead, while "
+        "they are read, they are counted by room, sender, event type "
+        "(with message type), hour of day and day. The number and total "
+        "size of media files is added up as well. At the end only this "
+        "summary is printed, as text or, with --output, as JSON. Only "
+        "the counters are kept in memory, never the messages. Combine "
+        "with --since and --until to get the statistics of a time "
+        "window.",
+    )
+    ap.add_argument(
+        "--archive",
+        required=False,
+        action="store_true",
+        help="Archive received messages for --search. "
+        "Details:: If set and listening (with any --listen mode), all "
+        "received messages, including your own ones, are also written into "
+        f"an SQLite database '{ARCHIVE_FILE}' in the store directory. "
+        "The database keeps a full-text index on message body, sender and "
+        "room name. Redactions remove the redacted text from the archive. "
+        "Reading the same messages again, e.g. with '--listen all', does "
+        "not create duplicates. See --search.",
+    )
     ap.add_argument(
         "-y",
         "--listen-self",
@@ -8860,6 +11923,25 @@ def main_inner(
         "wishes to perform further operations on the sent object, "
         "e.g. redacting/deleting it after an expiration time, etc.",
     )
+    ap.add_argument(
+        "--full-room",
+        required=False,
+        action="store_true",
+        help="Print the full room with every received message. "
+        f"Details:: Applies to '--output {OUTPUT_JSON}' and "
+        f"'--output {OUTPUT_JSON_MAX}' of '--listen' and '--tail'. "
+        "By default, the 'room' field of each received message only "
+        "holds a compact reference to the room: its 'room_id', its "
+        "'display_name' and whether it is 'encrypted'. The full room, "
+        "with all its members and state, is printed as a record of its "
+        "own that has the single field 'room'. It is printed before the "
+        "first message of a room and again before the next message "
+        "whenever the room has changed, i.e. its name, its topic, its "
+        "number of members or its encryption. "
+        "With this option the full room is put into the 'room' field of "
+        "every message instead, as in earlier versions. In rooms with "
+        "thousands of members this makes each line hundreds of KB.",
+    )
     ap.add_argument(
         # starting with version 2.19 "-u" has been moved to --user!
         "--download-media",
@@ -8883,8 +11965,87 @@ def main_inner(
         "Absolute paths will remain unchanged. /tmp will remain /tmp. "
         "/tmp/foo will be /tmp/foo. "
         "If media is encrypted it will be decrypted and stored decrypted. "
+        "Media files are downloaded in the background by up to "
+        "--concurrency parallel downloads, so printing of messages "
+        "continues right away. Each completed download is reported in "
+        "its own output line. See --download-media-max-size, "
+        "--download-media-mime-types and --download-media-rooms to "
+        "control which media files are downloaded. "
         "By default media files will not be downloaded.",
     )
+    ap.add_argument(
+        "--download-media-max-size",
+        required=False,
+        type=int,
+        metavar="BYTES",
+        help="Only download media files up to this size. "
+        "Details:: Used with --download-media. Media files larger than "
+        "BYTES bytes, according to the size announced by the sender, are "
+        "not downloaded. Media files without announced size are "
+        "downloaded. By default there is no size limit.",
+    )
+    ap.add_argument(
+        "--download-media-mime-types",
+        required=False,
+        action="extend",
+        nargs="+",
+        type=str,
+        metavar="MIME_TYPE",
+        help="Only download media files of these MIME types. "
+        "Details:: Used with --download-media. Specify one or more MIME "
+        "types, wildcards are allowed, e.g. 'image/*' 'application/pdf'. "
+        "The MIME type announced by the sender is used. By default media "
+        "files of all types are downloaded.",
+    )
+    ap.add_argument(
+        "--download-media-rooms",
+        required=False,
+        action="extend",
+        nargs="+",
+        type=str,
+        metavar="ROOM",
+        help="Only download media files of these rooms. "
+        "Details:: Used with --download-media. Specify one or more room "
+        "ids, canonical aliases or room names. Media of other rooms is "
+        "still listed but not downloaded. By default media files of all "
+        "rooms are downloaded.",
+    )
+    ap.add_argument(
+        "--download-media-thumbnail",
+        required=False,
+        type=str,
+        metavar="WIDTHxHEIGHT",
+        help="Download thumbnails instead of full media files. "
+        "Details:: Used with --download-media. Instead of the original "
+        "media file a thumbnail of about the given size, e.g. '320x240', "
+        "is downloaded. For unencrypted media the server creates the "
+        "thumbnail, if it cannot (e.g. for videos) the thumbnail provided "
+        "by the sender is used. For encrypted media the thumbnail "
+        "provided by the sender is used. Only if there is no thumbnail "
+        "the full media file is downloaded. This saves a lot of "
+        "bandwidth if only previews are needed. Thumbnails get the file "
+        "extension of their own type, e.g. '.jpg', not the one of the "
+        "media file. --download-media-max-size is applied to the size "
+        "of the thumbnail as announced by the sender, and to the size "
+        "of the media file only if the full file is downloaded.",
+    )
+    ap.add_argument(
+        "--download-media-dedup",
+        required=False,
+        action="store_true",
+        help="Store each media file only once. "
+        "Details:: Used with --download-media. Downloaded media files "
+        f"are stored by the SHA-256 of their content in the '"
+        f"{MEDIA_OBJECTS_DIR}' subdirectory of the download directory. "
+        "The human-readable file names are hard links (or, if hard links "
+        "are not possible, symbolic links) to these files. Identical "
+        "media, even if sent several times, is stored only once. Media "
+        "that was already downloaded is not downloaded again, an index "
+        f"'{MEDIA_INDEX_FILE}' in the download directory remembers it. "
+        "The media id is added to each file name, e.g. "
+        "'image.AbCdEf.png', so no numbering of duplicate names is "
+        "needed.",
+    )
     ap.add_argument(
         "--download-media-name",
         required=False,
@@ -8925,6 +12086,11 @@ def main_inner(
         "Details:: If set and listening, "
         "then program will attempt to visually notify of "
         "arriving messages through the operating system. "
+        "Avatars of senders are shown if available. They are cached in "
+        f"the directory '{AVATAR_CACHE_DIR}' of the store, and refreshed "
+        f"after {AVATAR_CACHE_TTL // 3600} hours. The avatar of a new "
+        "sender is fetched in the background, so the first notification "
+        "from a sender may show no avatar. "
         "By default there is no notification via OS.",
     )
     ap.add_argument(
@@ -8967,6 +12133,10 @@ def main_inner(
         "itself. "
         "Send, listen and verify operations are allowed when "
         "getting display name(s). "
+        "With '--user -' the user ids are read from stdin, one per line. "
+        "Users are looked up in parallel, see --concurrency, and printed "
+        "in the order the answers arrive. Display names can be cached, see "
+        "--profile-cache-ttl. "
         "Do not confuse this option with the option '--get-room-info' "
         "which gets the room display name, not the user display name.",
     )
@@ -8992,7 +12162,10 @@ def main_inner(
         "--user option. If no user is specified get the presence of "
         "itself. "
         "Send, listen and verify operations are allowed when "
-        "getting presence(s).",
+        "getting presence(s). "
+        "With '--user -' the user ids are read from stdin, one per line. "
+        "Users are looked up in parallel, see --concurrency, and printed "
+        "in the order the answers arrive.",
     )
     ap.add_argument(
         "--upload",
@@ -9037,8 +12210,59 @@ def main_inner(
         "attempted; and the data might be stored in encrypted fashion, "
         "or might be plain-text if the --upload skipped encryption with "
         "--plain. "
+        "Up to --concurrency files are downloaded in parallel. Data is "
+        "first written to a file with the extension '.part' which is "
+        "renamed when the download is complete. If a download is "
+        "interrupted, running the same command again continues the "
+        "download where it stopped, provided the server supports "
+        "partial downloads. "
         "See tests/test-upload.sh for an example.",
     )
+    ap.add_argument(
+        "--download-segments",
+        required=False,
+        type=int,
+        default=DOWNLOAD_SEGMENTS_DEFAULT,
+        metavar="NUMBER",
+        help="Download large files with --download in parallel parts. "
+        "Details:: This option takes one argument, a positive integer. "
+        f"The default is {DOWNLOAD_SEGMENTS_DEFAULT}. "
+        "Files of at least "
+        f"{DOWNLOAD_SEGMENT_MIN_SIZE // (1024 * 1024)} MB are split into "
+        "this many segments which are downloaded at the same time and "
+        "joined afterwards. This can speed up downloads from servers that "
+        "limit the bandwidth per connection. The server must support "
+        "partial downloads, otherwise the file is downloaded in one piece.",
+    )
+    ap.add_argument(
+        "--upload-rate-limit",
+        required=False,
+        type=int,
+        metavar="BYTES_PER_SECOND",
+        help="Limit the bandwidth used for uploading files. "
+        "Details:: This option takes one argument, a positive integer. "
+        "All file uploads together, e.g. by --upload, --file, --image, "
+        "--audio, are limited to this many bytes per second. Other "
+        "requests to the server, like sync or sending messages, are not "
+        "limited and do not wait for uploads. Choose a limit somewhat "
+        "below the capacity of your link, so that these requests are not "
+        "delayed by bulk transfers. By default there is no limit.",
+    )
+    ap.add_argument(
+        "--download-rate-limit",
+        required=False,
+        type=int,
+        metavar="BYTES_PER_SECOND",
+        help="Limit the bandwidth used for downloading files. "
+        "Details:: This option takes one argument, a positive integer. "
+        "All file downloads together, e.g. by --download, "
+        "--download-media, --mirror-media, are limited to this many bytes "
+        "per second. Other requests to the server, like sync or sending "
+        "messages, are not limited and do not wait for downloads. Choose "
+        "a limit somewhat below the capacity of your link, so that these "
+        "requests are not delayed by bulk transfers. By default there is "
+        "no limit.",
+    )
     ap.add_argument(
         "--delete-mxc",
         required=False,
@@ -9244,7 +12468,11 @@ def main_inner(
         f"If no user id is specified, the avatar of {PROG_WITHOUT_EXT} will "
         "be fetched. If one or more user ids are given, the avatars of "
         "these users will be fetched. As response both MXC URI as well as URL "
-        "will be printed.",
+        "will be printed. "
+        "Specify '-' to read user ids from stdin, one per line. Users are "
+        "looked up in parallel, see --concurrency, and printed in the "
+        "order the answers arrive. Profiles can be cached, see "
+        "--profile-cache-ttl.",
     )
     ap.add_argument(
         "--get-profile",
@@ -9261,7 +12489,27 @@ def main_inner(
         "profiles of these users will be fetched. As response "
         "display name and avatar MXC URI as well as possible additional "
         "profile information (if present) "
-        "will be printed. One line per user will be printed.",
+        "will be printed. One line per user will be printed. "
+        "Specify '-' to read user ids from stdin, one per line. Users are "
+        "looked up in parallel, see --concurrency, and printed in the "
+        "order the answers arrive. Profiles can be cached, see "
+        "--profile-cache-ttl.",
+    )
+    ap.add_argument(
+        "--profile-cache-ttl",
+        required=False,
+        type=int,
+        default=PROFILE_CACHE_TTL_DEFAULT,
+        metavar="SECONDS",
+        help="Set how long user profiles are cached. "
+        "Details:: This option takes one argument, an integer 0 or larger. "
+        f"The default is {PROFILE_CACHE_TTL_DEFAULT}, i.e. no caching. "
+        "If larger than 0, --get-display-name, --get-avatar and "
+        "--get-profile keep the profiles of users in the file "
+        f"'{PROFILE_CACHE_FILE}' of the store, and ask the server again "
+        "only when an entry is older than this many seconds. Changes of "
+        "a profile within that time are not seen. E.g. use 3600 when "
+        "looking up many users repeatedly.",
     )
     ap.add_argument(
         "--get-room-info",
@@ -9321,8 +12569,12 @@ def main_inner(
         "For each parameter pair there will be one line printed to stdout. "
         "Values for the permission type are 'ban', "
         "'invite', 'kick', 'notifications', 'redact', etc. "
+        "Event types like 'm.room.name' are accepted as well. Event "
+        "types without a level of their own in the room need "
+        "'state_default' if they are state events, else 'events_default'. "
         "See https://spec.matrix.org/v1.2/client-server-api/#mroompower_levels"
-        ".",
+        ". The power levels of each room are fetched only once, and all "
+        "rooms in parallel, see --concurrency.",
         # 'events', 'events_default', 'state_default': valid permission types?
     )
     ap.add_argument(
@@ -9481,6 +12733,27 @@ def main_inner(
         "To get output into a human readable form pipe output through sed "
         "and jq as shown in an example in tests/test-setget.sh.",
     )
+    ap.add_argument(
+        "--room-state-diff",
+        required=False,
+        action="extend",
+        nargs="*",  # None if not used, [] is used without extra args
+        type=str,
+        metavar="ROOM",
+        help="Print how the state of one or more rooms changed. "
+        "Details:: Provide zero or more room ids as arguments. "
+        "If no argument is given, then the default room of "
+        f"{PROG_WITHOUT_EXT} (as found in credentials file) will be used. "
+        "The state of the rooms is fetched like with --room-get-state, "
+        "all rooms in parallel, see --concurrency. It is compared with the "
+        "state found by the previous run, which is kept in the file "
+        f"'{ROOM_STATE_SNAPSHOTS_FILE}' in the store. Only the state "
+        "events that were added, changed or removed since then are "
+        "printed, one line each: 'added', 'changed' or 'removed', room "
+        "id, event type, state key and event id. With JSON output the "
+        "whole new state event is included. On the first run all state "
+        "events are reported as added.",
+    )
     ap.add_argument(
         "--delete-device",
         required=False,
@@ -9546,6 +12819,86 @@ def main_inner(
         "One can get "
         "this information also by looking at the credentials file.",
     )
+    ap.add_argument(
+        "--search",
+        required=False,
+        type=str,
+        metavar="QUERY",
+        help="Search archived messages. "
+        "Details:: Search the local archive built with --archive. No "
+        "server is contacted. QUERY is matched against message body, "
+        "sender and room name using the SQLite FTS5 query syntax, e.g. "
+        "'release', 'relea*', '\"release date\"' or 'release AND NOT "
+        "beta'. Use --room to restrict the search to some rooms, --user "
+        "to restrict it to some senders, and --since and --until to "
+        "restrict it to a time window. Found messages are printed oldest "
+        "first. Use --output to get JSON output.",
+    )
+    ap.add_argument(
+        "--search-server",
+        required=False,
+        type=str,
+        metavar="QUERY",
+        help="Search messages on the server. "
+        "Details:: Search message bodies with the search API of the "
+        "homeserver, which uses the index of the server. This is much "
+        "cheaper than downloading the whole history with '--listen all'. "
+        "Encrypted messages cannot be found this way, see --search for "
+        "searching a local archive instead. Use --room to restrict the "
+        "search to some rooms (by default all joined rooms are searched), "
+        "--user to restrict it to some senders, and --since and --until "
+        "to restrict it to a time window. Found messages are printed "
+        "newest first, page by page as they arrive, in the same format "
+        "as with --listen, so --output, --print-event-id, --listen-self, "
+        "etc. apply.",
+    )
+    ap.add_argument(
+        "--mirror-media",
+        required=False,
+        type=str,
+        nargs=2,
+        metavar=("ROOM", "DIRECTORY"),
+        help="Download all media files of a room into a directory. "
+        "Details:: Reads the complete history of the room and downloads "
+        "every media file (image, audio, video, file), encrypted ones are "
+        "decrypted. Downloads run in parallel, see --concurrency. Files "
+        "are verified against the size (and for encrypted media the hash) "
+        "given by the sender. They are stored once by content in the "
+        f"'{MEDIA_OBJECTS_DIR}' subdirectory, with human-readable names "
+        "as links to them, as with --download-media-dedup. Media that is "
+        "already in the directory is not downloaded again, so running "
+        "the same command again later only transfers new media. "
+        "--download-media-name, --download-media-max-size and "
+        "--download-media-mime-types are applied.",
+    )
+    ap.add_argument(
+        "--since",
+        required=False,
+        type=str,
+        metavar="DATETIME",
+        help="Only consider messages at or after this time. "
+        "Details:: Used with --search, --search-server, '--listen all' "
+        "and '--tail'. With '--listen all' reading jumps directly to "
+        "this point in time instead of reading the room from its "
+        "beginning, using the timestamp_to_event API of the server. "
+        "Specify a date and time in ISO "
+        "8601 format like '2024-03-05 02:00' or "
+        "'2024-03-05T02:00:00+01:00' (local time zone if no time zone "
+        "is given), or an integer with milliseconds since 1970.",
+    )
+    ap.add_argument(
+        "--until",
+        required=False,
+        type=str,
+        metavar="DATETIME",
+        help="Only consider messages before this time. "
+        "Details:: Used with --search, --search-server, '--listen all' "
+        "and '--tail'. With '--tail' reading jumps directly to this point "
+        "in time and prints the last N messages before it, instead of "
+        "paging backwards from now. With '--listen all' reading stops "
+        "here. The format is the same as for "
+        "--since.",
+    )
     ap.add_argument(
         # no single char flag
         "--no-ssl",
@@ -9587,7 +12940,9 @@ def main_inner(
         help="Specify one or multiple file names for some actions. "
         "Details:: This is an optional argument. Use this option "
         "in combination with options like --download to specify one or "
-        "multiple file names. "
+        "multiple file names. With --download the file name '-' writes "
+        "the download to stdout, decrypted on the fly if a key "
+        "dictionary is given. "
         "Ignored if used by itself without an appropriate corresponding "
         "action.",
     )
@@ -9705,6 +13060,32 @@ def main_inner(
         "synchronization will be skipped entirely before the 'send' "
         "which will improve performance.",
     )
+    ap.add_argument(
+        "--concurrency",
+        required=False,
+        type=int,
+        default=CONCURRENCY_DEFAULT,  # when --concurrency is not used
+        metavar="NUMBER",
+        help="Set how many rooms, users or files are handled in parallel. "
+        "Details:: This option takes one argument, a positive integer. "
+        f"The default is {CONCURRENCY_DEFAULT}. "
+        "It is the one limit for all requests made in parallel: "
+        "(a) '--tail' and '--listen all' fetch the messages of up to "
+        "this many rooms in parallel, and fetch the next page of "
+        "messages of a room while the current page is being printed. "
+        "The output remains grouped by room, rooms are printed one "
+        "after another in the order given. "
+        "(b) '--download-media' and '--mirror-media' download up to "
+        "this many media files at the same time. "
+        "(c) '--download' downloads up to this many files at the same "
+        "time, except when writing to stdout. "
+        "(d) '--get-display-name', '--get-presence', '--get-avatar' and "
+        "'--get-profile' look up this many users in parallel. "
+        "(e) '--has-permission', '--get-room-info', '--room-get-state' "
+        "and '--room-state-diff' query this many rooms in parallel. "
+        "Loading the rooms for '--tail' and '--listen all' is limited "
+        "the same way. Use 1 to do one thing at a time.",
+    )
     ap.add_argument(
         "-o",  # incompatible change Dec 2022, -o moved from --os-notify
         "--output",
@@ -9746,6 +13127,42 @@ def main_inner(
         "'--listen' and '--tail'. All other arguments like '--get-room-info' "
         "will print no output. ",
     )
+    ap.add_argument(
+        "--fast-json",
+        required=False,
+        action="store_true",
+        help="Serialize JSON output with orjson. "
+        "Details:: Use the orjson package instead of Python's json module "
+        f"to produce the output of '--output {OUTPUT_JSON}', "
+        f"'{OUTPUT_JSON_MAX}' and '{OUTPUT_JSON_SPEC}'. "
+        "This is several times faster, which matters for long "
+        "'--listen' or '--tail' runs piped into other programs. "
+        "The output is compact, i.e. it has no blanks after ':' and ','; "
+        "the data is the same. "
+        "Objects that orjson cannot handle are serialized with the json "
+        "module as usual. "
+        "If orjson is not installed, a warning is given and the json "
+        "module is used.",
+    )
+    ap.add_argument(
+        "--batch-output",
+        required=False,
+        action="store_true",
+        help="Write output to a pipe or file in batches. "
+        "Details:: By default each line of output is written and flushed "
+        "on its own. With this option the lines are collected and "
+        f"written together, {OUTPUT_FLUSH_RECORDS} lines at a time or "
+        f"{OUTPUT_FLUSH_INTERVAL} seconds after the first one, whichever "
+        "comes first. This saves a system call per line and matters for "
+        "long '--listen' or '--tail' runs with many messages piped into "
+        f"other programs, mostly with '--output {OUTPUT_TEXT}' "
+        "and with '--fast-json'. "
+        "The price is that a line can reach the reading program up to "
+        f"{OUTPUT_FLUSH_INTERVAL} seconds later. Pending lines are written "
+        "when the program ends, also on SIGTERM, but they are lost if the "
+        "program is killed with SIGKILL or crashes. "
+        "Output to a terminal is never batched.",
+    )
     ap.add_argument(
         "--room-invites",
         required=False,
@@ -9926,6 +13343,8 @@ Send message as format "CODE".
 Send message after emojizing.
 <-p>, <--split> SEPARATOR
 Split message text into multiple Matrix messages.
+<--stream-edit> [SECONDS]
+Send streamed lines as edits of a single message.
 <--config> CONFIG_FILE
 Specify the location of a config file.
 <--proxy> PROXY
@@ -9938,12 +13357,34 @@ Send message end-to-end encrypted.
 Print received messages and listen to messages.
 <-t>, <--tail> [NUMBER]
 Print last messages.
+<--merge-rooms>
+Merge the messages of several rooms by time.
+<--incremental>
+Only get messages not yet seen by a previous run.
+<--export> FILE
+Write the messages into a file instead of printing them.
+<--stats>
+Print statistics instead of the messages.
+<--archive>
+Archive received messages for --search.
 <-y>, <--listen-self>
 Print your own messages as well.
 <--print-event-id>
 Print event ids of received messages.
+<--full-room>
+Print the full room with every received message.
 <--download-media> [DOWNLOAD_DIRECTORY]
 Download media files while listening.
+<--download-media-max-size> BYTES
+Only download media files up to this size.
+<--download-media-mime-types> MIME_TYPE [MIME_TYPE ...]
+Only download media files of these MIME types.
+<--download-media-rooms> ROOM [ROOM ...]
+Only download media files of these rooms.
+<--download-media-thumbnail> WIDTHxHEIGHT
+Download thumbnails instead of full media files.
+<--download-media-dedup>
+Store each media file only once.
 <--download-media-name> SOURCE|CLEAN|EVENTID|TIME
 Specify the method to derive the media filename.
 <--os-notify>
@@ -9962,6 +13403,12 @@ Get your presence.
 Upload one or multiple files to the content repository.
 <--download> MXC_URI [MXC_URI ...]
 Download one or multiple files from the content repository.
+<--download-segments> NUMBER
+Download large files with --download in parallel parts.
+<--upload-rate-limit> BYTES_PER_SECOND
+Limit the bandwidth used for uploading files.
+<--download-rate-limit> BYTES_PER_SECOND
+Limit the bandwidth used for downloading files.
 <--delete-mxc> MXC_URI [MXC_URI ...]
 Delete one or multiple objects from the content repository.
 <--delete-mxc-before> TIMESTAMP [TIMESTAMP ...]
@@ -9990,6 +13437,8 @@ Set your avatar.
 Get an avatar.
 <--get-profile> [USER ...]
 Get a user profile.
+<--profile-cache-ttl> SECONDS
+Set how long user profiles are cached.
 <--get-room-info> [ROOM ...]
 Get the room information.
 <--get-client-info>
@@ -10012,12 +13461,24 @@ Get an OpenID token.
 Get the visibility of one or more rooms.
 <--room-get-state> [ROOM ...]
 Get the state of one or more rooms.
+<--room-state-diff> [ROOM ...]
+Print how the state of one or more rooms changed.
 <--delete-device> DEVICE [DEVICE ...]
 Delete one or multiple devices.
 <--room-redact,> <--room-delete-content> ROOM_ID EVENT_ID REASON [ROOM_ID EVENT_ID REASON ...]
 Strip information out of one or several events.
 <--whoami>
 Print your user id.
+<--search> QUERY
+Search archived messages.
+<--search-server> QUERY
+Search messages on the server.
+<--mirror-media> ROOM DIRECTORY
+Download all media files of a room into a directory.
+<--since> DATETIME
+Only consider messages at or after this time.
+<--until> DATETIME
+Only consider messages before this time.
 <--no-ssl>
 Skip SSL verification.
 <--ssl-certificate> SSL_CERTIFICATE_FILE
@@ -10040,8 +13501,14 @@ Specify a homeserver for use by certain actions.
 Specify a device name, for use by certain actions.
 <--sync> FULL|OFF
 Choose synchronization options.
+<--concurrency> NUMBER
+Set how many rooms, users or files are handled in parallel.
 <-o>, <--output> TEXT|JSON|JSON-MAX|JSON-SPEC
 Select an output format.
+<--fast-json>
+Serialize JSON output with orjson.
+<--batch-output>
+Write output to a pipe or file in batches.
 <--room-invites> [LIST|JOIN|LIST+JOIN]
 List room invitations and/or join invited rooms.
 <-v>, -V, <--version> [PRINT|CHECK]
@@ -10188,6 +13655,13 @@ Print version information or check for updates.
                 "W111: " "Debug option -d overwrote option --log-level."
             )
             gs.warn_count += 1
+    if gs.pa.fast_json and not HAVE_ORJSON:
+        gs.log.warning(
+            "W118: "
+            "orjson is not installed. Option --fast-json is ignored. "
+            "Install orjson or remove the --fast-json option."
+        )
+        gs.warn_count += 1
 
     SEP = bytes(gs.pa.separator, "utf-8").decode("unicode_escape")
     gs.log.debug(
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+r"""benchmark-output.py.
+This is a simple micro-benchmark of the output path of 'matrix-commander'.
+It prints the same '--listen'-like records in a few ways and reports
+records per second for each:
+    1) '--output text', flushed after every record, as before
+    2) '--output text', with '--batch-output'
+    3) '--output json', as before: type of every object decided on every
+       call, flushed after every record
+    4) '--output json', type decisions cached, flushed after every record
+    5) '--output json', type decisions cached, with '--batch-output'
+    6) like 5) but with '--fast-json' (only if orjson is installed)
+Usage: tests/benchmark-output.py [NUMBER_OF_RECORDS [OUTPUT_FILE]]
+The output goes to /dev/null if no OUTPUT_FILE is given. Use a named pipe
+as OUTPUT_FILE to measure writing into a pipe.
+"""
+
+# isort: skip_file
+# isort: off
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+# print(f"Default path is: {sys.path}")
+# importing matrix_commander module
+try:
+    # if installed via pip
+    import matrix_commander  # nopep8 # isort: skip
+    from matrix_commander import matrix_commander as mc  # nopep8 # isort: skip
+except ImportError:
+    # if not installed via pip. if installed via 'git clone' or file download
+    # appending a local path to sys.path
+    sys.path.append("./matrix_commander")
+    sys.path.append("../matrix_commander")
+    # print(f"Expanded path is: {sys.path}")
+    import matrix_commander as mc  # nopep8 # isort: skip
+from nio import MatrixRoom, RoomMessageText  # nopep8 # isort: skip
+
+RECORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+OUTPUT_FILE = sys.argv[2] if len(sys.argv) > 2 else os.devnull
+
+
+def records(count):
+    """Return count records shaped like the ones of --listen."""
+    room = MatrixRoom("!benchmark:example.org", "@me:example.org")
+    for ii in range(20):
+        room.add_member(f"@user{ii}:example.org", f"User {ii}", None)
+    result = []
+    for ii in range(count):
+        source = {
+            "type": "m.room.message",
+            "event_id": f"$event{ii}",
+            "sender": f"@user{ii % 20}:example.org",
+            "origin_server_ts": 1700000000000 + ii,
+            "content": {"msgtype": "m.text", "body": f"message {ii}"},
+        }
+        event = RoomMessageText.from_dict(source)
+        json_ = {"source": source, "room": room, "event": event}
+        text = f"Message received for room {room.room_id} | {event}"
+        result.append((text, json_))
+    return result
+
+
+def uncached_obj_to_dict(obj):
+    """Behave like obj_to_dict() did before it cached its decisions."""
+    return mc.obj_to_dict_handler(obj)(obj)
+
+
+async def run(data, option, batch_output, fast_json):
+    """Print all records and return the seconds it took."""
+    mc.gs.pa.batch_output = batch_output
+    mc.gs.pa.fast_json = fast_json
+    mc.gs.output_writer = mc.OutputWriter()
+    start = time.perf_counter()
+    for text, json_ in data:
+        mc.print_output(option, text=text, json_=json_)
+    mc.gs.output_writer.flush()
+    return time.perf_counter() - start
+
+
+def main():
+    """Run the benchmark and print the results to stderr."""
+    mc.gs = mc.GlobalState()
+    mc.gs.log = logging.getLogger("benchmark")
+    mc.gs.pa = argparse.Namespace(
+        verbose=0, fast_json=False, batch_output=False
+    )
+    data = records(RECORDS)
+    text = mc.OUTPUT_TEXT
+    json_ = mc.OUTPUT_JSON
+    obj_to_dict = mc.obj_to_dict
+    cases = [
+        ("text, flush per record", text, False, False, False),
+        ("text, batched", text, True, False, False),
+        ("json, types uncached, flush per record", json_, False, False, True),
+        ("json, types cached, flush per record", json_, False, False, False),
+        ("json, types cached, batched", json_, True, False, False),
+    ]
+    if mc.HAVE_ORJSON:
+        name = "json, types cached, batched, orjson"
+        cases.append((name, json_, True, True, False))
+    stdout = sys.stdout
+    results = []
+    with open(OUTPUT_FILE, "w") as f:
+        sys.stdout = f
+        try:
+            for name, option, batch_output, fast_json, uncached in cases:
+                mc.obj_to_dict = (
+                    uncached_obj_to_dict if uncached else obj_to_dict
+                )
+                seconds = asyncio.run(
+                    run(data, option, batch_output, fast_json)
+                )
+                results.append((name, seconds))
+        finally:
+            sys.stdout = stdout
+            mc.obj_to_dict = obj_to_dict
+    for name, seconds in results:
+        # text is compared to text, json to json
+        baseline = results[0 if name.startswith("text") else 2][1]
+        print(
+            f"{name:40} {RECORDS / seconds:10.0f} records/s "
+            f"{baseline / seconds:6.2f}x",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main()